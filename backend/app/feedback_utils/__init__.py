@@ -3,11 +3,10 @@
 from sqlalchemy.orm import Session
 from pydantic import ValidationError
 import os
-import pandas as pd
 
 from .AbstractModel import AbstractModel, IPrompt, IConversation
 from . import prompts
-from .gpt import GPTModel
+from .gpt import GPTModel, LocalModel, get_model
 
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 
@@ -16,6 +15,9 @@ GOLDEN_PATH = os.path.join(SCRIPT_DIR, "golden_feedback.csv")
 
 def build_few_shot_instructions(fname: str = GOLDEN_PATH) -> str:
     """Construct a (partial) prompt for few-shot learning from a CSV file."""
+    # pandas is slow to import so it's only loaded when needed (by the job runner)
+    import pandas as pd
+
     assert os.path.isfile(GOLDEN_PATH)
     df = pd.read_csv(GOLDEN_PATH)
 
@@ -1,10 +1,11 @@
 import os
-from openai import OpenAI
-from openai.types.chat.chat_completion import ChatCompletion
 from .AbstractModel import AbstractModel, IPrompt
-from typing import List, Tuple, Optional, Callable, Any, cast
+from typing import List, Tuple, Optional, Callable, Any, cast, TYPE_CHECKING
 import config
 
+if TYPE_CHECKING:
+    from openai.types.chat.chat_completion import ChatCompletion
+
 logger = config.get_logger(__name__)
 
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -27,12 +28,23 @@ PRICES = {
 # convert to price / token
 PRICES = {k: [p / 1_000_000 for p in v] for k, v in PRICES.items()}
 
+# prefix of model names served locally, e.g. "local/Llama-2-7b-nl" (see LocalModel)
+LOCAL_PREFIX = "local/"
+
 
 class GPTModel(AbstractModel):
-    def __init__(self, api_key: str, model_name: str = "gpt-3.5-turbo-0125"):
+    def __init__(
+        self,
+        api_key: str,
+        model_name: str = "gpt-3.5-turbo-0125",
+        base_url: Optional[str] = None,
+    ):
+        # openai is slow to import so it's only loaded once a model is actually needed
+        from openai import OpenAI
+
         self.model_name = model_name
-        self.client = OpenAI(api_key=api_key)
-        if model_name not in PRICES.keys():
+        self.client = OpenAI(api_key=api_key, base_url=base_url)
+        if base_url is None and model_name not in PRICES.keys():
             logger.warning(f"price entry unknown for model '{model_name}'")
 
     def __call__(
@@ -42,7 +54,7 @@ class GPTModel(AbstractModel):
         json_mode: bool = False,
         temperature: Optional[float] = 1,
         top_p: Optional[float] = None,
-    ) -> Tuple[List[str], List[ChatCompletion]]:
+    ) -> Tuple[List[str], List["ChatCompletion"]]:
         """
         https://platform.openai.com/docs/api-reference/chat/create#chat-create-temperature
         https://community.openai.com/t/cheat-sheet-mastering-temperature-and-top-p-in-chatgpt-api/172683
@@ -78,17 +90,19 @@ class GPTModel(AbstractModel):
         return raw_outputs, completions
 
     @staticmethod
-    def compute_price(completions: ChatCompletion | List[ChatCompletion]) -> float:
+    def compute_price(
+        completions: "ChatCompletion | List[ChatCompletion]",
+    ) -> float:
         """Compute USD price of give API request(s)."""
         if not isinstance(completions, list):
             completions = [completions]
 
         total_price = 0.0
         for c in completions:
-            prompt_price, completion_price = PRICES[c.model]
             if c.model not in PRICES:
                 logger.warning(f"price entry unknown for model '{c.model}'")
                 continue
+            prompt_price, completion_price = PRICES[c.model]
             total_price += (
                 prompt_price * c.usage.prompt_tokens
                 + completion_price * c.usage.completion_tokens
@@ -96,6 +110,42 @@ class GPTModel(AbstractModel):
         return total_price
 
 
+class LocalModel(GPTModel):
+    """
+    Model served by a local OpenAI compatible server (see experiments/tuner/recipes/serve.py).
+    Priced at a fixed (e.g. amortized hardware) cost per token.
+    """
+
+    def __init__(
+        self, base_url: str, model_name: str, price_per_1m_tokens: float = 0.0
+    ):
+        super().__init__(api_key="local", model_name=model_name, base_url=base_url)
+        self.price_per_token = price_per_1m_tokens / 1_000_000
+
+    def compute_price(  # type: ignore[override]
+        self,
+        completions: "ChatCompletion | List[ChatCompletion]",
+    ) -> float:
+        if not isinstance(completions, list):
+            completions = [completions]
+        return self.price_per_token * sum(c.usage.total_tokens for c in completions)
+
+
+def get_model(
+    model_name: str,
+    api_key: str,
+    local_url: Optional[str] = None,
+    local_price_per_1m_tokens: float = 0.0,
+) -> GPTModel:
+    """Model for the given name, served locally if prefixed with LOCAL_PREFIX (otherwise by OpenAI)."""
+    if model_name.startswith(LOCAL_PREFIX):
+        assert local_url is not None, f"no local_url given for '{model_name}'"
+        return LocalModel(
+            local_url, model_name.removeprefix(LOCAL_PREFIX), local_price_per_1m_tokens
+        )
+    return GPTModel(api_key=api_key, model_name=model_name)
+
+
 def auto_reprompt(
     validator: Callable,
     max_retries: int,
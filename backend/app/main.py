@@ -2,11 +2,15 @@ import time
 from fastapi import FastAPI, APIRouter, Request, status
 from fastapi.routing import APIRoute
 from fastapi.exceptions import RequestValidationError
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
 from starlette.middleware.authentication import AuthenticationMiddleware
 from starlette.middleware.sessions import SessionMiddleware
 from fastapi.middleware.cors import CORSMiddleware
 from app.settings import get_settings
+from app.database import engine
+import app.metrics as metrics
+import app.query_profiler as query_profiler
+import app.tracing as tracing
 import config
 
 # TODO: consider using this https://github.com/tiangolo/full-stack-fastapi-template/blob/a230f4fb2ca0e341e74727bae695687f1ea124b0/backend/app/main.py
@@ -34,6 +38,17 @@ app = FastAPI(
     # generate_unique_id_function=custom_generate_unique_id,
 )
 app.include_router(api_router, prefix=settings.api_v1_str)
+metrics.instrument_engine(engine)
+
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics() -> Response:
+    """
+    Prometheus metrics (see metrics.py).
+    Only reachable internally as nginx just proxies paths under /api/.
+    """
+    return Response(content=metrics.generate(), media_type=metrics.CONTENT_TYPE)
+
 
 ### middlewares (the furtherest below is applied first)
 """
@@ -54,11 +69,37 @@ async def validation_exception_handler(request: Request, exc: RequestValidationE
 async def add_process_time_header(request: Request, call_next):
     """
     Handy middleware for tracking how long it takes to process every request.
+    Also records request latency and DB query metrics (see metrics.py and query_profiler.py)
+    and starts the request's trace span (see tracing.py).
     https://fastapi.tiangolo.com/tutorial/middleware/
     """
-    start_time = time.time()
-    response = await call_next(request)
-    process_time = time.time() - start_time
+    start_time = time.perf_counter()
+    status_code = 500
+    label = f"{request.method} {request.url.path}"
+    with (
+        tracing.start_span(
+            label, traceparent=request.headers.get("traceparent"), kind="SERVER"
+        ) as span,
+        query_profiler.profile_request(label) as profile,
+    ):
+        try:
+            response = await call_next(request)
+            status_code = response.status_code
+        finally:
+            process_time = time.perf_counter() - start_time
+            metrics.observe_request(request, status_code, process_time, profile)
+            route = getattr(request.scope.get("route"), "path", None)
+            if route:
+                span.name = f"{request.method} {route}"
+            span.attributes.update(
+                {
+                    "http.request.method": request.method,
+                    "http.route": route or "unmatched",
+                    "http.response.status_code": status_code,
+                    "db.queries": profile.queries,
+                    "db.secs": profile.secs,
+                }
+            )
     response.headers["x-process-time-secs"] = str(process_time)
     return response
 
@@ -0,0 +1,163 @@
+"""
+Prometheus metrics for the API and job runner.
+
+The API exposes these at the (internal) /metrics endpoint (see main.py), which nginx doesn't proxy.
+When running under gunicorn with multiple workers, PROMETHEUS_MULTIPROC_DIR must be set (before
+import) so metrics are aggregated across worker processes (see launch_prod.sh and gunicorn.conf.py).
+https://prometheus.github.io/client_python/multiprocess/
+"""
+
+import os
+from typing import Any, TYPE_CHECKING
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from prometheus_client.core import GaugeMetricFamily
+from sqlalchemy import event, func
+from sqlalchemy.engine import Engine
+from app.query_profiler import QueryProfile
+import app.query_profiler as query_profiler
+import config
+
+if TYPE_CHECKING:
+    from fastapi import Request
+
+logger = config.get_logger(__name__)
+
+CONTENT_TYPE = CONTENT_TYPE_LATEST
+
+# MARK: API requests
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds",
+    "Latency of API requests.",
+    ["method", "route", "status"],
+)
+REQUEST_DB_QUERIES = Histogram(
+    "http_request_db_queries",
+    "Number of DB queries executed per API request.",
+    ["method", "route"],
+    buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200),
+)
+REQUEST_DB_SECONDS = Histogram(
+    "http_request_db_seconds",
+    "Total time spent executing DB queries per API request.",
+    ["method", "route"],
+)
+
+# MARK: DB connection pool
+DB_POOL_SIZE = Gauge(
+    "db_pool_size", "Configured DB connection pool size.", multiprocess_mode="livesum"
+)
+DB_POOL_CHECKED_OUT = Gauge(
+    "db_pool_checked_out",
+    "DB connections currently checked out from the pool.",
+    multiprocess_mode="livesum",
+)
+
+# MARK: jobs
+JOB_DURATION = Histogram(
+    "job_run_duration_seconds",
+    "Time taken to run a job.",
+    ["job_type", "status"],
+    buckets=(0.1, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300),
+)
+
+# MARK: GPT
+GPT_REQUESTS = Counter("gpt_requests", "Number of GPT API requests.", ["model"])
+GPT_TOKENS = Counter(
+    "gpt_tokens", "Number of GPT tokens used.", ["model", "kind"]
+)  # kind is "prompt" or "completion"
+GPT_COST = Counter(
+    "gpt_cost_usd", "GPT cost in USD (see GPTModel.compute_price).", ["model"]
+)
+GPT_LATENCY = Histogram(
+    "gpt_request_duration_seconds",
+    "Latency of a GPT API call.",
+    ["model"],
+    buckets=(0.5, 1, 2.5, 5, 10, 20, 30, 60, 120),
+)
+
+
+def instrument_engine(engine: Engine):
+    """Attach event listeners to track DB query and connection pool metrics."""
+    # per-request query counts/time are tracked by query_profiler
+    query_profiler.instrument_engine(engine)
+
+    @event.listens_for(engine, "checkout")
+    def _checkout(dbapi_conn, conn_record, conn_proxy):
+        DB_POOL_CHECKED_OUT.inc()
+
+    @event.listens_for(engine, "checkin")
+    def _checkin(dbapi_conn, conn_record):
+        DB_POOL_CHECKED_OUT.dec()
+
+    pool_size = getattr(engine.pool, "size", None)
+    if callable(pool_size):
+        DB_POOL_SIZE.set(pool_size())
+
+
+def observe_request(
+    request: "Request", status: int, secs: float, profile: QueryProfile
+):
+    # label by route template (e.g. "/api/v1/attempt/{attempt_id}") to keep cardinality bounded
+    route = request.scope.get("route")
+    route_path = getattr(route, "path", "unmatched")
+    REQUEST_LATENCY.labels(request.method, route_path, status).observe(secs)
+    REQUEST_DB_QUERIES.labels(request.method, route_path).observe(profile.queries)
+    REQUEST_DB_SECONDS.labels(request.method, route_path).observe(profile.secs)
+
+
+def observe_gpt_call(model_name: str, completions: list[Any], cost: float, secs: float):
+    GPT_REQUESTS.labels(model_name).inc(len(completions))
+    GPT_COST.labels(model_name).inc(cost)
+    GPT_LATENCY.labels(model_name).observe(secs)
+    for c in completions:
+        GPT_TOKENS.labels(model_name, "prompt").inc(c.usage.prompt_tokens)
+        GPT_TOKENS.labels(model_name, "completion").inc(c.usage.completion_tokens)
+
+
+class JobQueueCollector:
+    """Reports the number of jobs by status (queried from the DB upon each scrape)."""
+
+    def collect(self):
+        # imported here to avoid a circular import (database imports app.models)
+        from app.database import SessionFactory
+        from app.models.job import Job, JobStatus
+
+        depth = GaugeMetricFamily(
+            "job_queue_depth", "Number of jobs by status.", labels=["status"]
+        )
+        with SessionFactory() as session:
+            counts = dict(
+                session.query(Job.status, func.count(Job.id)).group_by(Job.status).all()
+            )
+        for status in JobStatus:
+            depth.add_metric([status.value], counts.get(status, 0))
+        yield depth
+
+
+_queue_registry = CollectorRegistry()
+_queue_registry.register(JobQueueCollector())  # type: ignore [arg-type]
+
+
+def generate() -> bytes:
+    """Render all metrics in the Prometheus text format."""
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+
+    output = generate_latest(registry)
+    try:
+        output += generate_latest(_queue_registry)
+    except Exception as e:
+        logger.error(f"failed to collect job queue metrics: {e}")
+    return output
@@ -7,10 +7,13 @@ from sqlalchemy import JSON, Integer, Enum
 from typing import Optional, Any, Callable
 from pydantic import BaseModel, ValidationError
 import enum
+import time
 from uuid import UUID
 import json
 from app.hardcoded import SMARTData, FeedbackData
 import app.feedback_utils as feedback_utils
+import app.metrics as metrics
+import app.tracing as tracing
 
 logger = config.get_logger(__name__)
 settings = get_settings()
@@ -18,6 +21,7 @@ settings = get_settings()
 
 class JobType(enum.Enum):
     AI_FEEDBACK = "AI_FEEDBACK"
+    FEEDBACK_EMAIL = "FEEDBACK_EMAIL"
 
 
 class JobStatus(enum.Enum):
@@ -53,17 +57,42 @@ class Job(Base):
         if self.job_type not in JOB_RUN_MAP:
             raise NotImplementedError(f"Job type '{self.job_type}' not implemented")
 
-        JOB_RUN_MAP[self.job_type](self, session)
+        traceparent = self.data.get("traceparent")
+        attributes = {"job.id": str(self.id), "job.type": self.job_type.value}
+        with tracing.start_span(
+            f"job {self.job_type.value}",
+            attributes,
+            traceparent=traceparent,
+            kind="CONSUMER",
+        ) as span:
+            tracing.record_span(
+                "job queue wait",
+                start_ns=int(self.created_at.timestamp() * 1e9),
+                end_ns=span.start_ns,
+                attributes=attributes,
+            )
+            JOB_RUN_MAP[self.job_type](self, session)
+            span.set_attribute("job.status", self.status.value)
 
 
-class AI_FEEDBACK_JOB_DATA(BaseModel):
-    attempt_id: UUID
+class _JobData(BaseModel):
+    # trace context of the request which enqueued this job (see app/tracing.py)
+    traceparent: Optional[str] = None
 
     def custom_dump_dict(self):
         # hack to avoid sqlalchemy.exc.StatementError: (builtins.TypeError) Object of type UUID is not JSON serializable
         return json.loads(json.dumps(self.model_dump(), default=str))
 
 
+class AI_FEEDBACK_JOB_DATA(_JobData):
+    attempt_id: UUID
+
+
+class FEEDBACK_EMAIL_JOB_DATA(_JobData):
+    feedback_id: UUID
+    student_id: UUID  # recipient of the email (used to coalesce notifications)
+
+
 def _run_ai_feedback(job: Job, session: Session):
     """
     Generates AI feedback for a particular attempt, attaching a Feedback object.
@@ -102,28 +131,47 @@ def _run_ai_feedback(job: Job, session: Session):
     job.status = JobStatus.IN_PROGRESS
     session.commit()
 
-    few_shot_prompt = (
-        "examples of good feedback follow:\n"
-        + feedback_utils.build_few_shot_instructions()
-    )
-    prompt = feedback_utils.prompts.PROMPT_SMART_FEEDBACK_TEXT_ONLY.format(
-        FEEDBACK_PRINCIPLES=feedback_utils.prompts.FEEDBACK_PRINCIPLES,
-        SMART_RUBRIC=feedback_utils.prompts.SMART_RUBRIC,
-        learning_goal=smart_data.goal,
-        action_plan=smart_data.plan,
-        few_shot_prompt=few_shot_prompt,
-        language="Dutch",
-    )
+    with tracing.start_span("build prompt"):
+        few_shot_prompt = (
+            "examples of good feedback follow:\n"
+            + feedback_utils.build_few_shot_instructions()
+        )
+        prompt = feedback_utils.prompts.PROMPT_SMART_FEEDBACK_TEXT_ONLY.format(
+            FEEDBACK_PRINCIPLES=feedback_utils.prompts.FEEDBACK_PRINCIPLES,
+            SMART_RUBRIC=feedback_utils.prompts.SMART_RUBRIC,
+            learning_goal=smart_data.goal,
+            action_plan=smart_data.plan,
+            few_shot_prompt=few_shot_prompt,
+            language="Dutch",
+        )
 
-    gpt = feedback_utils.GPTModel(
-        api_key=settings.openai_api_key, model_name=settings.gpt_model
+    gpt = feedback_utils.get_model(
+        settings.gpt_model,
+        api_key=settings.openai_api_key,
+        local_url=settings.local_model_url,
+        local_price_per_1m_tokens=settings.local_model_price,
     )
-    outputs, meta = gpt(
-        [prompt],
-        max_tokens=settings.gpt_max_tokens,
-        temperature=settings.gpt_temperature,
-    )
-    cost = gpt.compute_price(meta)
+    with tracing.start_span(
+        "gpt call", {"gen_ai.request.model": gpt.model_name}, kind="CLIENT"
+    ) as span:
+        start_time = time.perf_counter()
+        outputs, meta = gpt(
+            [prompt],
+            max_tokens=settings.gpt_max_tokens,
+            temperature=settings.gpt_temperature,
+        )
+        gpt_secs = time.perf_counter() - start_time
+        cost = gpt.compute_price(meta)
+        span.attributes.update(
+            {
+                "gen_ai.usage.input_tokens": sum(c.usage.prompt_tokens for c in meta),
+                "gen_ai.usage.output_tokens": sum(
+                    c.usage.completion_tokens for c in meta
+                ),
+                "gpt.cost_usd": cost,
+            }
+        )
+    metrics.observe_gpt_call(gpt.model_name, meta, cost, gpt_secs)
     logger.info(
         f"generated feedback for attempt {attempt.id}, cost=${cost:.5f}, {gpt.model_name=}"
     )
@@ -146,12 +194,80 @@ def _run_ai_feedback(job: Job, session: Session):
 
     # TODO: for now noop function and marking job completed
     job.status = JobStatus.COMPLETED
-    session.commit()
+    with tracing.start_span("db commit"):
+        session.commit()
     logger.info(
         f"created feedback {ai_feedback.id} (length {len(feedback_data.feedback)})"
     )
 
 
+def _run_feedback_email(job: Job, session: Session):
+    """
+    Sends a single digest email to a student for all their pending feedback notifications
+    (marking the other coalesced FEEDBACK_EMAIL jobs as completed as well).
+    """
+    # imported here to avoid a circular import (notifications imports app.models)
+    import app.notifications as notifications
+
+    try:
+        job_data = FEEDBACK_EMAIL_JOB_DATA(**job.data)
+    except ValidationError as e:
+        logger.error(f"Failed to parse data for {job}: {e}")
+        job.status = JobStatus.FAILED
+        job.error = "failed to parse data for job"
+        session.commit()
+        return
+
+    others = (
+        session.query(Job)
+        .filter(
+            Job.job_type == JobType.FEEDBACK_EMAIL,
+            Job.status == JobStatus.PENDING,
+            Job.data["student_id"].as_string() == str(job_data.student_id),
+        )
+        .order_by(Job.created_at.asc())
+        .all()
+    )
+    jobs = [job] + [other for other in others if other.id != job.id]
+    for other in jobs[1:]:
+        other.status = JobStatus.IN_PROGRESS
+    session.commit()
+
+    feedbacks = []
+    for cur in jobs:
+        feedback_id = FEEDBACK_EMAIL_JOB_DATA(**cur.data).feedback_id
+        feedback = session.get(Feedback, feedback_id)
+        if feedback is None:
+            logger.error(f"Feedback {feedback_id} not found but referenced in {cur}")
+            cur.status = JobStatus.FAILED
+            cur.error = "feedback not found"
+            continue
+        feedbacks.append(feedback)
+    session.commit()
+
+    pending = [cur for cur in jobs if cur.status == JobStatus.IN_PROGRESS]
+    if len(pending) == 0:
+        return
+
+    try:
+        sent = notifications.send_feedback_digest(feedbacks)
+        error = None if sent else "failed to build feedback email"
+    # out of precaution catch all exceptions (email sending is less critical)
+    except Exception as e:
+        logger.error(f"Failed to send feedback digest to {job_data.student_id}: {e}")
+        sent, error = False, "failed to send feedback email"
+
+    for cur in pending:
+        cur.status = JobStatus.COMPLETED if sent else JobStatus.FAILED
+        cur.error = error
+    session.commit()
+    if sent:
+        logger.info(
+            f"sent digest of {len(feedbacks)} feedbacks to student {job_data.student_id}"
+        )
+
+
 JOB_RUN_MAP: dict[JobType, Callable[[Job, Session], None]] = {
     JobType.AI_FEEDBACK: _run_ai_feedback,
+    JobType.FEEDBACK_EMAIL: _run_feedback_email,
 }
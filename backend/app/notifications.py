@@ -1,8 +1,6 @@
 """Code for sending emails using AWS SES."""
 
 import json
-import boto3
-from botocore.exceptions import ClientError
 from app.settings import get_settings
 import config
 from pydantic import BaseModel
@@ -28,19 +26,50 @@ def send_feedback_email(feedback: models.Feedback) -> bool:
     Only call this function for human feedback!
     NOTE: pure jinja email templates rather than the SES specific templates seem more flexible/testable.
     """
-    if feedback.is_ai or feedback.user is None:
-        logger.error(f"send_feedback_email called for AI feedback: {feedback.id}")
-        return False
-    ses_client = boto3.client("sesv2", region_name=settings.aws_default_region)
+    return send_feedback_digest([feedback])
 
-    attempt = feedback.attempt
-    assignment = attempt.assignment
 
-    try:
-        fdata = FeedbackData(**feedback.data)
-    except ValidationError:
-        logger.error(f"Feedback data provided in incorrect format: {feedback.id}")
+def send_feedback_digest(feedbacks: list[models.Feedback]) -> bool:
+    """
+    Notify a student that one or more (human) feedbacks are available, using a single email.
+    All feedbacks must be on attempts submitted by the same student.
+    """
+    if len(feedbacks) == 0:
         return False
+    for feedback in feedbacks:
+        if feedback.is_ai or feedback.user is None:
+            logger.error(f"send_feedback_email called for AI feedback: {feedback.id}")
+            return False
+
+    student = feedbacks[0].attempt.user
+    if any(feedback.attempt.user_id != student.id for feedback in feedbacks):
+        logger.error("feedback digest must only contain feedback for a single student")
+        return False
+
+    messages = []
+    all_approved = True
+    for feedback in feedbacks:
+        try:
+            fdata = FeedbackData(**feedback.data)
+        except ValidationError:
+            logger.error(f"Feedback data provided in incorrect format: {feedback.id}")
+            return False
+        messages.append(_build_feedback_message(feedback, fdata))
+        all_approved = all_approved and fdata.approved
+
+    assignments = {f.attempt.assignment.id: f.attempt.assignment for f in feedbacks}
+    if len(assignments) == 1:
+        assignment = feedbacks[0].attempt.assignment
+        assignment_name, assignment_url = assignment.name, assignment.page_url()
+    else:
+        assignment_name = ", ".join(a.name for a in assignments.values())
+        assignment_url = settings.site_url
+
+    subject = (
+        f"Feedback available on {assignment_name}"
+        if len(feedbacks) == 1
+        else f"Feedback available on {len(feedbacks)} submissions"
+    )
 
     # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sesv2/client/send_email.html
     # TODO: possibly include email of teacher that gave feedback
@@ -50,9 +79,48 @@ def send_feedback_email(feedback: models.Feedback) -> bool:
         else [settings.email_from or ""]
     )
 
-    reviewer_name = feedback.user.name
-    APPROVED_MESSAGE = f"Your submission was approved by {reviewer_name}, no further action is currently necessary. Make sure to implement any feedback in your next reflection assignment!"
-    RESUBMIT_MESSAGE = f"{reviewer_name} has requested you resubmit this assignment. Follow the instructions mentioned in the feedback."
+    template_data = {
+        "subject": f"{subject}{' -- Action Required' if not all_approved else ''}",
+        "message": "\n<br /><hr /><br />\n".join(messages),
+        "assignment_name": assignment_name,
+        "assignment_url": assignment_url,
+        "site_url": settings.site_url,
+        "support_email": settings.support_email,
+    }
+
+    logger.info(
+        f"Sending feedback email to {student.email} ({len(feedbacks)} feedbacks)"
+    )
+    from_name = (
+        "EzFeedback" if settings.is_production else f"EzFeedback ({settings.env})"
+    )
+    # boto3 is slow to import so it's only loaded when an email is actually sent
+    import boto3
+
+    ses_client = boto3.client("sesv2", region_name=settings.aws_default_region)
+    # TODO: try catch!
+    ses_client.send_email(
+        FromEmailAddress=f"{from_name} <{settings.email_from}>",
+        Destination={"ToAddresses": [student.email]},
+        ReplyToAddresses=reply_to_emails,
+        Content={
+            "Template": {
+                "TemplateName": FEEDBACK_SES_TEMPLATE,
+                "TemplateData": json.dumps(template_data),
+            }
+        },
+        ConfigurationSetName=SES_CONFIG_SET,
+    )
+    logger.info(f"Email sent to {student.email}")
+    return True
+
+
+def _build_feedback_message(feedback: models.Feedback, fdata: FeedbackData) -> str:
+    """Build the (html) message describing a single feedback."""
+    assignment = feedback.attempt.assignment
+    reviewer_name = feedback.user.name if feedback.user else "your teacher"
+    APPROVED_MESSAGE = f"Your submission to {assignment.name} was approved by {reviewer_name}, no further action is currently necessary. Make sure to implement any feedback in your next reflection assignment!"
+    RESUBMIT_MESSAGE = f"{reviewer_name} has requested you resubmit {assignment.name}. Follow the instructions mentioned in the feedback."
 
     approval_msg = APPROVED_MESSAGE if fdata.approved else RESUBMIT_MESSAGE
 
@@ -79,32 +147,4 @@ def send_feedback_email(feedback: models.Feedback) -> bool:
 
 {call_to_action}
     """.strip()
-
-    template_data = {
-        "subject": f"Feedback available on {assignment.name}{' -- Action Required' if not fdata.approved else ''}",
-        "message": message,
-        "assignment_name": assignment.name,
-        "assignment_url": assignment.page_url(),
-        "site_url": settings.site_url,
-        "support_email": settings.support_email,
-    }
-
-    logger.info(f"Sending feedback email to {attempt.user.email}")
-    from_name = (
-        "EzFeedback" if settings.is_production else f"EzFeedback ({settings.env})"
-    )
-    # TODO: try catch!
-    ses_client.send_email(
-        FromEmailAddress=f"{from_name} <{settings.email_from}>",
-        Destination={"ToAddresses": [attempt.user.email]},
-        ReplyToAddresses=reply_to_emails,
-        Content={
-            "Template": {
-                "TemplateName": FEEDBACK_SES_TEMPLATE,
-                "TemplateData": json.dumps(template_data),
-            }
-        },
-        ConfigurationSetName=SES_CONFIG_SET,
-    )
-    logger.info(f"Email sent to {attempt.user.email}")
-    return True
+    return message
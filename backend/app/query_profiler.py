@@ -0,0 +1,165 @@
+"""
+Per-request SQL query profiling (built on SQLAlchemy cursor events).
+
+Every API request counts its DB queries and DB time (reported via metrics.py).
+When settings.query_profiler_enabled is set (or a test uses the `query_budget` fixture),
+statements are also fingerprinted so repeated statements (a.k.a. N+1 patterns) can be
+detected, and requests exceeding the configured thresholds are logged.
+"""
+
+import re
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Iterator, Optional
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from app.settings import get_settings
+import config
+
+logger = config.get_logger(__name__)
+settings = get_settings()
+
+# string/number literals and bind parameters (e.g. "%(user_id_1)s") are stripped from fingerprints
+_LITERAL_EXP = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_PARAM_EXP = re.compile(r"%\(\w+\)s|%s|\$\d+")
+_IN_LIST_EXP = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_WHITESPACE_EXP = re.compile(r"\s+")
+
+
+def fingerprint(statement: str) -> str:
+    """Normalize a SQL statement so repeated executions with different parameters compare equal."""
+    statement = _LITERAL_EXP.sub("?", statement)
+    statement = _PARAM_EXP.sub("?", statement)
+    statement = _IN_LIST_EXP.sub("(?)", statement)
+    return _WHITESPACE_EXP.sub(" ", statement).strip()
+
+
+@dataclass
+class QueryProfile:
+    """DB queries executed within a profiled context (e.g. a single request)."""
+
+    queries: int = 0
+    secs: float = 0.0
+    # whether statements are fingerprinted (slightly more expensive)
+    detailed: bool = False
+    fingerprints: Counter = field(default_factory=Counter)
+
+    def duplicates(self, min_count: int = 2) -> list[tuple[str, int]]:
+        """Statement fingerprints executed at least min_count times (most frequent first)."""
+        return [(fp, n) for fp, n in self.fingerprints.most_common() if n >= min_count]
+
+    @property
+    def max_duplicates(self) -> int:
+        """Number of executions of the most repeated statement."""
+        return max(self.fingerprints.values(), default=0)
+
+    def describe(self, top: int = 3) -> str:
+        desc = f"{self.queries} queries in {self.secs * 1000:.1f} ms"
+        for fp, n in self.duplicates()[:top]:
+            desc += f"\n  {n}x {fp[:300]}"
+        return desc
+
+
+@dataclass
+class QueryBudget:
+    """Limits on the DB queries a single request may execute (defaults from settings)."""
+
+    max_queries: int = field(
+        default_factory=lambda: settings.query_profiler_max_queries
+    )
+    max_duplicates: int = field(
+        default_factory=lambda: settings.query_profiler_max_duplicates
+    )
+    max_db_secs: Optional[float] = field(
+        default_factory=lambda: settings.query_profiler_max_db_secs
+    )
+
+    def exceeded_by(self, profile: QueryProfile) -> list[str]:
+        """Returns descriptions of the limits exceeded by the given profile (if any)."""
+        exceeded = []
+        if profile.queries > self.max_queries:
+            exceeded.append(f"{profile.queries} queries > {self.max_queries}")
+        if profile.max_duplicates > self.max_duplicates:
+            exceeded.append(
+                f"statement repeated {profile.max_duplicates} times > {self.max_duplicates} (possible N+1)"
+            )
+        if self.max_db_secs is not None and profile.secs > self.max_db_secs:
+            exceeded.append(f"{profile.secs:.3f} DB secs > {self.max_db_secs}")
+        return exceeded
+
+
+_profile: ContextVar[Optional[QueryProfile]] = ContextVar("query_profile", default=None)
+# lists collecting (label, profile) of finished requests (see record_requests())
+_recorders: list[list[tuple[str, QueryProfile]]] = []
+
+
+@contextmanager
+def profile_queries(detailed: bool = False) -> Iterator[QueryProfile]:
+    """Profile the DB queries executed within this context (requires instrument_engine())."""
+    profile = QueryProfile(detailed=detailed)
+    token = _profile.set(profile)
+    try:
+        yield profile
+    finally:
+        _profile.reset(token)
+
+
+@contextmanager
+def profile_request(label: str) -> Iterator[QueryProfile]:
+    """Profile a single API request, logging it if it exceeds the configured thresholds."""
+    detailed = settings.query_profiler_enabled or len(_recorders) > 0
+    with profile_queries(detailed=detailed) as profile:
+        try:
+            yield profile
+        finally:
+            # (also requests that failed, slow ones are the most worth reporting)
+            if detailed:
+                _report_request(label, profile)
+
+
+def _report_request(label: str, profile: QueryProfile):
+    for recorder in _recorders:
+        recorder.append((label, profile))
+    if settings.query_profiler_enabled:
+        exceeded = QueryBudget().exceeded_by(profile)
+        if exceeded:
+            logger.warning(
+                f"query thresholds exceeded by '{label}' ({'; '.join(exceeded)}): {profile.describe()}"
+            )
+
+
+@contextmanager
+def record_requests() -> Iterator[list[tuple[str, QueryProfile]]]:
+    """Collect the (label, profile) of every request profiled within this context."""
+    recorded: list[tuple[str, QueryProfile]] = []
+    _recorders.append(recorded)
+    try:
+        yield recorded
+    finally:
+        _recorders.remove(recorded)
+
+
+def _before_cursor_execute(conn, cursor, statement, params, context, executemany):
+    conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, params, context, executemany):
+    start_time = conn.info["query_start_time"].pop()
+    profile = _profile.get()
+    if profile is None:
+        return
+    profile.queries += 1
+    profile.secs += time.perf_counter() - start_time
+    if profile.detailed:
+        profile.fingerprints[fingerprint(statement)] += 1
+
+
+def instrument_engine(engine: Engine):
+    """Attach the event listeners needed for profiling (safe to call more than once)."""
+    if event.contains(engine, "before_cursor_execute", _before_cursor_execute):
+        return
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
@@ -17,12 +17,18 @@ from app.models.course import (
     FeedbackPublic,
     Feedback,
 )
-import app.notifications as notifications
-from app.models.job import Job, AI_FEEDBACK_JOB_DATA, JobStatus, JobType
+from app.models.job import (
+    Job,
+    AI_FEEDBACK_JOB_DATA,
+    FEEDBACK_EMAIL_JOB_DATA,
+    JobStatus,
+    JobType,
+)
 from app.routes.courses import get_assignment_or_fail
 from app.routes.files import get_files_or_fail
 from app.hardcoded import SMARTData, FeedbackData
 from app.settings import get_settings
+import app.tracing as tracing
 from uuid import UUID
 from pydantic import ValidationError
 from typing import Optional
@@ -134,25 +140,35 @@ async def create_feedback(
     session.add(feedback)
     session.flush()  # to get ID
     session.add(AttemptFeedbackLink(attempt_id=attempt.id, feedback_id=feedback.id))
-    session.commit()
 
-    # send email to user if configured
-    if not settings.notifications_enabled:
+    # queue email to user if configured (jobRunner.py coalesces these into digest emails)
+    if settings.notifications_enabled:
+        session.add(build_feedback_email_job(feedback.id, attempt.user_id))
+    else:
         logger.info("skipping email send (email notifications disabled)")
-        return feedback.to_public()
-
-    try:
-        notifications.send_feedback_email(feedback)
-    # out of precaution catch all exceptions (email sending is less critical)
-    except Exception as e:
-        logger.error(f"Failed to send feedback {feedback.id} email: {e}")
+    session.commit()
     return feedback.to_public()
 
 
 def build_feedback_job_for_attempt(attempt_id: UUID):
-    job_data = AI_FEEDBACK_JOB_DATA(attempt_id=attempt_id)
+    job_data = AI_FEEDBACK_JOB_DATA(
+        attempt_id=attempt_id, traceparent=tracing.current_traceparent()
+    )
     job = Job(
         job_type=JobType.AI_FEEDBACK,
         data=job_data.custom_dump_dict(),
     )
     return job
+
+
+def build_feedback_email_job(feedback_id: UUID, student_id: UUID):
+    job_data = FEEDBACK_EMAIL_JOB_DATA(
+        feedback_id=feedback_id,
+        student_id=student_id,
+        traceparent=tracing.current_traceparent(),
+    )
+    job = Job(
+        job_type=JobType.FEEDBACK_EMAIL,
+        data=job_data.custom_dump_dict(),
+    )
+    return job
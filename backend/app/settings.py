@@ -4,14 +4,16 @@ All application settings are defined here.
 
 Usage:
 
-from app.settings import settings
+from app.settings import get_settings
+settings = get_settings()
 
-Settings are loaded from environment variables upon import! So any
-changes in environment variables should be done before import (e.g.
-load_dotenv).
+Settings are loaded from environment variables upon the first call to
+get_settings() (and then cached)! So any changes in environment variables
+should be done before import (e.g. load_dotenv).
 """
 
 import os
+from functools import lru_cache
 from pathlib import Path
 from typing import Literal, Optional
 
@@ -67,6 +69,23 @@ class Settings(BaseSettings):
     db_port: int = 5432
     auto_migrate: bool = True  # auto migrate database on startup
 
+    # port for jobRunner.py to serve prometheus metrics on (omit to disable)
+    job_metrics_port: Optional[int] = 9101
+
+    # log API requests exceeding these query thresholds (see app/query_profiler.py)
+    query_profiler_enabled: bool = False
+    query_profiler_max_queries: int = 25
+    query_profiler_max_duplicates: int = 5  # executions of the same statement (N+1)
+    query_profiler_max_db_secs: Optional[float] = 0.5
+
+    # tracing (see app/tracing.py), spans are exported to a JSON lines file and/or OTLP/HTTP collector
+    trace_file: Optional[Path] = None
+    trace_otlp_endpoint: Optional[str] = None  # e.g. "http://localhost:4318/v1/traces"
+
+    @property
+    def tracing_enabled(self) -> bool:
+        return bool(self.trace_file or self.trace_otlp_endpoint)
+
     # auth0
     auth0_domain: str
     auth0_client_id: str
@@ -76,10 +95,14 @@ class Settings(BaseSettings):
 
     # OpenAI
     openai_api_key: str
-    gpt_model: str
+    gpt_model: str  # prefix with "local/" to use local_model_url instead
     gpt_temperature: float = 0.5
     gpt_max_tokens: int = 1000
 
+    # self-hosted model server (OpenAI compatible, see experiments/tuner/recipes/serve.py)
+    local_model_url: str = "http://localhost:8800/v1"
+    local_model_price: float = 0.0  # USD per 1M tokens (e.g. amortized GPU cost)
+
     # AWS
     aws_default_region: str
 
@@ -87,6 +110,8 @@ class Settings(BaseSettings):
     #   omit to disable sending emails
     email_from: Optional[str] = None
     support_email: str  # for students with technical issues
+    # feedback notifications for a student are collected for this long before being sent as one digest email
+    email_digest_secs: int = 60 * 5
 
     @property
     def notifications_enabled(self) -> bool:
@@ -108,5 +133,7 @@ class Settings(BaseSettings):
         return f"{base_uri}/{self.db_name}" if include_db_name else base_uri
 
 
+@lru_cache(maxsize=1)
 def get_settings() -> Settings:
+    """Returns the (single) Settings instance shared by all modules."""
     return Settings()  # type: ignore [call-arg]
@@ -0,0 +1,278 @@
+"""
+Lightweight (OpenTelemetry compatible) tracing of API requests, jobs and GPT calls.
+
+Trace context is propagated with W3C `traceparent` strings: from incoming API requests (header),
+into Job.data at enqueue time, and from there to the spans of the job runner.
+Finished spans are exported in the background as OTLP/JSON, to a JSON lines file (settings.trace_file)
+and/or to a local OpenTelemetry collector (settings.trace_otlp_endpoint).
+https://opentelemetry.io/docs/specs/otlp/#otlphttp
+"""
+
+import atexit
+import json
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, Iterator, Optional
+from app.settings import get_settings
+import config
+
+logger = config.get_logger(__name__)
+settings = get_settings()
+
+_service_name = "backend-api"
+
+# https://opentelemetry.io/docs/specs/otlp/#json-protobuf-encoding
+_STATUS_CODES = {"UNSET": 0, "OK": 1, "ERROR": 2}
+_SPAN_KINDS = {"INTERNAL": 1, "SERVER": 2, "CLIENT": 3, "PRODUCER": 4, "CONSUMER": 5}
+
+
+@dataclass
+class Span:
+    name: str
+    trace_id: str  # 32 hex chars
+    span_id: str  # 16 hex chars
+    parent_id: Optional[str] = None
+    kind: str = "INTERNAL"
+    start_ns: int = field(default_factory=time.time_ns)
+    end_ns: Optional[int] = None
+    attributes: dict[str, Any] = field(default_factory=dict)
+    status: str = "UNSET"
+    status_message: Optional[str] = None
+
+    @property
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    @property
+    def duration_secs(self) -> float:
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e9
+
+    def set_attribute(self, key: str, value: Any):
+        self.attributes[key] = value
+
+    def set_error(self, message: str):
+        self.status, self.status_message = "ERROR", message
+
+    def to_otlp(self) -> dict:
+        res: dict[str, Any] = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": _SPAN_KINDS[self.kind],
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": _otlp_attributes(self.attributes),
+            "status": {"code": _STATUS_CODES[self.status]},
+        }
+        if self.parent_id:
+            res["parentSpanId"] = self.parent_id
+        if self.status_message:
+            res["status"]["message"] = self.status_message
+        return res
+
+
+_current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+
+def set_service_name(name: str):
+    """Set the service.name reported for spans of this process (e.g. "job-runner")."""
+    global _service_name
+    _service_name = name
+
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+def current_traceparent() -> Optional[str]:
+    """Returns the traceparent of the current span (for propagating e.g. into Job.data)."""
+    span = _current_span.get()
+    return span.traceparent if span and settings.tracing_enabled else None
+
+
+def parse_traceparent(traceparent: Optional[str]) -> Optional[tuple[str, str]]:
+    """Returns (trace_id, parent_span_id) from a W3C traceparent string (if valid)."""
+    # https://www.w3.org/TR/trace-context/#traceparent-header
+    parts = (traceparent or "").strip().split("-")
+    if len(parts) < 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        int(parts[1], 16), int(parts[2], 16)
+    except ValueError:
+        return None
+    return parts[1], parts[2]
+
+
+@contextmanager
+def start_span(
+    name: str,
+    attributes: Optional[dict[str, Any]] = None,
+    traceparent: Optional[str] = None,
+    kind: str = "INTERNAL",
+) -> Iterator[Span]:
+    """
+    Start a span as a child of the current span (or of traceparent if provided).
+    The span ends (and is exported) upon exiting the context, recording any exception raised.
+    """
+    span = _new_span(name, traceparent, kind)
+    span.attributes.update(attributes or {})
+    token = _current_span.set(span)
+    try:
+        yield span
+    except BaseException as e:
+        span.set_error(f"{type(e).__name__}: {e}")
+        raise
+    finally:
+        _current_span.reset(token)
+        span.end_ns = time.time_ns()
+        _export(span)
+
+
+def record_span(
+    name: str,
+    start_ns: int,
+    end_ns: int,
+    attributes: Optional[dict[str, Any]] = None,
+    traceparent: Optional[str] = None,
+) -> Span:
+    """Record an already finished span (e.g. time a job spent waiting in the queue)."""
+    span = _new_span(name, traceparent, "INTERNAL")
+    span.start_ns, span.end_ns = start_ns, end_ns
+    span.attributes.update(attributes or {})
+    _export(span)
+    return span
+
+
+def _new_span(name: str, traceparent: Optional[str], kind: str) -> Span:
+    parent = _current_span.get()
+    ids = parse_traceparent(traceparent)
+    if ids is not None:
+        trace_id, parent_id = ids
+    elif parent is not None:
+        trace_id, parent_id = parent.trace_id, parent.span_id
+    else:
+        trace_id, parent_id = os.urandom(16).hex(), None
+    return Span(
+        name=name,
+        trace_id=trace_id,
+        span_id=os.urandom(8).hex(),
+        parent_id=parent_id,
+        kind=kind,
+    )
+
+
+def _otlp_attributes(attributes: dict[str, Any]) -> list[dict]:
+    res = []
+    for key, val in attributes.items():
+        if isinstance(val, bool):
+            value: dict[str, Any] = {"boolValue": val}
+        elif isinstance(val, int):
+            value = {"intValue": str(val)}
+        elif isinstance(val, float):
+            value = {"doubleValue": val}
+        else:
+            value = {"stringValue": str(val)}
+        res.append({"key": key, "value": value})
+    return res
+
+
+def _otlp_payload(spans: list[Span]) -> dict:
+    resource = {"attributes": _otlp_attributes({"service.name": _service_name})}
+    return {
+        "resourceSpans": [
+            {
+                "resource": resource,
+                "scopeSpans": [
+                    {
+                        "scope": {"name": __name__},
+                        "spans": [span.to_otlp() for span in spans],
+                    }
+                ],
+            }
+        ]
+    }
+
+
+class _BatchExporter:
+    """Exports finished spans from a background thread (so requests aren't slowed down)."""
+
+    def __init__(self, max_batch: int = 256, interval_secs: float = 2.0):
+        self.max_batch = max_batch
+        self.interval_secs = interval_secs
+        self.queue: queue.Queue[Optional[Span]] = queue.Queue(maxsize=10_000)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, span: Span):
+        try:
+            self.queue.put_nowait(span)
+        except queue.Full:
+            logger.warning(f"trace export queue full, dropping span '{span.name}'")
+
+    def flush(self):
+        self.queue.put(None)  # flush marker (ends the current batch early)
+        self.queue.join()
+
+    def _run(self) -> None:
+        while True:
+            items: list[Optional[Span]] = []
+            deadline = time.monotonic() + self.interval_secs
+            while len(items) < self.max_batch:
+                try:
+                    timeout = max(0, deadline - time.monotonic())
+                    items.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+                if items[-1] is None:
+                    break
+            batch = [span for span in items if span is not None]
+            if batch:
+                self._write(batch)
+            # only mark done once written (so flush() waits on the export)
+            for _ in items:
+                self.queue.task_done()
+
+    def _write(self, spans: list[Span]):
+        payload = _otlp_payload(spans)
+        try:
+            if settings.trace_file:
+                with open(settings.trace_file, "a") as f:
+                    f.write(json.dumps(payload) + "\n")
+            if settings.trace_otlp_endpoint:
+                # imported here as it's only needed when exporting to a collector
+                import httpx
+
+                res = httpx.post(settings.trace_otlp_endpoint, json=payload, timeout=5)
+                res.raise_for_status()
+        except Exception as e:
+            logger.error(f"failed to export {len(spans)} spans: {e}")
+
+
+_exporter: Optional[_BatchExporter] = None
+_exporter_lock = threading.Lock()
+
+
+def _export(span: Span):
+    global _exporter
+    if not settings.tracing_enabled:
+        return
+    if _exporter is None:
+        # started lazily (e.g. after gunicorn forks its workers)
+        with _exporter_lock:
+            if _exporter is None:
+                _exporter = _BatchExporter()
+    _exporter.submit(span)
+
+
+def flush():
+    """Block until all finished spans have been exported."""
+    if _exporter is not None:
+        _exporter.flush()
+
+
+atexit.register(flush)
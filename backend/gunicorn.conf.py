@@ -0,0 +1,8 @@
+"""Gunicorn config (automatically loaded by gunicorn from the working directory, see launch_prod.sh)."""
+
+
+def child_exit(server, worker):
+    """Clean up the prometheus metrics of a dead worker (see app/metrics.py)."""
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
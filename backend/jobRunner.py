@@ -4,11 +4,16 @@
 import signal
 import sys
 import time
+from datetime import datetime, timedelta, timezone
 import app.database as database
 import app.models as models
+import app.metrics as metrics
+import app.tracing as tracing
 from app.models.job import Job, JobType, JobStatus
 from app.settings import get_settings
 import config
+from prometheus_client import start_http_server
+from sqlalchemy import or_
 from sqlalchemy.orm import Session
 
 settings = get_settings()
@@ -18,6 +23,12 @@ logger = config.get_logger(__name__)
 def main():
     signal.signal(signal.SIGTERM, signal_handler)
     signal.signal(signal.SIGINT, signal_handler)  # Also handle Ctrl-C gracefully
+    tracing.set_service_name("job-runner")
+
+    if settings.job_metrics_port:
+        # job metrics live in this process, so serve them separately from the API's /metrics
+        start_http_server(settings.job_metrics_port)
+        logger.info(f"serving job metrics on port {settings.job_metrics_port}")
 
     with database.SessionFactory() as session:
         logger.info("Job runner started")
@@ -38,13 +49,33 @@ def _loop_once(session: Session) -> Job | None:
     logger.info(f"Running job: {job} (other pending jobs: {pending_job_count-1})")
     start_time = time.perf_counter()
     job.run(session)
-    logger.info(f"job complete in {(time.perf_counter() - start_time):.3f} secs: {job}")
+    duration = time.perf_counter() - start_time
+    metrics.JOB_DURATION.labels(job.job_type.value, job.status.value).observe(duration)
+    logger.info(f"job complete in {duration:.3f} secs: {job}")
     return job
 
 
 def pop_next_pending_job(session: Session) -> Job | None:
-    """Get the next pending job to run."""
-    job = session.query(models.Job).filter(Job.status == JobStatus.PENDING).first()
+    """
+    Get the next pending job to run.
+    FEEDBACK_EMAIL jobs are held back until they're older than settings.email_digest_secs
+    so notifications for the same student can be coalesced into a single digest email.
+    """
+    digest_cutoff = datetime.now(timezone.utc) - timedelta(
+        seconds=settings.email_digest_secs
+    )
+    job = (
+        session.query(models.Job)
+        .filter(
+            Job.status == JobStatus.PENDING,
+            or_(
+                Job.job_type != JobType.FEEDBACK_EMAIL,
+                Job.created_at <= digest_cutoff,
+            ),
+        )
+        .order_by(Job.created_at.asc())
+        .first()
+    )
     return job
 
 
@@ -14,6 +14,10 @@ function main() {
         echo "using existing NUM_WORKERS=$NUM_WORKERS"
     fi
 
+    # aggregate prometheus metrics across gunicorn workers (see app/metrics.py)
+    export PROMETHEUS_MULTIPROC_DIR="${PROMETHEUS_MULTIPROC_DIR:-/tmp/prometheus_multiproc}"
+    rm -rf "$PROMETHEUS_MULTIPROC_DIR" && mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+
     declare -a CMD=(
         "gunicorn" "app.main:app"
         "--timeout" "300"
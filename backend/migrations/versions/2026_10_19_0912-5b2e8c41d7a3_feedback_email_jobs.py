@@ -0,0 +1,35 @@
+"""feedback email jobs
+
+Revision ID: 5b2e8c41d7a3
+Revises: 9e86599b9a80
+Create Date: 2026-10-19 09:12:31.204115+00:00
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "5b2e8c41d7a3"
+down_revision: Union[str, None] = "9e86599b9a80"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # (alembic doesn't autogenerate changes to enum values)
+    op.execute("ALTER TYPE jobtype ADD VALUE IF NOT EXISTS 'FEEDBACK_EMAIL'")
+
+
+def downgrade() -> None:
+    # postgres can't drop a value from an enum, so recreate the type without it
+    op.execute("DELETE FROM job WHERE job_type = 'FEEDBACK_EMAIL'")
+    op.execute("ALTER TYPE jobtype RENAME TO jobtype_old")
+    op.execute("CREATE TYPE jobtype AS ENUM ('AI_FEEDBACK')")
+    op.execute(
+        "ALTER TABLE job ALTER COLUMN job_type TYPE jobtype USING job_type::text::jobtype"
+    )
+    op.execute("DROP TYPE jobtype_old")
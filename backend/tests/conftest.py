@@ -39,6 +39,28 @@ def settings() -> Settings:
     return get_settings()
 
 
+@pytest.fixture
+def query_budget():
+    """
+    Fails the test if any API request it makes exceeds the query budget (see app/query_profiler.py).
+    Tests may adjust the limits on the yielded budget, e.g. `query_budget.max_queries = 50`.
+    """
+    import app.query_profiler as query_profiler
+
+    # DB time is too noisy to enforce in tests
+    budget = query_profiler.QueryBudget(max_db_secs=None)
+    with query_profiler.record_requests() as recorded:
+        yield budget
+
+    errors = []
+    for label, profile in recorded:
+        exceeded = budget.exceeded_by(profile)
+        if exceeded:
+            errors.append(f"{label} ({'; '.join(exceeded)}): {profile.describe()}")
+    if errors:
+        pytest.fail("query budget exceeded by:\n" + "\n".join(errors))
+
+
 def pytest_sessionstart():
     """Runs before all tests start https://stackoverflow.com/a/35394239"""
     if not load_dotenv(override=True, dotenv_path=os.path.join(TEST_DIR, "test.env")):
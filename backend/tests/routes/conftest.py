@@ -0,0 +1,7 @@
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def enforce_query_budget(query_budget):
+    """Guard all route tests against excessive (e.g. N+1) queries."""
+    yield query_budget
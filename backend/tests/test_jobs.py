@@ -1,11 +1,20 @@
 import jobRunner
 from app.models.job import Job, JobStatus, JobType, AI_FEEDBACK_JOB_DATA
-from app.models import Feedback
+from app.models import Feedback, CourseRole
 import tests.dummy as dummy
-from app.routes.attempts import build_feedback_job_for_attempt
+from app.routes.attempts import (
+    build_feedback_job_for_attempt,
+    build_feedback_email_job,
+)
 from app.hardcoded import SMARTData, FeedbackData
+import pytest
 import pytest_mock
-from app.feedback_utils import build_few_shot_instructions
+from app.feedback_utils import (
+    build_few_shot_instructions,
+    get_model,
+    GPTModel,
+    LocalModel,
+)
 
 
 def test_pop_next_pending_job(session, mocker: pytest_mock.MockerFixture):
@@ -80,7 +89,81 @@ def test_ai_feedback_job(session, mocker: pytest_mock.MockerFixture):
     assert feedback_data.cost == simulated_cost
 
 
+def test_ai_feedback_job_local_model(session, mocker: pytest_mock.MockerFixture):
+    """Feedback can be generated by a self-hosted model (priced per token)."""
+    import app.models.job as job_module
+
+    mocker.patch.object(job_module.settings, "gpt_model", "local/Llama-2-7b-nl")
+    mocker.patch.object(job_module.settings, "local_model_price", 2.0)
+    mock_call = mocker.patch("app.feedback_utils.LocalModel.__call__")
+    usage = mocker.Mock(prompt_tokens=300, completion_tokens=200, total_tokens=500)
+    mock_call.return_value = (["simulated local feedback"], [mocker.Mock(usage=usage)])
+    course, assignment, teacher, student = dummy.init_simple_course(session)
+
+    attempt = dummy.make_attempt(session, assignment.id, student.id)
+    job = build_feedback_job_for_attempt(attempt.id)
+    session.add(job)
+    session.commit()
+    job.run(session)
+    assert job.status == JobStatus.COMPLETED
+
+    session.refresh(attempt)
+    feedback_data = FeedbackData(**attempt.feedbacks[0].data)
+    assert feedback_data.feedback == "simulated local feedback"
+    assert feedback_data.cost == pytest.approx(500 * 2.0 / 1_000_000)
+
+
+def test_get_model():
+    model = get_model("gpt-3.5-turbo-0125", api_key="key")
+    assert type(model) is GPTModel
+    model = get_model(
+        "local/Llama-2-7b-nl", "key", local_url="http://localhost:8800/v1"
+    )
+    assert isinstance(model, LocalModel) and model.model_name == "Llama-2-7b-nl"
+    assert str(model.client.base_url) == "http://localhost:8800/v1/"
+
+
 def test_build_few_shot_instructions():
     # just verifying the function runs without an error
     few_shot = build_few_shot_instructions()
     assert isinstance(few_shot, str)
+
+
+def test_feedback_email_digest(session, mocker: pytest_mock.MockerFixture):
+    """Feedback notifications for the same student are coalesced into one email."""
+    mock_send = mocker.patch("app.notifications.send_feedback_digest")
+    mock_send.return_value = True
+    course, assignment, teacher, student = dummy.init_simple_course(session)
+    student2 = dummy.make_user(session, email="student2@example.com")
+    student2.enroll(session, course, CourseRole.STUDENT)
+
+    jobs = []
+    for cur_student in [student, student, student2]:
+        attempt = dummy.make_attempt(session, assignment.id, cur_student.id)
+        feedback = dummy.make_feedback(session, attempt.id, user_id=teacher.id)
+        jobs.append(build_feedback_email_job(feedback.id, cur_student.id))
+    session.add_all(jobs)
+    session.commit()
+
+    # jobs are held back until the digest window has passed
+    mocker.patch.object(jobRunner.settings, "email_digest_secs", 60 * 60)
+    assert jobRunner.pop_next_pending_job(session) is None
+
+    mocker.patch.object(jobRunner.settings, "email_digest_secs", 0)
+    job = jobRunner.pop_next_pending_job(session)
+    assert job is not None and job.job_type == JobType.FEEDBACK_EMAIL
+    job.run(session)
+
+    # first student's two notifications were sent together
+    assert mock_send.call_count == 1
+    assert len(mock_send.call_args.args[0]) == 2
+    assert [j.status for j in jobs] == [
+        JobStatus.COMPLETED,
+        JobStatus.COMPLETED,
+        JobStatus.PENDING,
+    ]
+
+    assert jobRunner._loop_once(session) == jobs[2]
+    assert mock_send.call_count == 2
+    assert len(mock_send.call_args.args[0]) == 1
+    assert jobRunner.pop_next_pending_job(session) is None
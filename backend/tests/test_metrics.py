@@ -0,0 +1,22 @@
+import tests.dummy as dummy
+
+
+def test_metrics(client, settings, session):
+    course, assignment, teacher, student = dummy.init_simple_course(session)
+    attempt = dummy.make_attempt(session, assignment.id, student.id)
+
+    dummy.login_user(client, student)
+    res = client.get(f"{settings.api_v1_str}/attempt/{attempt.id}")
+    assert res.status_code == 200
+
+    res = client.get("/metrics")
+    assert res.status_code == 200
+    text = res.text
+
+    # requests are labelled by their route template (rather than the raw path)
+    route = f"{settings.api_v1_str}/attempt/{{attempt_id}}"
+    assert f'route="{route}",status="200"' in text
+    assert str(attempt.id) not in text
+    assert "http_request_db_queries_bucket" in text
+    assert "db_pool_checked_out" in text
+    assert 'job_queue_depth{status="pending"}' in text
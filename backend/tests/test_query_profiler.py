@@ -0,0 +1,60 @@
+import logging
+import uuid
+
+import pytest
+import app.query_profiler as query_profiler
+from app.models import User
+import tests.dummy as dummy
+
+
+def test_fingerprint():
+    fp = query_profiler.fingerprint
+    a = fp("SELECT * FROM  users\n WHERE users.id = %(pk_1)s AND name = 'bob'")
+    b = fp("SELECT * FROM users WHERE users.id = %(pk_1)s AND name = 'alice'")
+    assert a == b == "SELECT * FROM users WHERE users.id = ? AND name = ?"
+    assert fp("SELECT 1 FROM t WHERE id IN (%s, %s, %s) LIMIT 5") == (
+        "SELECT ? FROM t WHERE id IN (?) LIMIT ?"
+    )
+    # numbers within identifiers are preserved
+    assert fp("SELECT t_1.id FROM t AS t_1") == "SELECT t_1.id FROM t AS t_1"
+
+
+def test_detects_repeated_queries(client, settings, session, monkeypatch, caplog):
+    course, assignment, teacher, student = dummy.init_simple_course(session)
+    user_ids = [teacher.id, student.id]
+    session.expunge_all()
+
+    with query_profiler.profile_queries(detailed=True) as profile:
+        for user_id in user_ids:
+            session.get(User, user_id)
+    assert profile.queries == 2
+    assert profile.max_duplicates == 2
+    assert len(profile.duplicates()) == 1
+
+    budget = query_profiler.QueryBudget(max_queries=10, max_duplicates=1)
+    assert len(budget.exceeded_by(profile)) == 1
+
+    # requests exceeding the thresholds are logged (when enabled)
+    monkeypatch.setattr(query_profiler.settings, "query_profiler_enabled", True)
+    monkeypatch.setattr(query_profiler.settings, "query_profiler_max_queries", 0)
+    dummy.login_user(client, student)
+    with caplog.at_level(logging.WARNING, logger=query_profiler.logger.name):
+        res = client.get(f"{settings.api_v1_str}/course/")
+    assert res.status_code == 200
+    assert "query thresholds exceeded by 'GET /api/v1/course/'" in caplog.text
+
+
+def test_failed_requests_are_reported(session, monkeypatch, caplog):
+    monkeypatch.setattr(query_profiler.settings, "query_profiler_enabled", True)
+    monkeypatch.setattr(query_profiler.settings, "query_profiler_max_queries", 0)
+    with (
+        caplog.at_level(logging.WARNING, logger=query_profiler.logger.name),
+        query_profiler.record_requests() as recorded,
+        pytest.raises(ValueError),
+    ):
+        with query_profiler.profile_request("GET /failing"):
+            session.get(User, uuid.uuid4())
+            raise ValueError("handler failed")
+    assert [label for label, _ in recorded] == ["GET /failing"]
+    assert recorded[0][1].queries == 1
+    assert "query thresholds exceeded by 'GET /failing'" in caplog.text
@@ -0,0 +1,53 @@
+"""Guards against slow (heavy) imports creeping back into the API and job runner startup."""
+
+import os
+import subprocess
+import sys
+import pytest
+from app.settings import get_settings
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# heavy dependencies which should only be imported once they're actually needed
+LAZY_MODULES = ["pandas", "openai", "boto3"]
+# generous budget for importing an entrypoint (gunicorn worker boot / job runner start)
+STARTUP_BUDGET_SECS = 3.0
+
+
+def import_profile(module: str) -> dict[str, float]:
+    """
+    Import a module in a fresh interpreter with `python -X importtime`.
+    Returns the cumulative import time (in seconds) of every module that was imported.
+    """
+    res = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=BACKEND_DIR,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    profile = {}
+    for line in res.stderr.splitlines():
+        # e.g. "import time:      3497 |    1095531 |       app.database"
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        profile[name.strip()] = int(cumulative) / 1_000_000
+    return profile
+
+
+@pytest.mark.parametrize("module", ["app.main", "jobRunner"])
+def test_startup_imports(module: str):
+    profile = import_profile(module)
+    slowest = sorted(profile.items(), key=lambda x: x[1], reverse=True)[:10]
+    print(f"\nslowest imports for {module}:")
+    for name, secs in slowest:
+        print(f"  {secs:.3f} secs  {name}")
+
+    for name in LAZY_MODULES:
+        assert name not in profile, f"'{name}' should be lazily imported"
+    assert profile[module] < STARTUP_BUDGET_SECS
+
+
+def test_settings_cached():
+    assert get_settings() is get_settings()
@@ -0,0 +1,63 @@
+import json
+import pytest_mock
+import jobRunner
+import app.tracing as tracing
+from app.models.schemas import AttemptCreate
+from app.models.job import Job, JobStatus
+import tests.dummy as dummy
+
+
+def test_parse_traceparent():
+    trace_id, span_id = "4bf92f3577b34da6a3ce929d0e0e4736", "00f067aa0ba902b7"
+    assert tracing.parse_traceparent(f"00-{trace_id}-{span_id}-01") == (
+        trace_id,
+        span_id,
+    )
+    for invalid in [None, "", "00-abc-def-01", f"00-{trace_id}-{span_id}"]:
+        assert tracing.parse_traceparent(invalid) is None
+
+
+def test_trace_request_to_job(
+    client, settings, session, tmp_path, monkeypatch, mocker: pytest_mock.MockerFixture
+):
+    """The spans of a submitted attempt and its AI feedback job should share a single trace."""
+    trace_file = tmp_path / "traces.jsonl"
+    monkeypatch.setattr(tracing.settings, "trace_file", trace_file)
+    dummy.mock_gpt(mocker, ["simulated feedback"], 0.0042)
+    course, assignment, teacher, student = dummy.init_simple_course(session)
+
+    dummy.login_user(client, student)
+    obj = AttemptCreate(
+        assignment_id=assignment.id,
+        data=dummy.EXAMPLE_SMART_DATA.model_dump(),
+        file_ids=[],
+    )
+    # continue an (upstream) trace provided by the client
+    trace_id = "4bf92f3577b34da6a3ce929d0e0e4736"
+    res = client.put(
+        f"{settings.api_v1_str}/attempt/",
+        json=json.loads(obj.model_dump_json()),
+        params={"assignment_id": assignment.id},
+        headers={"traceparent": f"00-{trace_id}-00f067aa0ba902b7-01"},
+    )
+    assert res.status_code == 201
+
+    job = jobRunner._loop_once(session)
+    assert job is not None and job.status == JobStatus.COMPLETED
+    assert job.data["traceparent"].startswith(f"00-{trace_id}-")
+    tracing.flush()
+
+    spans = {}
+    for line in trace_file.read_text().splitlines():
+        for resource_spans in json.loads(line)["resourceSpans"]:
+            for span in resource_spans["scopeSpans"][0]["spans"]:
+                spans[span["name"]] = span
+
+    request_span = spans[f"PUT {settings.api_v1_str}/attempt/"]
+    job_span = spans["job AI_FEEDBACK"]
+    assert job_span["parentSpanId"] == job.data["traceparent"].split("-")[2]
+    for name in ["job queue wait", "build prompt", "gpt call", "db commit"]:
+        assert spans[name]["parentSpanId"] == job_span["spanId"]
+    assert {span["traceId"] for span in spans.values()} == {trace_id}
+    attributes = {a["key"]: a["value"] for a in request_span["attributes"]}
+    assert attributes["http.response.status_code"] == {"intValue": "201"}
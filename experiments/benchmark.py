@@ -2,17 +2,21 @@
 """
 Script for benchmarking feedback from LLMs on the basis of quality and safety.
 For fluency benchmarking see tuner/generate.py
+For judging many models with many judges (and metrics) in one run, see benchmark_matrix.py
 """
 
 import os
 import json
-from typing import Annotated, Tuple
+from functools import lru_cache
+from typing import Annotated, Any, Dict, Iterable, List, Tuple, Type
 from pydantic import BaseModel, create_model, conint, Field
 import argparse
 import pandas as pd
 import prompts as promptlib
+import budget
 import config
 import gpt
+from results_store import ResultsStore, FEEDBACK_EXPERIMENT, BENCHMARK_EXPERIMENT
 import matplotlib.pyplot as plt
 
 
@@ -39,14 +43,18 @@ For example:
 
 # list of default attributes baked into judgement_prompt
 default_attributes = ["utility"]
+# attributes judged in addition to the defaults (name -> criteria)
+OTHER_ATTRIBUTES = {"safety": promptlib.FEEDBACK_PRINCIPLES}
+# expected (average) length of a judgement (explanation + scores), for projecting the cost of a run
+EXPECTED_OUTPUT_TOKENS = 250
 
 
 def get_score_model(
     all_attributes: list[str] = default_attributes + ["safety"],
-) -> Tuple[BaseModel, dict]:
+) -> Tuple[Type[BaseModel], str]:
     """Dynamically create a Pydantic model for the response scores."""
 
-    fields = {
+    fields: Dict[str, Any] = {
         attr: (Annotated[int, conint(ge=1, le=10)], Field(ge=1, le=10))
         for attr in all_attributes
     }
@@ -58,38 +66,72 @@ def get_score_model(
     return AttrModel, format_example
 
 
+class JudgeTemplate:
+    """
+    judgement_template with everything but the question and answer filled in (and the score model/schema
+    built) once, so prompts for many rows can be built cheaply.
+    """
+
+    def __init__(self, other_attributes: dict[str, str] = dict()):
+        additional_attributes = ""
+        for attr, criteria in other_attributes.items():
+            additional_attributes += f'\nAdditionally a "{attr}" score shall follow from the criteria:\n{criteria}\n'
+
+        all_attributes = default_attributes + list(other_attributes.keys())
+        self.ScoreModel, format_example = get_score_model(all_attributes)
+
+        # split filled template around the question and answer
+        filled = judgement_template.format(
+            question="\0",
+            answer="\0",
+            additional_attributes=additional_attributes,
+            format_schema=self.ScoreModel.model_json_schema(),
+            format_example=format_example,
+        )
+        self._parts = filled.split("\0")
+        assert len(self._parts) == 3
+
+    def build(self, question: str, answer: str) -> str:
+        return self._parts[0] + question + self._parts[1] + answer + self._parts[2]
+
+    def build_many(self, questions: Iterable[str], answers: Iterable[str]) -> list[str]:
+        """Build prompts column-wise (e.g. from dataframe columns)."""
+        return [self.build(q, a) for q, a in zip(questions, answers)]
+
+    def parse_scores(self, responses: Iterable[str]) -> pd.DataFrame:
+        """
+        Parse judge responses (in a single pass) into a dataframe with an integer column per score
+        (missing values where a response failed to parse).
+        """
+        metric_names = list(self.ScoreModel.model_fields)
+        records: List[Dict[str, Any]] = []
+        for text in responses:
+            obj = promptlib.parse_pydantic(text, self.ScoreModel)
+            records.append(obj.model_dump() if isinstance(obj, self.ScoreModel) else {})
+        return pd.DataFrame.from_records(records, columns=metric_names).astype("Int64")
+
+
+@lru_cache(maxsize=16)
+def _get_judge_template(other_attributes: tuple[tuple[str, str], ...]) -> JudgeTemplate:
+    return JudgeTemplate(dict(other_attributes))
+
+
 def build_judge_prompt(
     question: str,
     answer: str,
     other_attributes: dict[str, str] = dict(),
-    # format_schema: str,
-    # format_example: str,
-) -> Tuple[str, BaseModel]:
+) -> Tuple[str, Type[BaseModel]]:
     """
     Builds a prompt for evaluating the quality of an assistant's response.
     Returns the prompt and a Pydantic model for the response schema.
     See http://arxiv.org/abs/2306.05685 (Figure 6) for original inspiration.
+    For building many prompts see JudgeTemplate.
     """
-    additional_attributes = ""
-    for attr, criteria in other_attributes.items():
-        additional_attributes += f'\nAdditionally a "{attr}" score shall follow from the criteria:\n{criteria}\n'
-
-    all_attributes = default_attributes + list(other_attributes.keys())
-    AttrModel, format_example = get_score_model(all_attributes)
-
-    prompt = judgement_template.format(
-        question=question,
-        answer=answer,
-        additional_attributes=additional_attributes,
-        format_schema=AttrModel.model_json_schema(),
-        format_example=format_example,
-    )
-    return prompt, AttrModel
+    template = _get_judge_template(tuple(other_attributes.items()))
+    return template.build(question, answer), template.ScoreModel
 
 
 def main():
-    OTHER_ATTRIBUTES = {"safety": promptlib.FEEDBACK_PRINCIPLES}
-
     parser = argparse.ArgumentParser(
         description="Judge the quality of feedback generated by an LLM, benchmarking with desired model as a judge.",
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
@@ -98,7 +140,7 @@ def main():
         "--input-dir",
         "-i",
         type=str,
-        help="Input file directory (should contain 'feedback.xlsx' file",
+        help="Input file directory (should contain feedback results, see feedback.py)",
         default=os.path.join(SCRIPT_DIR, "data/feedback/v4"),
     )
     parser.add_argument(
@@ -108,91 +150,115 @@ def main():
         default="gpt-3.5-turbo-0125",
         help="Name of OpenAI model to use as judge.",
     )
+    parser.add_argument(
+        "--export-excel",
+        action="store_true",
+        help="Also export the benchmark results to an Excel file (with a sheet per model).",
+    )
+    parser.add_argument(
+        "--max-workers",
+        type=int,
+        default=8,
+        help="Max number of concurrent API requests.",
+    )
+    budget.add_budget_args(parser)
 
     args = parser.parse_args()
     feedback_path = os.path.join(args.input_dir, "feedback.xlsx")
     benchmark_path = os.path.join(args.input_dir, f"benchmark_with_{args.model}.xlsx")
+    store = ResultsStore(os.path.join(args.input_dir, "results"))
 
-    ### read xlsx files with arbitrary sheet names
-    feedback_dfs = get_all_dfs(feedback_path)
-    benchmark_dfs = get_all_dfs(benchmark_path)  # won't exist on first run
+    # import results from legacy Excel files (if any, not yet in store)
+    store.import_excel(feedback_path, FEEDBACK_EXPERIMENT)
+    store.import_excel(benchmark_path, BENCHMARK_EXPERIMENT, judge=args.model)
 
-    assert len(feedback_dfs) > 0, f"no feedback found in '{feedback_path}'"
+    feedback_models = store.models(FEEDBACK_EXPERIMENT)
+    assert len(feedback_models) > 0, f"no feedback found in '{store.root}'"
 
     ### generate judgements for feedbacks, (if not already judged)
-    def get_prompt(row: pd.Series) -> str:
-        judge_prompt, _ = build_judge_prompt(
-            question=row["prompt"],
-            answer=row["response"],
-            other_attributes=OTHER_ATTRIBUTES,
-        )
-        return judge_prompt
-
-    _, ScoreModel = build_judge_prompt(
-        question="example question",
-        answer="example answer",
-        other_attributes=OTHER_ATTRIBUTES,
-    )
+    template = JudgeTemplate(OTHER_ATTRIBUTES)
+    ScoreModel = template.ScoreModel
 
     def validator(response: str) -> bool:
         """Verifies a model's response is a valid ScoreModel object."""
         return isinstance(promptlib.parse_pydantic(response, ScoreModel), ScoreModel)
 
-    def post_process_df(df: pd.DataFrame) -> pd.DataFrame:
-        metric_names = ScoreModel.__fields__.keys()
-        metrics = {name: [] for name in metric_names}
-        for _, row in df.iterrows():
-            obj = promptlib.parse_pydantic(row["response"], ScoreModel)
-            for m in metric_names:
-                val = None if not isinstance(obj, ScoreModel) else getattr(obj, m)
-                metrics[m].append(val)
-        # add new columns
-        for metric_name, metric_values in metrics.items():
-            df[metric_name] = metric_values
-
-    judge = gpt.GPTModel(args.model)
     logger.info(
-        f"checking if feedbacks from {len(feedback_dfs)} model(s) have been judged by {args.model}"
+        f"checking if feedbacks from {len(feedback_models)} model(s) have been judged by {args.model}"
     )
-    for model_name in feedback_dfs.keys():
-        if model_name in benchmark_dfs:
+    judge_dfs = {}  # judge prompts of each model not yet judged
+    journals = {}  # validated judgements (of an interrupted run) of each model not yet judged
+    for model_name in feedback_models:
+        if store.exists(BENCHMARK_EXPERIMENT, model_name, judge=args.model):
             continue  # was previously judged
-
-        logger.info(
-            f"benchmarking feedback from model: {model_name} with judge {args.model}"
+        feedback_df = store.read(
+            FEEDBACK_EXPERIMENT, model_name, columns=["goal_id", "prompt", "response"]
         )
-
-        feedback_df = feedback_dfs[model_name]
-        judge_df = pd.DataFrame(
+        assert feedback_df is not None
+        judge_dfs[model_name] = pd.DataFrame(
             {
                 "goal_id": feedback_df["goal_id"],
-                "prompt": feedback_df.apply(get_prompt, axis=1).to_list(),
+                "prompt": template.build_many(
+                    feedback_df["prompt"], feedback_df["response"]
+                ),
             }
         )
+        journal_name = f".benchmark_{model_name}_with_{args.model}.journal.jsonl"
+        journals[model_name] = gpt.PromptJournal(
+            os.path.join(args.input_dir, journal_name.replace("/", "_"))
+        )
+
+    max_retries = 2
+    # (prompts already in a journal are resumed from it, without repeat spend)
+    projection = budget.plan_gpt(
+        (
+            p
+            for model_name, df in judge_dfs.items()
+            for p in df["prompt"]
+            if journals[model_name].get(p) is None
+        ),
+        args.model,
+        expected_output_tokens=EXPECTED_OUTPUT_TOKENS,
+        concurrency=args.max_workers,
+        max_retries=max_retries,
+        name=f"judging {len(judge_dfs)} model(s) with {args.model}",
+    )
+    if not budget.check_run(projection, args):
+        return
+
+    judge = gpt.GPTModel(args.model)
+    for model_name, judge_df in judge_dfs.items():
+        logger.info(
+            f"benchmarking feedback from model: {model_name} with judge {args.model}"
+        )
 
         # judge_df = judge_df[:3]  # for testing
-        max_retries = 2
-        outputs, total_price, total_calls = gpt.auto_reprompt(
+        outputs, total_price, total_calls, _ = gpt.auto_reprompt(
             validator,
             max_retries,
             judge,
             judge_df["prompt"].to_list(),
+            # constrain outputs to the score schema (if supported by the judge)
+            response_model=ScoreModel,
+            # resumable if interrupted
+            journal=journals[model_name],
+            max_workers=args.max_workers,
         )
         logger.info(f"price: ${total_price:.4f} for {total_calls} API calls")
         judge_df["response"] = outputs
-        post_process_df(judge_df)
-        config.safe_append_sheet(
-            judge_df, model_name, benchmark_path, prompt_overwrite=True
-        )
+        judge_df = pd.concat([judge_df, template.parse_scores(outputs)], axis=1)
+        store.write(judge_df, BENCHMARK_EXPERIMENT, model_name, judge=args.model)
         print()
 
-    logger.info(
-        f"all feedbacks have been judged by {args.model}. See '{benchmark_path}'"
-    )
+    logger.info(f"all feedbacks have been judged by {args.model}. See '{store.root}'")
 
-    ### plot benchmark results
-    benchmark_dfs = get_all_dfs(benchmark_path)
+    ### plot benchmark results (only reading the score columns)
+    benchmark_dfs = store.read_all(
+        BENCHMARK_EXPERIMENT, judge=args.model, columns=list(ScoreModel.model_fields)
+    )
     plot_benchmark(benchmark_dfs, ScoreModel, args.input_dir)
+    if args.export_excel:
+        store.export_excel(BENCHMARK_EXPERIMENT, benchmark_path, judge=args.model)
 
 
 # note that these plots are similar in style to
@@ -204,12 +270,10 @@ def plot_benchmark(judges: dict, ScoreModel, dir: str):
 
         data[judge_name] = {}
         for m in metric_names:
-            vals = df[m].tolist()
             print(f"\n{judge_name} {m}:")
             print(df[m].describe())
-            # drop NaNs if any
-            vals = [v for v in vals if v is not None]
-            data[judge_name][m] = vals
+            # drop missing values (failed parses) if any
+            data[judge_name][m] = df[m].dropna().tolist()
 
     fig, axes = plt.subplots(1, 2, figsize=(12, 6))  # 1 row, 2 columns
     title_fontsize = 16
@@ -240,15 +304,5 @@ def plot_benchmark(judges: dict, ScoreModel, dir: str):
     logger.info(f"wrote '{fname}'")
 
 
-def get_all_dfs(fname: str):
-    if not os.path.exists(fname):
-        return dict()
-    excel_file = pd.ExcelFile(fname)
-    return {
-        sheet_name: excel_file.parse(sheet_name)
-        for sheet_name in excel_file.sheet_names
-    }
-
-
 if __name__ == "__main__":
     main()
@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+"""
+Benchmark the feedback of many candidate models, with many judges and metrics, in a single run.
+
+Every (candidate, judge, metric) cell of the matrix is judged concurrently, sharing a rate limit per judge model.
+Identical prompts are only sent once (e.g. utility and safety are scored by the same judge prompt,
+and candidates may give identical responses).
+Results are written to the same store as feedback.py / benchmark.py (so existing results are reused).
+"""
+
+import argparse
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from typing import Callable, Iterable, Optional
+import jinja2
+import pandas as pd
+
+import config
+import gpt
+from AbstractModel import IPrompt
+import prompts as promptlib
+from benchmark import JudgeTemplate, OTHER_ATTRIBUTES
+from results_store import (
+    ResultsStore,
+    FEEDBACK_EXPERIMENT,
+    BENCHMARK_EXPERIMENT,
+    FLUENCY_EXPERIMENT,
+)
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+logger = config.get_logger(__name__)
+
+# experiment each metric is stored under (metrics of the same experiment share a judge prompt)
+METRIC_EXPERIMENTS = {
+    "utility": BENCHMARK_EXPERIMENT,
+    "safety": BENCHMARK_EXPERIMENT,
+    "fluency": FLUENCY_EXPERIMENT,
+}
+
+
+class FluencyTemplate:
+    """prompts/fluency_score_nl.jinja2 rendered once, so prompts for many rows can be built cheaply."""
+
+    def __init__(self):
+        env = jinja2.Environment(
+            loader=jinja2.FileSystemLoader(os.path.join(SCRIPT_DIR, "prompts"))
+        )
+        filled = env.get_template("fluency_score_nl.jinja2").render(
+            question=promptlib.FLUENCY_QUESTION, answer="\0"
+        )
+        self._parts = filled.split("\0")
+        assert len(self._parts) == 2
+
+    def build_many(self, questions: Iterable[str], answers: Iterable[str]) -> list[str]:
+        return [self._parts[0] + answer + self._parts[1] for answer in answers]
+
+    @staticmethod
+    def parse_score(text: Optional[str]) -> Optional[int]:
+        """Parse a star rating (1-5), or None if invalid."""
+        try:
+            score = int((text or "").strip())
+        except ValueError:
+            return None
+        return score if 1 <= score <= 5 else None
+
+    def parse_scores(self, responses: Iterable[str]) -> pd.DataFrame:
+        scores = [self.parse_score(text) for text in responses]
+        return pd.DataFrame({"fluency": scores}).astype("Int64")
+
+
+@dataclass
+class JudgeTask:
+    """How the judgements of an experiment are prompted and parsed."""
+
+    template: JudgeTemplate | FluencyTemplate
+    validator: Callable[[Optional[str]], bool]
+    gpt_kwargs: dict
+
+
+def get_judge_tasks() -> dict[str, JudgeTask]:
+    """Judge task of each experiment (keyed by experiment name)."""
+    # same template as benchmark.py (so results are interchangeable)
+    judge_template = JudgeTemplate(OTHER_ATTRIBUTES)
+    ScoreModel = judge_template.ScoreModel
+    fluency_template = FluencyTemplate()
+    return {
+        BENCHMARK_EXPERIMENT: JudgeTask(
+            template=judge_template,
+            validator=lambda text: isinstance(
+                promptlib.parse_pydantic(text, ScoreModel), ScoreModel
+            ),
+            gpt_kwargs={"response_model": ScoreModel},
+        ),
+        FLUENCY_EXPERIMENT: JudgeTask(
+            template=fluency_template,
+            validator=lambda text: FluencyTemplate.parse_score(text) is not None,
+            gpt_kwargs={"temperature": 0.2},
+        ),
+    }
+
+
+@dataclass
+class Cell:
+    """Judgements of one candidate's feedback by one judge (for the metrics of one experiment)."""
+
+    experiment: str
+    candidate: str
+    judge: str
+    df: pd.DataFrame  # columns ["goal_id", "prompt"] (plus "response" once judged)
+
+
+def plan_cells(
+    store: ResultsStore,
+    candidates: list[str],
+    judges: list[str],
+    metrics: list[str],
+    tasks: dict[str, JudgeTask],
+) -> list[Cell]:
+    """Build the prompts of each cell of the matrix not yet in the store."""
+    experiments = sorted({METRIC_EXPERIMENTS[m] for m in metrics})
+    cells = []
+    feedback_dfs: dict[str, pd.DataFrame] = {}
+    for experiment in experiments:
+        template = tasks[experiment].template
+        for candidate in candidates:
+            for judge in judges:
+                if store.exists(experiment, candidate, judge=judge):
+                    logger.debug(f"reusing {experiment} of {candidate} by {judge}")
+                    continue
+                if candidate not in feedback_dfs:
+                    feedback_df = store.read(
+                        FEEDBACK_EXPERIMENT,
+                        candidate,
+                        columns=["goal_id", "prompt", "response"],
+                    )
+                    assert feedback_df is not None, f"no feedback from '{candidate}'"
+                    feedback_dfs[candidate] = feedback_df
+                feedback_df = feedback_dfs[candidate]
+                df = pd.DataFrame(
+                    {
+                        "goal_id": feedback_df["goal_id"],
+                        "prompt": template.build_many(
+                            feedback_df["prompt"], feedback_df["response"]
+                        ),
+                    }
+                )
+                cells.append(Cell(experiment, candidate, judge, df))
+    return cells
+
+
+def run_matrix(
+    store: ResultsStore,
+    candidates: list[str],
+    judges: list[str],
+    metrics: list[str],
+    requests_per_min: float = 500,
+    max_workers: int = 8,
+    max_retries: int = 2,
+    get_model: Callable[[str], gpt.GPTModel] = gpt.GPTModel,
+) -> pd.DataFrame:
+    """
+    Judge the feedback of each candidate with each judge (for the given metrics), writing results to the store.
+    Returns a summary of the scores of each cell (see summarize()).
+    """
+    tasks = get_judge_tasks()
+    cells = plan_cells(store, candidates, judges, metrics, tasks)
+
+    # dedupe prompts across cells of the same (judge, experiment)
+    groups: dict[tuple[str, str], list[str]] = {}
+    for cell in cells:
+        unique = groups.setdefault((cell.judge, cell.experiment), [])
+        unique.extend(cell.df["prompt"])
+    groups = {key: list(dict.fromkeys(prompts)) for key, prompts in groups.items()}
+
+    total_prompts = sum(len(cell.df) for cell in cells)
+    unique_prompts = sum(len(prompts) for prompts in groups.values())
+    logger.info(
+        f"judging {len(cells)} cells: {unique_prompts} unique prompts (of {total_prompts})"
+    )
+
+    # judges are prompted concurrently, each sharing a rate limit across its groups
+    limiters = {judge: gpt.RateLimiter(requests_per_min) for judge in judges}
+    models = {judge: get_model(judge) for judge in judges}
+
+    def judge_group(judge: str, experiment: str) -> gpt.RepromptResult:
+        task = tasks[experiment]
+        journal_name = f".matrix_{experiment}_{judge}.journal.jsonl".replace("/", "_")
+        prompts: list[IPrompt] = list(groups[(judge, experiment)])
+        return gpt.auto_reprompt(
+            task.validator,
+            max_retries,
+            models[judge],
+            prompts,
+            # resumable if interrupted
+            journal=os.path.join(store.root, journal_name),
+            max_workers=max_workers,
+            rate_limiter=limiters[judge],
+            **task.gpt_kwargs,
+        )
+
+    total_price = 0.0
+    os.makedirs(store.root, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=max(1, len(groups))) as executor:
+        futures = {executor.submit(judge_group, *key): key for key in groups}
+        for future in as_completed(futures):
+            judge, experiment = futures[future]
+            res = future.result()
+            total_price += res.total_price
+            logger.info(
+                f"{experiment} by {judge}: ${res.total_price:.4f} for {res.total_calls} API calls"
+            )
+
+            # scatter outputs back to each cell of this group
+            outputs = dict(zip(groups[(judge, experiment)], res.outputs))
+            template = tasks[experiment].template
+            for cell in cells:
+                if (cell.judge, cell.experiment) != (judge, experiment):
+                    continue
+                cell.df["response"] = cell.df["prompt"].map(outputs)
+                cell.df = pd.concat(
+                    [cell.df, template.parse_scores(cell.df["response"])], axis=1
+                )
+                store.write(cell.df, experiment, cell.candidate, judge=judge)
+
+    logger.info(f"total price: ${total_price:.4f}")
+    return summarize(store, candidates, judges, metrics)
+
+
+def summarize(
+    store: ResultsStore, candidates: list[str], judges: list[str], metrics: list[str]
+) -> pd.DataFrame:
+    """Mean score (and number of valid scores) of each (candidate, judge, metric) cell in the store."""
+    rows = []
+    for metric in metrics:
+        for judge in judges:
+            for candidate in candidates:
+                df = store.read(
+                    METRIC_EXPERIMENTS[metric], candidate, judge=judge, columns=[metric]
+                )
+                scores = (
+                    df[metric].dropna() if df is not None else pd.Series(dtype=float)
+                )
+                rows.append(
+                    {
+                        "candidate": candidate,
+                        "judge": judge,
+                        "metric": metric,
+                        "mean": scores.mean() if len(scores) else None,
+                        "n": len(scores),
+                    }
+                )
+    return pd.DataFrame(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Judge the feedback of candidate models with multiple judges and metrics (concurrently).",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "--input-dir",
+        "-i",
+        type=str,
+        help="Input file directory (should contain feedback results, see feedback.py)",
+        default=os.path.join(SCRIPT_DIR, "data/feedback/v4"),
+    )
+    parser.add_argument(
+        "--candidates",
+        "-c",
+        nargs="+",
+        help="Models whose feedback to judge (default: all models with feedback).",
+    )
+    parser.add_argument(
+        "--judges",
+        "-j",
+        nargs="+",
+        default=["gpt-4-0125-preview"],
+        help="Names of OpenAI models to use as judges.",
+    )
+    parser.add_argument(
+        "--metrics",
+        nargs="+",
+        choices=list(METRIC_EXPERIMENTS.keys()),
+        default=list(METRIC_EXPERIMENTS.keys()),
+    )
+    parser.add_argument(
+        "--rpm",
+        type=float,
+        default=500,
+        help="Max requests per minute to each judge model.",
+    )
+    parser.add_argument("--max-workers", type=int, default=8)
+    parser.add_argument("--max-retries", "-r", type=int, default=2)
+
+    args = parser.parse_args()
+    config.source_dot_env()  # read api key
+    store = ResultsStore(os.path.join(args.input_dir, "results"))
+    candidates = args.candidates or store.models(FEEDBACK_EXPERIMENT)
+    assert len(candidates) > 0, f"no feedback found in '{store.root}'"
+
+    summary = run_matrix(
+        store,
+        candidates,
+        args.judges,
+        args.metrics,
+        requests_per_min=args.rpm,
+        max_workers=args.max_workers,
+        max_retries=args.max_retries,
+    )
+    print(summary.to_string(index=False))
+    fname = os.path.join(args.input_dir, "benchmark_matrix.csv")
+    summary.to_csv(fname, index=False)
+    logger.info(f"wrote '{fname}'")
+
+
+if __name__ == "__main__":
+    main()
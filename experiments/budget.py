@@ -0,0 +1,220 @@
+"""
+Dry-run planning of experiment runs: projects the cost, tokens and wall-clock time of a run before it starts
+(so budget overruns are found upfront, rather than halfway through a run).
+
+Usage (in a script):
+    budget.add_budget_args(parser)
+    ...
+    projection = budget.plan_gpt(prompts, args.model, expected_output_tokens=500)
+    if not budget.check_run(projection, args):
+        return  # dry run
+"""
+
+import argparse
+import math
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Callable, Iterable, Optional
+
+import config
+import gpt
+from AbstractModel import IPrompt
+
+logger = config.get_logger(__name__)
+
+# DeepL API Pro price (USD per character, excluding the monthly fee)
+#   https://www.deepl.com/pro-api
+DEEPL_PRICE_PER_CHAR = 25.0 / 1_000_000
+
+# rough latency assumptions for projecting wall-clock time (override as needed)
+REQUEST_OVERHEAD_SECS = 0.6  # time to first token
+OUTPUT_TOKENS_PER_SEC = {
+    "gpt-3.5-turbo-0125": 70.0,
+    "gpt-4-0125-preview": 25.0,
+    "gpt-4-turbo-2024-04-09": 30.0,
+    "gpt-4o-2024-08-06": 60.0,
+    "gpt-4o-mini-2024-07-18": 80.0,
+}
+DEFAULT_OUTPUT_TOKENS_PER_SEC = 30.0
+DEEPL_CHARS_PER_SEC = 2_000.0
+
+# tokens added by the chat format for each (single message) conversation
+#   https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
+CHAT_OVERHEAD_TOKENS = 7
+CHARS_PER_TOKEN = 4.0  # fallback estimate when no tokenizer is available
+
+
+@dataclass
+class Projection:
+    """Projected usage of a run (price and time assume no retries are needed)."""
+
+    name: str
+    requests: int
+    price: float  # USD
+    secs: float  # wall-clock time
+    input_tokens: int = 0
+    output_tokens: int = 0
+    characters: int = 0  # for translation (billed by character)
+    max_retries: int = 0
+
+    @property
+    def max_price(self) -> float:
+        """Worst case price (if every request needs max_retries reprompts)."""
+        return self.price * (1 + self.max_retries)
+
+    def __str__(self) -> str:
+        res = f"{self.name}: {self.requests:,} requests"
+        if self.input_tokens or self.output_tokens:
+            res += (
+                f", {self.input_tokens:,} input + ~{self.output_tokens:,} output tokens"
+            )
+        if self.characters:
+            res += f", {self.characters:,} characters"
+        res += f", ~${self.price:.2f}"
+        if self.max_retries > 0:
+            res += f" (at most ${self.max_price:.2f} with retries)"
+        return res + f", ~{self.secs / 60:.1f} min"
+
+
+class BudgetExceededError(Exception):
+    pass
+
+
+@lru_cache(maxsize=8)
+def get_token_counter(model_name: str) -> Callable[[str], int]:
+    """Returns a function counting the tokens of a text (with the model's local tokenizer if available)."""
+    try:
+        # imported here as it's only needed for planning
+        import tiktoken
+
+        try:
+            encoding = tiktoken.encoding_for_model(model_name)
+        except KeyError:
+            encoding = tiktoken.get_encoding("cl100k_base")
+        return lambda text: len(encoding.encode(text, disallowed_special=()))
+    except Exception as e:
+        # e.g. tiktoken not installed, or its encoding can't be downloaded
+        logger.warning(f"no tokenizer for '{model_name}' ({e}), estimating tokens")
+        return lambda text: math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def _prompt_text(prompt: IPrompt) -> str:
+    if isinstance(prompt, str):
+        return prompt
+    return "\n".join(message["content"] for message in prompt)
+
+
+def project_secs(
+    requests: int, output_tokens: int, tokens_per_sec: float, concurrency: int
+) -> float:
+    """Projected wall-clock time of requests (with the given concurrency)."""
+    secs = requests * REQUEST_OVERHEAD_SECS + output_tokens / tokens_per_sec
+    return secs / max(1, min(concurrency, requests or 1))
+
+
+def plan_gpt(
+    prompts: Iterable[IPrompt],
+    model_name: str,
+    expected_output_tokens: int,
+    concurrency: int = 1,
+    max_retries: int = 0,
+    name: Optional[str] = None,
+    count_tokens: Optional[Callable[[str], int]] = None,
+) -> Projection:
+    """
+    Project the cost and time of prompting a GPT model with the given prompts.
+    expected_output_tokens: expected (average) length of each response.
+    """
+    count_tokens = count_tokens or get_token_counter(model_name)
+    requests, input_tokens = 0, 0
+    for prompt in prompts:
+        input_tokens += count_tokens(_prompt_text(prompt)) + CHAT_OVERHEAD_TOKENS
+        requests += 1
+    output_tokens = requests * expected_output_tokens
+
+    if model_name in gpt.PRICES:
+        input_price, output_price = gpt.PRICES[model_name]
+        price = input_tokens * input_price + output_tokens * output_price
+    else:
+        logger.warning(f"price entry unknown for model '{model_name}'")
+        price = math.nan
+
+    tokens_per_sec = OUTPUT_TOKENS_PER_SEC.get(
+        model_name, DEFAULT_OUTPUT_TOKENS_PER_SEC
+    )
+    return Projection(
+        name=name or model_name,
+        requests=requests,
+        price=price,
+        secs=project_secs(requests, output_tokens, tokens_per_sec, concurrency),
+        input_tokens=input_tokens,
+        output_tokens=output_tokens,
+        max_retries=max_retries,
+    )
+
+
+def plan_translation(
+    texts: Iterable[str],
+    requests: int,
+    concurrency: int = 1,
+    name: str = "DeepL translation",
+) -> Projection:
+    """Project the cost and time of translating the given texts with DeepL (in the given number of requests)."""
+    characters = sum(len(text) for text in texts)
+    secs = requests * REQUEST_OVERHEAD_SECS + characters / DEEPL_CHARS_PER_SEC
+    return Projection(
+        name=name,
+        requests=requests,
+        price=characters * DEEPL_PRICE_PER_CHAR,
+        secs=secs / max(1, min(concurrency, requests or 1)),
+        characters=characters,
+    )
+
+
+def check_budget(
+    projection: Projection,
+    max_price: Optional[float] = None,
+    max_hours: Optional[float] = None,
+):
+    """Raises BudgetExceededError if the projection exceeds the given budget."""
+    # an unknown price (nan) is never considered within budget
+    if max_price is not None and not projection.price <= max_price:
+        raise BudgetExceededError(
+            f"projected price ${projection.price:.2f} exceeds budget of ${max_price:.2f}"
+        )
+    if max_hours is not None and projection.secs > max_hours * 3600:
+        raise BudgetExceededError(
+            f"projected time {projection.secs / 3600:.1f}h exceeds budget of {max_hours:.1f}h"
+        )
+
+
+def add_budget_args(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Only report the projected cost and time of this run (without calling any APIs).",
+    )
+    parser.add_argument(
+        "--max-price",
+        type=float,
+        help="Refuse to start if the projected price (USD) exceeds this budget.",
+    )
+    parser.add_argument(
+        "--max-hours",
+        type=float,
+        help="Refuse to start if the projected wall-clock time exceeds this budget.",
+    )
+
+
+def check_run(projection: Projection, args: argparse.Namespace) -> bool:
+    """
+    Report the projection of a run and check it against the budget args (see add_budget_args()).
+    Exits if the budget would be exceeded, returns False if the run shouldn't start (dry run).
+    """
+    logger.info(f"projected {projection}")
+    try:
+        check_budget(projection, max_price=args.max_price, max_hours=args.max_hours)
+    except BudgetExceededError as e:
+        logger.error(f"refusing to start: {e}")
+        raise SystemExit(1) from e
+    return not args.dry_run
@@ -185,22 +185,16 @@ def safe_append_sheet(
             df.to_excel(writer, sheet_name=sheet_name, index=False)
         return True
 
-    # append to existing file
-    # read existing sheets
-    excel_file = pd.ExcelFile(fname)
-    sheets = {
-        sheet_name: excel_file.parse(sheet_name)
-        for sheet_name in excel_file.sheet_names
-    }
-
-    if sheet_name in sheets and prompt_overwrite:
+    # append to existing file (without parsing/rewriting the other sheets via pandas)
+    #   see results_store.py for a faster alternative for storing experiment results
+    if prompt_overwrite and sheet_name in pd.ExcelFile(fname).sheet_names:
         if not prompt_yes_no(f"overwrite sheet '{sheet_name}' in '{fname}'?"):
             return False
 
-    sheets[sheet_name] = df
-    with pd.ExcelWriter(fname) as writer:
-        for sheet_name, df in sheets.items():
-            df.to_excel(writer, sheet_name=sheet_name, index=False)
+    with pd.ExcelWriter(
+        fname, engine="openpyxl", mode="a", if_sheet_exists="replace"
+    ) as writer:
+        df.to_excel(writer, sheet_name=sheet_name, index=False)
     if verbose:
         logger.info(f"wrote '{fname}'")
     return True
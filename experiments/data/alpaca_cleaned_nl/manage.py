@@ -11,16 +11,19 @@ import os
 import json
 import sys
 import glob
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from datasets import load_dataset, concatenate_datasets, Dataset, DatasetDict
 import numpy as np
 import deepl
-from typing import Union, Tuple
+from typing import Iterable, Iterator, Optional, TextIO, Union, Tuple
 
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 EXPERIMENTS_DIR = os.path.realpath(os.path.join(SCRIPT_DIR, "../.."))
 sys.path.append(EXPERIMENTS_DIR)
 import data.alpaca_cleaned_nl.translate_utils as tutils  # noqa: E402
 import config  # noqa: E402
+import budget  # noqa: E402
+import gpt  # noqa: E402
 from config import TaskTimer  # noqa: E402
 
 
@@ -35,6 +38,12 @@ TRANSLATED_PATH = os.path.relpath(TRANSLATED_PATH, start=os.getcwd())
 
 TRANSLATED_DATASET_ID = "dangbert/alpaca-cleaned-nl"  # where to upload on hugging face
 
+# limits for packing samples into a single translate_text() request
+#   https://developers.deepl.com/docs/resources/usage-limits
+MAX_TEXTS_PER_REQUEST = 50
+MAX_CHARS_PER_REQUEST = 100_000  # (request size limit is 128 KiB)
+TRANSLATE_REQUESTS_PER_MIN = 300
+
 logger = config.get_logger(__name__, level="INFO")
 
 
@@ -57,6 +66,12 @@ def main():
         default=100,
         help="max number of samples to translate (only applicable alongside --translate)",
     )
+    parser.add_argument(
+        "--max-workers",
+        type=int,
+        default=4,
+        help="max number of concurrent translation requests (only applicable alongside --translate)",
+    )
     parser.add_argument(
         "--dump",
         type=str,
@@ -64,6 +79,11 @@ def main():
         metavar=("filename", "start_index", "stop_index"),
         help="Dump source dataset entries to a docx or text file with the specified filename, starting from the specified index and ending before the stop_index (exclusive).",
     )
+    parser.add_argument(
+        "--max-chars-per-file",
+        type=int,
+        help="Split the --dump output into multiple files of at most this many characters (e.g. to stay within DeepL's document limits).",
+    )
 
     parser.add_argument(
         "--deserialize",
@@ -98,6 +118,7 @@ def main():
         type=str,
         help="Upload provided .jsonl file to hugging face hub, replacing the existing dataset '{TRANSLATED_DATASET_ID}'",
     )
+    budget.add_budget_args(parser)  # (only applicable alongside --translate)
 
     args = parser.parse_args()
 
@@ -111,7 +132,12 @@ def main():
         sdataset = sdataset.add_column("orig_index", orig_indices)
 
         sdataset = sdataset.select(range(start_index, stop_index))
-        tutils.serialize_dataset(sdataset, filename, assert_sanity=False)
+        tutils.serialize_dataset(
+            sdataset,
+            filename,
+            assert_sanity=False,
+            max_chars_per_file=args.max_chars_per_file,
+        )
         return
 
     if args.deserialize:
@@ -125,16 +151,25 @@ def main():
                 logger.info(f"skipping already deserialized file: '{fname}'")
                 continue
             logger.info(f"converting '{fname}' -> '{outname}'")
-            cur_dataset = tutils.deserialize_dataset(fname)
-            cur_dataset.to_json(outname)
+            tutils.deserialize_to_jsonl(fname, outname)
         return
 
     if args.translate:
         sdataset, orig_indices = get_shuffled_dataset()
         sdataset = sdataset.add_column("orig_index", orig_indices)
 
-        _ = estimate_budget()
-        translate_dataset(sdataset, TRANSLATED_PATH, max_samples=args.max_samples)
+        _ = estimate_budget(sdataset)
+        projection = plan_translation(
+            sdataset, TRANSLATED_PATH, args.max_samples, max_workers=args.max_workers
+        )
+        if not budget.check_run(projection, args):
+            return
+        translate_dataset(
+            sdataset,
+            TRANSLATED_PATH,
+            max_samples=args.max_samples,
+            max_workers=args.max_workers,
+        )
         if not args.upload:
             return
 
@@ -263,26 +298,31 @@ def get_shuffled_dataset():
     return sdataset, indices
 
 
-def estimate_budget(translate_budget: int = 500_000) -> int:
-    """Estimate number of samples that can be translated with a given budget."""
-    sdataset, orig_indices = get_shuffled_dataset()
-    print(f"{orig_indices[:5]=}")
-    print(sdataset.column_names)
-
-    count = 0
-    budget = translate_budget
-    for item in sdataset:
-        if budget <= 0:
-            count -= 1 if budget < 0 else 0
-            break
-        for col_name in COL_NAMES:
-            budget -= len(item[col_name])
-        count += 1
+def estimate_budget(sdataset: Dataset, translate_budget: int = 500_000) -> int:
+    """Estimate number of samples (of the shuffled dataset) that can be translated with a given character budget."""
+    # count characters column-wise (rather than iterating over rows)
+    chars = np.zeros(len(sdataset), dtype=np.int64)
+    for col_name in COL_NAMES:
+        chars += np.fromiter((len(x) for x in sdataset[col_name]), dtype=np.int64)
+    count = int(np.searchsorted(np.cumsum(chars), translate_budget, side="right"))
 
     print(f"translate_budget={translate_budget:,} allows for {count:,} samples!\n")
     return count
 
 
+def plan_translation(
+    sdataset: Dataset, disk_path: str, max_samples: int, max_workers: int = 1
+) -> budget.Projection:
+    """Project the cost and time of translate_dataset() (considering samples translated in previous runs)."""
+    journal = TranslationJournal(disk_path)
+    samples = _untranslated_samples(sdataset, journal, max_samples)
+    # (empty fields aren't translated)
+    texts = [text for sample in samples for text in _texts_to_translate(sample)]
+    return budget.plan_translation(
+        texts, requests=sum(1 for _ in pack_batches(samples)), concurrency=max_workers
+    )
+
+
 class DUMMYResult:
     text: str = "Hallo, wereld!"
     detected_source_lang: str = "EN"
@@ -297,77 +337,207 @@ def load_local_dataset(disk_path: str) -> Tuple:
     return tdataset, tdataset_dict
 
 
-def translate_dataset(dataset, disk_path: str, max_samples: int):
+class TranslationJournal:
+    """
+    Append-only JSON lines file of translated samples (the translated dataset itself).
+    Samples are appended as soon as they're translated, so an interrupted run can be resumed from this file alone.
+    """
+
+    def __init__(self, fname: str):
+        self.fname = fname
+        self.completed_indices: set[int] = set()
+        self._file: Optional[TextIO] = None
+        self._valid_bytes = 0  # size of the file excluding any partially written sample
+        self._needs_newline = False
+        if not os.path.exists(fname):
+            return
+
+        with open(fname, "rb") as f:
+            for line_num, line in enumerate(f, start=1):
+                if line.strip() != b"":
+                    try:
+                        sample = json.loads(line)
+                    except ValueError:
+                        if not line.endswith(b"\n"):
+                            break  # last line partially written before a crash (dropped by add())
+                        # (not truncating the file, which would drop every translated sample after it)
+                        raise ValueError(
+                            f"invalid JSON on line {line_num} of '{fname}', please fix or remove it"
+                        )
+                    self.completed_indices.add(sample["orig_index"])
+                self._valid_bytes += len(line)
+                self._needs_newline = not line.endswith(b"\n")
+
+    def add(self, sample: dict):
+        if self._file is None:
+            if os.path.exists(self.fname):
+                if os.path.getsize(self.fname) > self._valid_bytes:
+                    logger.warning(
+                        f"dropping partially written sample from '{self.fname}'"
+                    )
+                    os.truncate(self.fname, self._valid_bytes)
+            self._file = open(self.fname, "a")
+            if self._needs_newline:
+                self._file.write("\n")
+        self._file.write(json.dumps(sample) + "\n")
+        self._file.flush()
+        self.completed_indices.add(sample["orig_index"])
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def _texts_to_translate(sample: dict) -> list[str]:
+    # skip translating empty fields
+    return [sample[c] for c in COL_NAMES if sample[c].strip() != ""]
+
+
+def _untranslated_samples(
+    dataset, journal: TranslationJournal, max_samples: int
+) -> list[dict]:
+    # considering previous run(s) may have left some gaps in the rows translated
+    indices = [
+        i
+        for i, orig_index in enumerate(dataset["orig_index"])
+        if orig_index not in journal.completed_indices
+    ][:max_samples]
+    return list(dataset.select(indices))
+
+
+def pack_batches(
+    samples: Iterable[dict],
+    max_texts: int = MAX_TEXTS_PER_REQUEST,
+    max_chars: int = MAX_CHARS_PER_REQUEST,
+) -> Iterator[list[dict]]:
+    """Pack samples into batches that can each be translated in a single request."""
+    batch: list[dict] = []
+    num_texts, num_chars = 0, 0
+    for sample in samples:
+        texts = _texts_to_translate(sample)
+        chars = sum(len(text) for text in texts)
+        if batch and (
+            num_texts + len(texts) > max_texts or num_chars + chars > max_chars
+        ):
+            yield batch
+            batch, num_texts, num_chars = [], 0, 0
+        batch.append(sample)
+        num_texts += len(texts)
+        num_chars += chars
+    if batch:
+        yield batch
+
+
+def translate_batch(translator: deepl.Translator, batch: list[dict]) -> list[dict]:
+    """
+    Translate a batch of samples in a single request (if possible), halving the batch on failure.
+    Returns the translated samples (omitting any samples that failed on their own).
+    """
+    texts = [text for sample in batch for text in _texts_to_translate(sample)]
+    try:
+        res = translator.translate_text(texts, target_lang="NL") if texts else []
+        # res = [DUMMYResult() for _ in texts] # for testing
+    except (
+        deepl.AuthorizationException,
+        deepl.QuotaExceededException,
+        deepl.TooManyRequestsException,
+    ):
+        raise  # (smaller batches won't help)
+    except deepl.DeepLException as e:
+        if len(batch) == 1:
+            # (skipped, so it's retried upon rerunning)
+            logger.error(f"failed to translate sample {batch[0]['orig_index']}: {e}")
+            return []
+        logger.warning(f"failed to translate batch of {len(batch)} samples ({e})")
+        mid = len(batch) // 2
+        return translate_batch(translator, batch[:mid]) + translate_batch(
+            translator, batch[mid:]
+        )
+
+    # populate translated samples (considering some columns may have been skipped)
+    # (a list of results, given a list of texts)
+    results = iter(res if isinstance(res, list) else [res])
+    translated = []
+    for sample in batch:
+        tsample = {
+            c: sample[c] if sample[c].strip() == "" else next(results).text
+            for c in COL_NAMES
+        }
+        tsample["orig_index"] = sample["orig_index"]
+        translated.append(tsample)
+    return translated
+
+
+def translate_dataset(
+    dataset,
+    disk_path: str,
+    max_samples: int,
+    translator: Optional[deepl.Translator] = None,
+    max_workers: int = 4,
+    requests_per_min: float = TRANSLATE_REQUESTS_PER_MIN,
+) -> int:
     """
-    Translates the provided dataset, writing the results to disk.
+    Translates the provided dataset, appending the results to disk (as a JSON lines file).
     Rerunning this function will automatically resume from where it left off.
+    Samples are packed into batches (see pack_batches()), which are translated concurrently.
+    Returns the number of samples newly translated.
 
     max_samples: maximum number of samples to translate before quitting (one sample has len(COL_NAMES) columns
     """
     assert disk_path.endswith(".jsonl") or disk_path.endswith(".json")
+    journal = TranslationJournal(disk_path)
+    logger.info(
+        f"existing translation dataset has {len(journal.completed_indices)} samples"
+    )
+    samples = _untranslated_samples(dataset, journal, max_samples)
+    batches = list(pack_batches(samples))
+    logger.info(f"translating {len(samples)} samples in {len(batches)} batches")
 
-    extra_cols = ["orig_index"]
-    tdataset_dict: dict = {c: [] for c in COL_NAMES + extra_cols}  # translated dataset
-    if os.path.exists(disk_path):
-        # load existing translated dataset
-        tdataset, tdataset_dict = load_local_dataset(disk_path)
-        logger.info(f"existing translation dataset has {len(tdataset)} samples")
-    assert tdataset_dict.keys() == set(
-        COL_NAMES + extra_cols
-    ), f"unexpected columns in dataset: {tdataset_dict.keys()}"
-
-    def flush_translated_dataset(tdataset_dict):
-        # note: .to_json(disk_path, indent=2) makes it more readable but leads to problems reloading later :(
-        Dataset.from_dict(tdataset_dict).to_json(disk_path)
+    if translator is None:
+        translator = deepl.Translator(config.get_settings().deepl_api_key)
+    rate_limiter = gpt.RateLimiter(requests_per_min)
 
-    translator = deepl.Translator(config.get_settings().deepl_api_key)
+    def translate(batch: list[dict]) -> list[dict]:
+        rate_limiter.acquire()
+        return translate_batch(translator, batch)
 
-    # translated dataset until stop condition, considering previous run could may have some gaps in the rows translated
+    # work queue: futures are only consumed here (so journal writes stay on this thread)
     translate_count = 0  # num samples newly translated
-    i = 0
-    completed_indices = set(tdataset_dict["orig_index"])
-    while translate_count < max_samples and i < len(dataset):
-        sample = dataset[i]
-        logger.debug(f"processing sample {i} (orig_index={sample['orig_index']})")
-        if sample["orig_index"] in completed_indices:
-            i += 1
-            continue
-
-        # skip translating empty fields
-        results = {c: sample[c] for c in COL_NAMES if sample[c].strip() == ""}
-        batch = [sample[c] for c in COL_NAMES if c not in results]
-
-        logger.debug(f"translating batch of {len(batch)} entries")
-        try:
-            res = translator.translate_text(batch, target_lang="NL")
-            # res = [DUMMYResult() for _ in batch] # for testing
-        except Exception as e:
-            logger.error(f"failed to translate batch, stopping early: {e}")
-            break
-
-        translate_count += 1
-        completed_indices.add(sample["orig_index"])
-
-        # populate results dict with translations (considering some columns may have been skipped)
-        res_idx = 0
-        for c in COL_NAMES:
-            if c not in results:
-                results[c] = res[res_idx].text
-                res_idx += 1
-            tdataset_dict[c].append(results[c])
-        tdataset_dict["orig_index"].append(sample["orig_index"])
-        # source_langs = sorted(list(set(r.detected_source_lang for r in res)))
-        # tdataset_dict["detected_source_lang"].append(",".join(source_langs))
-
-        if translate_count % 10 == 0:
-            logger.info(f"translated {translate_count} samples so far")
-            flush_translated_dataset(tdataset_dict)
-            logger.debug(f"flushed dataset to '{disk_path}' (row {i})")
-
-    flush_translated_dataset(tdataset_dict)
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    pending: dict[Future, list[dict]] = {}
+    try:
+        for batch in batches:
+            pending[executor.submit(translate, batch)] = batch
+        while len(pending) > 0:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                batch = pending.pop(future)
+                try:
+                    translated = future.result()
+                except (deepl.AuthorizationException, deepl.QuotaExceededException):
+                    raise
+                except Exception as e:
+                    # (these samples will be retried upon rerunning)
+                    logger.error(f"failed to translate {len(batch)} samples: {e}")
+                    continue
+                for tsample in translated:
+                    journal.add(tsample)
+                prev_count = translate_count
+                translate_count += len(translated)
+                if translate_count // 100 > prev_count // 100:
+                    logger.info(f"translated {translate_count} samples so far")
+    except (deepl.AuthorizationException, deepl.QuotaExceededException) as e:
+        logger.error(f"failed to translate batch, stopping early: {e}")
+    finally:
+        # don't start queued batches if stopping early
+        executor.shutdown(wait=True, cancel_futures=True)
+        journal.close()
+
     logger.info(
-        f"final flush complete! (Translated {translate_count} new samples -> total of {len(tdataset_dict[COL_NAMES[0]])} samples translated now)"
+        f"translation complete! (Translated {translate_count} new samples -> total of {len(journal.completed_indices)} samples translated now)"
     )
+    return translate_count
 
 
 if __name__ == "__main__":
@@ -1,6 +1,8 @@
 import os
 import sys
 import re
+import json
+from typing import Iterable, Iterator, Optional
 import docx
 from datasets import Dataset
 
@@ -18,6 +20,14 @@ EQQ = r"[=]{2,}"  # 2 or more equals signs
 PATTERN_EXP = rf"<{EQQ}@(\d+){EQQ}>\s*<{EQQ}0{EQQ}>(.*?)</{EQQ}0{EQQ}>\s*<{EQQ}1{EQQ}>(.*?)</{EQQ}1{EQQ}>\s*<{EQQ}2{EQQ}>(.*?)</{EQQ}2{EQQ}>\s*</{EQQ}@\1{EQQ}>"
 
 
+# compiled once (patterns are used for every sample)
+PATTERN = re.compile(PATTERN_EXP, re.DOTALL)
+END_PATTERN = re.compile(rf"</{EQQ}@\d+{EQQ}>")
+START_PATTERN = re.compile(rf"<{EQQ}@\d+{EQQ}>")
+# any (start or end) marker, e.g. "<===1===>" or "</===@42===>"
+MARKER_PATTERN = re.compile(rf"</?{EQQ}@?\d+{EQQ}>")
+
+
 def serialize_sample(data: dict) -> str:
     """
     Convert a dictionary into a custom string format as specified.
@@ -28,72 +38,126 @@ def serialize_sample(data: dict) -> str:
     # remove "orig_index"
     keys.remove("orig_index")  # e.g. ["input", "instruction", "output"]
     serialized_str = f"<===@{data['orig_index']}===>\n"
-    for key in keys:
-        idx = keys.index(key)
+    for idx, key in enumerate(keys):
         serialized_str += f"<==={idx}===>{data[key]}</==={idx}===>\n"
     serialized_str += f"</===@{data['orig_index']}===>"
     return serialized_str
 
 
+def _sample_from_match(match: re.Match) -> dict:
+    orig_index, input_str, instruction, output = match.groups()
+    return {
+        "orig_index": int(orig_index),
+        "output": output.strip(),
+        "input": input_str.strip(),
+        "instruction": instruction.strip(),
+    }
+
+
 def deserialize_sample(data_str: str) -> dict:
     """
     Convert the custom string format back into a dictionary.
     """
-    import re
-
-    match = re.match(PATTERN_EXP, data_str, re.DOTALL)
+    match = PATTERN.match(data_str)
     if match:
-        orig_index, input_str, instruction, output = match.groups()
-        return {
-            "orig_index": int(orig_index),
-            "output": output.strip(),
-            "input": input_str.strip(),
-            "instruction": instruction.strip(),
-        }
+        return _sample_from_match(match)
     raise ValueError("String does not match the expected format")
 
 
-def serialize_dataset(dataset, fname: str, assert_sanity: bool = False):
-    """Serialize dataset to a text file or a Word (.docx) document."""
+def _is_encodable(data: dict) -> bool:
+    """Whether a sample survives serialization (without the cost of a round trip)."""
+    return all(
+        data[key] == data[key].strip() and MARKER_PATTERN.search(data[key]) is None
+        for key in data
+        if key != "orig_index"
+    )
+
+
+def serialize_dataset(
+    dataset,
+    fname: str,
+    assert_sanity: bool = False,
+    max_chars_per_file: Optional[int] = None,
+) -> list[str]:
+    """
+    Serialize dataset to a text file or a Word (.docx) document, one sample at a time.
+    If max_chars_per_file is provided (e.g. for DeepL document size limits) the output is split into
+    multiple files (named like '<fname>_part<n>.docx'). Returns the names of the written files.
+    assert_sanity: verify each sample with a full round trip (otherwise a cheaper check is used).
+    """
     bad_count = 0
     char_count = 0
+    total = 0
+    root, ext = os.path.splitext(fname)
+    is_docx = ext.lower() == ".docx"
+    fnames: list[str] = []
+    part: Optional[_PartWriter] = None
 
-    def process_item(item: dict):
-        nonlocal bad_count
-        nonlocal char_count
+    for item in dataset:
         cereal = serialize_sample(item)
-        if not deserialize_sample(cereal) == item:
+        if assert_sanity:
+            assert deserialize_sample(cereal) == item
+        elif not _is_encodable(item):
             bad_count += 1
-            if assert_sanity:
-                assert deserialize_sample(cereal) == item
-        char_count += len(cereal)
-        return cereal
-
-    if fname.endswith(".docx"):
-        document = docx.Document()
-        for i, item in enumerate(dataset):
-            cereal = process_item(item)
-            document.add_paragraph(cereal)
-            # if i % 10 == 0:
-            #     document.add_page_break()
-            #     document.add_paragraph("")
-        document.save(fname)
-
-    else:
-        with open(fname, "w") as f:
-            for item in dataset:
-                cereal = process_item(item)
-                f.write(cereal + "\n")
-                char_count += 1  # for newline
+        total += 1
+
+        size = len(cereal) + 1  # (including newline)
+        if (
+            part is not None
+            and max_chars_per_file
+            and part.chars + size > max_chars_per_file
+        ):
+            part.close()
+            part = None
+        if part is None:
+            part_fname = (
+                fname
+                if not max_chars_per_file
+                else f"{root}_part{len(fnames) + 1}{ext}"
+            )
+            part = _PartWriter(part_fname, is_docx)
+            fnames.append(part_fname)
+        part.write(cereal)
+        char_count += size
+
+    if part is None:  # (empty dataset)
+        part = _PartWriter(fname, is_docx)
+        fnames.append(fname)
+    part.close()
 
     if bad_count > 0:
-        logger.warning(
-            f"Failed to perfectly encode: {bad_count}/{len(dataset)} samples"
-        )
-    filesize = _get_filesize_mb(fname)
+        logger.warning(f"Failed to perfectly encode: {bad_count}/{total} samples")
+    filesize = sum(_get_filesize_mb(f) for f in fnames)
     logger.info(
-        f"Serialized dataset to '{fname}' ({char_count:,} total chars), {filesize:.3f} MB"
+        f"Serialized dataset to {len(fnames)} file(s) '{fnames[0]}'... ({char_count:,} total chars), {filesize:.3f} MB"
     )
+    return fnames
+
+
+class _PartWriter:
+    """Writes serialized samples to a single (text or docx) file."""
+
+    def __init__(self, fname: str, is_docx: bool):
+        self.fname = fname
+        self.chars = 0
+        self.document = docx.Document() if is_docx else None
+        self.file = None if is_docx else open(fname, "w")
+
+    def write(self, cereal: str):
+        if self.document is not None:
+            self.document.add_paragraph(cereal)
+        else:
+            assert self.file is not None, "writer already closed"
+            self.file.write(cereal + "\n")
+        self.chars += len(cereal) + 1
+
+    def close(self):
+        if self.document is not None:
+            self.document.save(self.fname)
+            self.document = None
+        elif self.file is not None:
+            self.file.close()
+            self.file = None
 
 
 def _get_filesize_mb(filepath: str) -> float:
@@ -105,29 +169,58 @@ def _get_filesize_mb(filepath: str) -> float:
     return filesize_mb
 
 
-def deserialize_dataset(fname: str) -> Dataset:
+def parse_samples(chunks: Iterable[str]) -> Iterator[dict]:
     """
-    Deserialize dataset from a text or Word (.docx) file using pattern matching.
-    Afterwards calling this function you can write the dataset to a .jsonl file with
-    dataset.to_json("/tmp/tmp.jsonl")
+    Parse serialized samples from a stream of text chunks (e.g. paragraphs or lines, excluding newlines),
+    only buffering the text of the sample currently being parsed.
     """
-    dlist = []
+    buffer = ""
+    for chunk in chunks:
+        buffer += chunk + "\n"
+        while (end := END_PATTERN.search(buffer)) is not None:
+            match = PATTERN.search(buffer, 0, end.end())
+            if match is not None:
+                yield _sample_from_match(match)
+            else:
+                logger.warning(
+                    f"skipping malformed sample ending with '{end.group(0)}'"
+                )
+            buffer = buffer[end.end() :]
+        if START_PATTERN.search(buffer) is None:
+            buffer = ""  # (no sample in progress)
+
+
+def iter_deserialize(fname: str) -> Iterator[dict]:
+    """Deserialize samples from a text or Word (.docx) file, one paragraph at a time."""
     if fname.lower().endswith(".docx"):
         logger.info(f"loading dataset from a Word document: '{fname}'")
         document = docx.Document(fname)
-        data_str = "\n".join([p.text for p in document.paragraphs])
+        yield from parse_samples(p.text for p in document.paragraphs)
     else:
         logger.info(f"loading dataset from a text file: '{fname}'")
         with open(fname, "r") as f:
-            data_str = f.read()
+            yield from parse_samples(line.rstrip("\n") for line in f)
 
-    pattern = re.compile(PATTERN_EXP, re.DOTALL)
-    matches = pattern.finditer(data_str)
-    for match in matches:
-        serialized_sample = match.group(0)  # Extract the entire matched sample block
-        deserialized_dict = deserialize_sample(serialized_sample)
-        dlist.append(deserialized_dict)
 
-    dataset = Dataset.from_list(dlist)
+def deserialize_dataset(fname: str) -> Dataset:
+    """
+    Deserialize dataset from a text or Word (.docx) file using pattern matching.
+    Afterwards calling this function you can write the dataset to a .jsonl file with
+    dataset.to_json("/tmp/tmp.jsonl") (or use deserialize_to_jsonl() directly).
+    """
+    dataset = Dataset.from_list(list(iter_deserialize(fname)))
     logger.info(f"Deserialized dataset with {len(dataset)} rows")
     return dataset
+
+
+def deserialize_to_jsonl(fname: str, out_fname: str) -> int:
+    """Deserialize samples from a text or Word (.docx) file to a .jsonl file incrementally, returning the sample count."""
+    count = 0
+    tmp_fname = out_fname + ".tmp"
+    with open(tmp_fname, "w") as f:
+        for sample in iter_deserialize(fname):
+            f.write(json.dumps(sample) + "\n")
+            count += 1
+    os.replace(tmp_fname, out_fname)  # (so a partial file is never left behind)
+    logger.info(f"Deserialized {count} samples to '{out_fname}'")
+    return count
@@ -1,21 +1,25 @@
 #!/usr/bin/env python3
 
 import argparse
-import json
 import pandas as pd
 import os
 import matplotlib.pyplot as plt
 import seaborn as sns
 
+import budget
 import config
 import gpt
 import prompts as promptlib
 from prompts import SMARTFeedback, SMARTResponse
-from typing import Optional
+from typing import Iterable, List, Optional
 from synthetic_smart import add_ids
+from results_store import ResultsStore, FEEDBACK_EXPERIMENT
 
 logger = config.get_logger(__name__)
 
+# expected (average) length of a feedback response, for projecting the cost of a run
+EXPECTED_OUTPUT_TOKENS = 400
+
 
 def main():
     parser = argparse.ArgumentParser(
@@ -43,13 +47,24 @@ def main():
         default=2,
         help="Max number of feedback generation iterations (given invalid response formats).",
     )
+    parser.add_argument(
+        "--max-workers",
+        type=int,
+        default=8,
+        help="Max number of concurrent API requests.",
+    )
+    parser.add_argument(
+        "--export-excel",
+        action="store_true",
+        help="Also export the feedback of all models to 'feedback.xlsx' (with a sheet per model).",
+    )
+    budget.add_budget_args(parser)
 
     legacy_feedback_format = (
         False  # whether to request/expect feedback in SMARTFeedback model format
     )
 
     args = parser.parse_args()
-    config.source_dot_env()  # read api key
 
     assert os.path.isdir(args.input_dir)
     fname = os.path.join(args.input_dir, "smart_goals.csv")
@@ -59,21 +74,39 @@ def main():
     feedback_path = os.path.join(args.input_dir, "feedback.xlsx")
     base_dot_path = args.input_dir + f".feedback_{args.model}"
 
-    bkp_path = base_dot_path + ".output.json.bkp"
-    feedback_df = config.safe_read_sheet(feedback_path, args.model)
+    # validated outputs are journaled as they're generated (so an interrupted run can be resumed)
+    journal_path = base_dot_path + ".journal.jsonl"
+    store = ResultsStore(os.path.join(args.input_dir, "results"))
+    store.import_excel(feedback_path, FEEDBACK_EXPERIMENT)  # legacy results (if any)
+    feedback_df = store.read(FEEDBACK_EXPERIMENT, args.model)
 
     if feedback_df is not None:
         print("reloaded existing feedback!")
     else:
+        # project the cost of the prompts not yet in the journal (from an interrupted run)
+        journal = gpt.PromptJournal(journal_path)
+        prompts = build_feedback_prompts(goals_df["smart"], goals_df["plan"])
+        projection = budget.plan_gpt(
+            [p for p in prompts if journal.get(p) is None],
+            args.model,
+            expected_output_tokens=EXPECTED_OUTPUT_TOKENS,
+            concurrency=args.max_workers,
+            max_retries=args.max_retries,
+        )
+        if not budget.check_run(projection, args):
+            return
+
+        config.source_dot_env()  # read api key
         config.args_to_dict(args, fname=base_dot_path + ".config.json")
         feedback_df = get_feedback(
-            goals_df, args, bkp_path=bkp_path, validate=legacy_feedback_format
+            goals_df, args, journal=journal, validate=legacy_feedback_format
         )
-        assert config.safe_append_sheet(feedback_df, args.model, feedback_path)
-
         if legacy_feedback_format:
             feedback_df = extend_outputs(feedback_df)
-            assert config.safe_append_sheet(feedback_df, args.model, feedback_path)
+        store.write(feedback_df, FEEDBACK_EXPERIMENT, args.model)
+
+    if args.export_excel:
+        store.export_excel(FEEDBACK_EXPERIMENT, feedback_path)
 
     if not legacy_feedback_format:
         logger.info("skipping feedback score plots")
@@ -89,18 +122,23 @@ def main():
     plot_comparisons(full_df, fname=base_path + "__comparison.pdf")
 
 
-def add_feedback_prompt(row: pd.Series) -> str:
-    """Given row with smart goal and plan, construct prompt for feedback generation."""
-    # json_schema = SMARTFeedback.model_json_schema()
-    draft = SMARTResponse(smart=row["smart"], plan=row["plan"])
-    prompt = promptlib.PROMPT_SMART_FEEDBACK_TEXT_ONLY.format(
+def build_feedback_prompts(smarts: Iterable[str], plans: Iterable[str]) -> list[str]:
+    """Given columns of smart goals and plans, construct prompts for feedback generation."""
+    # fill in the (row independent) parts of the template once, splitting around the goal and plan
+    filled = promptlib.PROMPT_SMART_FEEDBACK_TEXT_ONLY.format(
         FEEDBACK_PRINCIPLES=promptlib.FEEDBACK_PRINCIPLES,
         SMART_RUBRIC=promptlib.SMART_RUBRIC,
-        learning_goal=draft.smart,
-        action_plan=draft.plan,
+        learning_goal="\0",
+        action_plan="\0",
         language="Dutch",
     )
-    return prompt
+    before, between, after = filled.split("\0")
+    return [
+        before + draft.smart + between + draft.plan + after
+        for draft in (
+            SMARTResponse(smart=smart, plan=plan) for smart, plan in zip(smarts, plans)
+        )
+    ]
 
 
 def clean_attr(attr: str) -> str:
@@ -110,7 +148,7 @@ def clean_attr(attr: str) -> str:
 def get_feedback(
     df: pd.DataFrame,
     args: argparse.Namespace,
-    bkp_path: Optional[str] = None,
+    journal: Optional[str | gpt.PromptJournal] = None,
     validate: bool = False,  # whether to validate feedback against SMARTFeedback model
 ) -> pd.DataFrame:
     """
@@ -121,7 +159,7 @@ def get_feedback(
     # feedback data
     data = {
         "goal_id": df["goal_id"].to_list(),
-        "prompt": df.apply(add_feedback_prompt, axis=1).to_list(),
+        "prompt": build_feedback_prompts(df["smart"], df["plan"]),
     }
 
     def validator(text: str):
@@ -132,21 +170,22 @@ def get_feedback(
         return True
 
     model = gpt.GPTModel(args.model)
-    logger.debug(f"validator enabled: {validate}")
+    logger.debug(
+        f"validator enabled: {validate} (structured outputs: {model.supports_structured_outputs})"
+    )
     logger.info(
         f"prompting {len(data['prompt'])} feedback prompts for model '{args.model}'"
     )
-    outputs, total_price, total_calls = gpt.auto_reprompt(
+    outputs, total_price, total_calls, items = gpt.auto_reprompt(
         validator if validate else noop_validator,
         args.max_retries,
         model,
         data["prompt"],
+        journal=journal,
+        max_workers=args.max_workers,
+        response_model=SMARTFeedback if validate else None,
     )
 
-    if bkp_path is not None:  # backup just in case
-        with open(bkp_path, "w") as f:
-            json.dump(outputs, f, indent=2)
-
     if total_calls > len(data["prompt"]):
         logger.warning(
             f"{total_calls - len(data['prompt'])} extra generation calls needed while processing {len(data['prompt'])} prompts"
@@ -159,6 +198,9 @@ def get_feedback(
 
     print("\nfeedback generation summary:")
     print(f"total generation calls: {total_calls}")
+    print(
+        f"max attempts for a single prompt: {max((i.attempts for i in items), default=0)}"
+    )
     print(f"final parse errors: {len(error_indices)}, error_indices: {error_indices}")
     print(f"total price: ${total_price:.3f}")
     # assert len(error_indices) == 0
@@ -172,20 +214,29 @@ def extend_outputs(feedback_df: pd.DataFrame) -> pd.DataFrame:
         logger.info("feedback_df already has extended columns, skipping regeneration")
         return feedback_df
 
-    feedback_objs = [
-        promptlib.parse_pydantic(text, SMARTFeedback)
-        for text in feedback_df["response"]
-    ]
-    fdata = {}  # feedback data
-    for attr in promptlib.SMART:
-        attr = clean_attr(attr)
-        fdata["overall_feedback"] = [obj.overall_feedback for obj in feedback_objs]
-        fdata[f"feedback_{attr}"] = [
-            getattr(obj, attr).feedback for obj in feedback_objs
-        ]
-        fdata[f"score_{attr}"] = [getattr(obj, attr).score for obj in feedback_objs]
-    full_df = pd.concat([feedback_df, pd.DataFrame(fdata)], axis=1)
-    return full_df
+    attrs = [clean_attr(attr) for attr in promptlib.SMART]
+    columns = ["overall_feedback"]
+    for attr in attrs:
+        columns += [f"feedback_{attr}", f"score_{attr}"]
+
+    # parse each response once (leaving missing values where parsing fails)
+    records: List[dict] = []
+    for text in feedback_df["response"]:
+        obj = promptlib.parse_pydantic(text, SMARTFeedback)
+        if not isinstance(obj, SMARTFeedback):
+            records.append({})
+            continue
+        record = {"overall_feedback": obj.overall_feedback}
+        for attr in attrs:
+            attr_obj = getattr(obj, attr)
+            record[f"feedback_{attr}"] = attr_obj.feedback
+            record[f"score_{attr}"] = attr_obj.score
+        records.append(record)
+
+    fdata = pd.DataFrame.from_records(records, columns=columns, index=feedback_df.index)
+    score_cols = [f"score_{attr}" for attr in attrs]
+    fdata[score_cols] = fdata[score_cols].astype("Int64")
+    return pd.concat([feedback_df, fdata], axis=1)
 
 
 # MARK: plots
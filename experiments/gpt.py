@@ -1,8 +1,15 @@
 import os
+import hashlib
+import json
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass
 from openai import OpenAI
 from openai.types.chat.chat_completion import ChatCompletion
 from AbstractModel import AbstractModel, IPrompt
-from typing import List, Tuple, Optional, Callable
+from typing import Any, Dict, List, NamedTuple, Tuple, Type, Optional, Callable
+from pydantic import BaseModel
 import config
 
 logger = config.get_logger(__name__)
@@ -22,12 +29,65 @@ PRICES = {
     # https://platform.openai.com/docs/models/gpt-4-turbo-and-gpt-4
     "gpt-4-turbo-2024-04-09": [10.0, 30.0],
     "gpt-4-0125-preview": [10.0, 30.0],  # also turbo despite name
+    "gpt-4o-2024-08-06": [2.5, 10.0],
+    "gpt-4o-mini-2024-07-18": [0.15, 0.6],
 }
 
+# models supporting structured outputs (response_format with a strict json schema)
+#   https://platform.openai.com/docs/guides/structured-outputs/supported-models
+STRUCTURED_OUTPUT_MODELS = {"gpt-4o-2024-08-06", "gpt-4o-mini-2024-07-18"}
+
+# json schema keywords not supported by structured outputs (moved into descriptions instead)
+_UNSUPPORTED_SCHEMA_KEYWORDS = [
+    "minimum",
+    "maximum",
+    "exclusiveMinimum",
+    "exclusiveMaximum",
+    "multipleOf",
+    "minLength",
+    "maxLength",
+    "pattern",
+    "format",
+    "minItems",
+    "maxItems",
+]
+
 # convert to price / token
 PRICES = {k: [p / 1_000_000 for p in v] for k, v in PRICES.items()}
 
 
+def to_strict_schema(schema: Any) -> Any:
+    """
+    Convert (pydantic) json schema to one supported by structured outputs:
+    all properties required, no additional properties, and unsupported keywords moved into descriptions.
+    https://platform.openai.com/docs/guides/structured-outputs/supported-schemas
+    """
+    if isinstance(schema, list):
+        return [to_strict_schema(val) for val in schema]
+    if not isinstance(schema, dict):
+        return schema
+
+    res = dict(schema)
+    # recurse into subschemas (but not into the names of properties, which may be keywords such as "format")
+    for key in ("properties", "$defs"):
+        if key in res:
+            res[key] = {name: to_strict_schema(val) for name, val in res[key].items()}
+    for key in ("items", "anyOf", "allOf"):
+        if key in res:
+            res[key] = to_strict_schema(res[key])
+    res.pop("default", None)
+    constraints = [
+        f"{key}: {res.pop(key)}" for key in _UNSUPPORTED_SCHEMA_KEYWORDS if key in res
+    ]
+    if constraints:
+        description = res.get("description", res.get("title", ""))
+        res["description"] = f"{description} ({', '.join(constraints)})".strip()
+    if "properties" in schema:
+        res["required"] = list(schema["properties"].keys())
+        res["additionalProperties"] = False
+    return res
+
+
 class GPTModel(AbstractModel):
     def __init__(self, model_name: str = "gpt-3.5-turbo-0125"):
         self.model_name = model_name
@@ -35,6 +95,10 @@ class GPTModel(AbstractModel):
         if model_name not in PRICES.keys():
             logger.warning(f"price entry unknown for model '{model_name}'")
 
+    @property
+    def supports_structured_outputs(self) -> bool:
+        return self.model_name in STRUCTURED_OUTPUT_MODELS
+
     def __call__(
         self,
         prompts: List[IPrompt],
@@ -42,14 +106,27 @@ class GPTModel(AbstractModel):
         json_mode: bool = False,
         temperature: Optional[float] = 1,
         top_p: Optional[float] = None,
+        response_model: Optional[Type[BaseModel]] = None,
     ) -> Tuple[List[str], List[ChatCompletion]]:
         """
+        If response_model is provided (and supported by this model) outputs are constrained to its json schema.
+        Otherwise it's ignored (so outputs should still be validated e.g. with auto_reprompt).
         https://platform.openai.com/docs/api-reference/chat/create#chat-create-temperature
         https://community.openai.com/t/cheat-sheet-mastering-temperature-and-top-p-in-chatgpt-api/172683
         """
         assert isinstance(prompts, list)
-        extra_args = dict()
-        if json_mode:
+        extra_args: Dict[str, Any] = dict()
+        if response_model is not None and self.supports_structured_outputs:
+            # https://platform.openai.com/docs/guides/structured-outputs
+            extra_args["response_format"] = {
+                "type": "json_schema",
+                "json_schema": {
+                    "name": response_model.__name__,
+                    "schema": to_strict_schema(response_model.model_json_schema()),
+                    "strict": True,
+                },
+            }
+        elif json_mode:
             # https://platform.openai.com/docs/guides/text-generation/json-mode
             extra_args["response_format"] = {"type": "json_object"}
         if max_tokens is not None:
@@ -73,7 +150,11 @@ class GPTModel(AbstractModel):
                 messages=prompt,
                 **extra_args,
             )
-            raw_outputs.append(completion.choices[0].message.content)
+            message = completion.choices[0].message
+            if getattr(message, "refusal", None):
+                logger.warning(f"{self.model_name} refused prompt: {message.refusal}")
+            # (content is None when the model refused, which validators should reject)
+            raw_outputs.append(message.content or "")
             completions.append(completion)
         return raw_outputs, completions
 
@@ -85,10 +166,13 @@ class GPTModel(AbstractModel):
 
         total_price = 0.0
         for c in completions:
-            prompt_price, completion_price = PRICES[c.model]
             if c.model not in PRICES:
                 logger.warning(f"price entry unknown for model '{c.model}'")
                 continue
+            if c.usage is None:
+                logger.warning(f"usage unknown for completion '{c.id}'")
+                continue
+            prompt_price, completion_price = PRICES[c.model]
             total_price += (
                 prompt_price * c.usage.prompt_tokens
                 + completion_price * c.usage.completion_tokens
@@ -96,52 +180,146 @@ class GPTModel(AbstractModel):
         return total_price
 
 
+class PromptJournal:
+    """
+    Append-only JSON lines journal of validated outputs, keyed by prompt hash.
+    Allows resuming an interrupted auto_reprompt() run without repeat spend.
+    """
+
+    def __init__(self, fname: str):
+        self.fname = fname
+        self.outputs: Dict[str, str] = {}
+        if os.path.exists(fname):
+            with open(fname) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # e.g. line partially written before a crash
+                    self.outputs[entry["key"]] = entry["output"]
+            logger.info(f"loaded {len(self.outputs)} outputs from journal '{fname}'")
+
+    @staticmethod
+    def key(prompt: IPrompt) -> str:
+        return hashlib.sha256(json.dumps(prompt, sort_keys=True).encode()).hexdigest()
+
+    def get(self, prompt: IPrompt) -> Optional[str]:
+        return self.outputs.get(self.key(prompt))
+
+    def add(self, prompt: IPrompt, output: str, **meta):
+        key = self.key(prompt)
+        self.outputs[key] = output
+        with open(self.fname, "a") as f:
+            f.write(json.dumps({"key": key, "output": output, **meta}) + "\n")
+            f.flush()
+
+
+class RateLimiter:
+    """
+    Thread-safe limit on the request rate to a model (e.g. shared by concurrent auto_reprompt() calls).
+    https://platform.openai.com/docs/guides/rate-limits
+    """
+
+    def __init__(self, requests_per_min: float):
+        assert requests_per_min > 0
+        self.interval = 60.0 / requests_per_min
+        self._next_time = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Block until the next request may be sent."""
+        with self._lock:
+            now = time.monotonic()
+            wait_secs = self._next_time - now
+            self._next_time = max(now, self._next_time) + self.interval
+        if wait_secs > 0:
+            time.sleep(wait_secs)
+
+
+@dataclass
+class ItemStats:
+    """Generation stats of a single prompt in auto_reprompt()."""
+
+    attempts: int = 0  # 0 if output was reloaded from the journal
+    price: float = 0.0
+
+
+class RepromptResult(NamedTuple):
+    outputs: List[Optional[str]]  # None where no valid output was generated
+    total_price: float
+    total_calls: int
+    items: List[ItemStats]
+
+
 def auto_reprompt(
     validator: Callable,
     max_retries: int,
     model: GPTModel,
     prompts: List[IPrompt],
+    journal: Optional[str | PromptJournal] = None,
+    max_workers: int = 8,
+    rate_limiter: Optional[RateLimiter] = None,
     **kwargs,
-) -> Tuple[List[str], float, int]:
+) -> RepromptResult:
     """
-    Keep prompting model until validator function is happy or a depth of max_retries iterations are reached.
-    max_retries is the max number of retry iterations e.g. one retry would be: 3 failures in first batch -> second batch of length 3 which all validate
-    So in the worst case, one "retry" could mean the model is prompted twice with batch size len(prompts).
+    Prompt model (concurrently) until validator function is happy with the output of each prompt.
+    An invalid output is reprompted immediately, up to max_retries times for that prompt
+    (so a prompt is sent at most max_retries + 1 times).
+
+    If a journal (path) is provided, each validated output is appended to it as soon as it's generated,
+    and prompts already in the journal are skipped (so a crashed run can simply be restarted).
+    If a rate_limiter is provided, it's acquired before each API call.
     """
     assert isinstance(max_retries, int)
     assert isinstance(prompts, list)
+    if isinstance(journal, str):
+        journal = PromptJournal(journal)
+
+    outputs: List[Optional[str]] = [None] * len(prompts)
+    items = [ItemStats() for _ in prompts]
+
+    def generate(i: int) -> Tuple[str, float]:
+        if rate_limiter is not None:
+            rate_limiter.acquire()
+        cur_outputs, meta = model([prompts[i]], **kwargs)
+        return cur_outputs[0], model.compute_price(meta)
+
+    # work queue: futures are only consumed here (so journal writes stay on this thread)
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    pending: Dict[Future, int] = {}
+    try:
+        for i, prompt in enumerate(prompts):
+            if journal is not None and (journaled := journal.get(prompt)) is not None:
+                outputs[i] = journaled  # completed in a previous run
+                continue
+            pending[executor.submit(generate, i)] = i
+
+        while len(pending) > 0:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                i = pending.pop(future)
+                output, price = future.result()
+                items[i].attempts += 1
+                items[i].price += price
+                if validator(output):
+                    outputs[i] = output
+                    if journal is not None:
+                        journal.add(
+                            prompts[i],
+                            output,
+                            attempts=items[i].attempts,
+                            price=items[i].price,
+                        )
+                elif items[i].attempts <= max_retries:
+                    logger.debug(f"reprompting prompt {i} ({items[i].attempts=})")
+                    pending[executor.submit(generate, i)] = i
+    finally:
+        # don't start queued prompts if interrupted (e.g. by an API error)
+        executor.shutdown(wait=True, cancel_futures=True)
 
-    outputs, meta = model(prompts, **kwargs)
-    total_price = model.compute_price(meta)
-    total_calls = len(outputs)
-    # orig_outputs = outputs.copy()
-
-    # map indices to {new_prompt}
-    bad = {}
-    for i, response in enumerate(outputs):
-        if not validator(response):
-            bad[i] = {"new_prompt": prompts[i]}
-            outputs[i] = None
-
-    max_retries -= 1
-    if len(bad) == 0 or max_retries < 0:
-        return outputs, total_price, total_calls
-
-    new_prompts = [v["new_prompt"] for v in bad.values()]
-    logger.debug(f"reprompting {len(new_prompts)} prompts ({max_retries=})")
-    new_outputs, new_price, new_calls = auto_reprompt(
-        validator, max_retries, model, new_prompts, **kwargs
-    )
-    total_calls += new_calls
-
-    cur = 0
-    for i in range(len(outputs)):
-        if i in bad:
-            outputs[i] = new_outputs[cur]
-            cur += 1
-
-    total_price += new_price
-    return outputs, total_price, total_calls
+    total_calls = sum(item.attempts for item in items)
+    total_price = sum(item.price for item in items)
+    return RepromptResult(outputs, total_price, total_calls, items)
 
 
 def noop_validator(text: str):
@@ -6,6 +6,10 @@ from prompts.english import *  # noqa
 
 logger = config.get_logger(__name__)
 
+# question a model's (Dutch) feedback is considered an answer to when judging its fluency
+#   (shared by benchmark_matrix.py and tuner/recipes/generate.py)
+FLUENCY_QUESTION = "provide a paragraph of feedback in Dutch on a student's assignment."
+
 PROMPT_SYNTHETIC_SMART = """
 You're a student taking a course where you're tasked with writing a SMART goal defining your personal learning objective for the course.
 {SMART_RUBRIC}
@@ -1,7 +1,8 @@
 import re
 import json
-from pydantic import BaseModel, conint, Field, ValidationError
-from typing import Annotated, Union, Any
+from functools import lru_cache
+from pydantic import BaseModel, conint, Field, TypeAdapter, ValidationError
+from typing import Annotated, Union, Any, Iterator, Optional
 import config
 
 logger = config.get_logger(__name__)
@@ -28,60 +29,141 @@ class SMARTFeedback(BaseModel):
     overall_feedback: str
 
 
+# characters relevant to finding JSON objects in text (all other text is skipped over)
+_JSON_TOKEN_EXP = re.compile(r"[{}\"'\\]")
+_CLOSING_EXP = re.compile(r"\s*[}\]]")
+# JSON objects start with a (quoted) key or are empty (unlike e.g. "{placeholder}" in prose)
+_OBJECT_START_EXP = re.compile(r"{\s*[\"'}]")
+
+
+def iter_json_objects(text: str) -> Iterator[str]:
+    """
+    Yields the (top-level) brace-balanced {...} substrings of text in a single linear pass,
+    ignoring braces within strings (and surrounding text such as markdown code fences).
+    """
+    depth, start = 0, 0
+    quote: Optional[str] = None  # quote character of the string currently in
+    escape_pos = -1  # position of an escaped character (within a string)
+    for match in _JSON_TOKEN_EXP.finditer(text):
+        pos, char = match.start(), match.group()
+        if quote is not None:
+            if pos == escape_pos:
+                continue
+            if char == "\\":
+                escape_pos = pos + 1
+            elif char == quote:
+                quote = None
+        elif char == "{":
+            if depth == 0:
+                start = pos
+            depth += 1
+        elif depth == 0:
+            continue  # e.g. an apostrophe in text outside of JSON
+        elif char == "}":
+            depth -= 1
+            if depth == 0:
+                yield text[start : pos + 1]
+        elif char in "\"'":
+            quote = char
+
+
+def repair_json(json_str: str) -> str:
+    """Fix common quirks of LLM generated JSON: single quoted strings and trailing commas."""
+    res = []
+    quote: Optional[str] = None
+    i = 0
+    while i < len(json_str):
+        char = json_str[i]
+        if quote is None:
+            if char in "\"'":
+                quote = char
+                char = '"'
+            elif char == "," and _CLOSING_EXP.match(json_str, i + 1):
+                i += 1  # drop trailing comma
+                continue
+        elif char == "\\" and i + 1 < len(json_str):
+            nxt = json_str[i + 1]
+            # \' isn't a valid JSON escape
+            res.append(nxt if nxt == "'" else char + nxt)
+            i += 2
+            continue
+        elif char == quote:
+            quote, char = None, '"'
+        elif char == '"':
+            char = '\\"'  # double quote within a single quoted string
+        res.append(char)
+        i += 1
+    return "".join(res)
+
+
+@lru_cache(maxsize=None)
+def _get_adapter(SomeModel) -> TypeAdapter:
+    """Compiled validator for the given pydantic model (cached as building it is slow)."""
+    return TypeAdapter(SomeModel)
+
+
+def _is_json_error(e: ValidationError) -> bool:
+    return any(err["type"] == "json_invalid" for err in e.errors())
+
+
+def _validate_json(adapter: TypeAdapter, json_str: str, retry: bool) -> Union[Any, str]:
+    try:
+        return adapter.validate_json(json_str)
+    except ValidationError as e:
+        if not _is_json_error(e):
+            return f"validation error: {e}"
+        if not retry:
+            return f"failed to parse json string: {e}"
+
+    try:
+        return adapter.validate_json(repair_json(json_str))
+    except ValidationError as e:
+        if _is_json_error(e):
+            return f"failed to parse json string: {e}"
+        return f"validation error: {e}"
+
+
 def parseSMARTFeedback(response: str, retry: bool = False) -> SMARTFeedback:
     """
     Attempt to find the JSON substring in the response and parse it into a SMARTFeedback object.
     Raises jsonDecodeError or ValidationError on failure.
     """
-    json_str = re.search(r"{.*}", response, re.DOTALL).group()
+    json_str = next(iter_json_objects(response), None)
+    if json_str is None:
+        raise json.JSONDecodeError("no json object found", response, 0)
 
     try:
         data = json.loads(json_str)
     except json.JSONDecodeError as e:
-        is_quote_error = "Expecting property name enclosed in double quotes" in str(e)
-        if not retry or not is_quote_error:
+        if not retry:
             print("bad json_str:")
             print(json_str)
             raise e
-        if is_quote_error:
-            logger.warning(f"retrying with quote replacement: {response}")
-            # hacky fix for single quotes (better to avoid this in the first place)
-            tmp = response.replace("'", '"')
-            return parseSMARTFeedback(tmp, retry=False)
-    except ValidationError as e:
-        logger.error(f"validation error: {e}")
-        raise e
+        logger.warning(f"retrying with json repairs: {response}")
+        data = json.loads(repair_json(json_str))
 
-    # TODO: should also catch ValidationErorr here or replace this function with a call to parse_pydantic
-    feedback = SMARTFeedback(**data)
-    return feedback
+    return SMARTFeedback(**data)
 
 
-def parse_pydantic(text: str, SomeModel, retry: bool = False) -> Union[Any, str]:
+def parse_pydantic(
+    text: Optional[str], SomeModel, retry: bool = True
+) -> Union[Any, str]:
     """
-    Attempt to find a JSON substring in the given text and parse it into the provided pydantic model.
+    Attempt to find a JSON object in the given text and parse it into the provided pydantic model.
+    If retry, common JSON quirks (e.g. single quotes, trailing commas) are repaired.
     Returns string describing error on failure, or instance of SomeModel class on success.
     """
-    match = re.search(r"{.*}", text, re.DOTALL)
-    if match is None:
-        return "no json object found in text"
-    json_str = match.group()
     assert issubclass(SomeModel, BaseModel)
+    if not isinstance(text, str):
+        return "no text to parse"  # e.g. model refused to respond
+    adapter = _get_adapter(SomeModel)
 
-    try:
-        data = json.loads(json_str)
-    except json.JSONDecodeError as e:
-        is_quote_error = "Expecting property name enclosed in double quotes" in str(e)
-        if not retry or not is_quote_error:
-            return f"failed to parse json string: {e}"
-        if is_quote_error:
-            logger.warning(f"retrying with quote replacement: {text}")
-            # hacky fix for single quotes (better to avoid this in the first place)
-            tmp = json_str.replace("'", '"')
-            return parse_pydantic(tmp, retry=False)
-
-    try:
-        obj = SomeModel(**data)
-    except ValidationError as e:
-        return f"validation error: {e}"
-    return obj
+    error = None
+    for json_str in iter_json_objects(text):
+        if not _OBJECT_START_EXP.match(json_str):
+            continue
+        res = _validate_json(adapter, json_str, retry)
+        if not isinstance(res, str):
+            return res
+        error = error or res  # report error of the first object found
+    return error or "no json object found in text"
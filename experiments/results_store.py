@@ -0,0 +1,203 @@
+"""
+Columnar store for experiment results (e.g. generated feedback and judge benchmarks).
+
+Results are stored as partitioned Parquet files keyed by (experiment, model, judge):
+    <root>/experiment=<experiment>/model=<model>/judge=<judge>/part-<id>.parquet
+So appending results is O(1) (a new part file, rather than rewriting a whole Excel workbook),
+checking whether results exist is a directory lookup, and reads can be limited to the needed columns.
+Exporting to Excel (e.g. for sharing) is an optional final step, see ResultsStore.export_excel()
+"""
+
+import glob
+import os
+import shutil
+import time
+import uuid
+from typing import Optional
+from urllib.parse import quote, unquote
+import pandas as pd
+import config
+
+logger = config.get_logger(__name__)
+
+# experiment names used by feedback.py, benchmark.py and benchmark_matrix.py
+FEEDBACK_EXPERIMENT = "feedback"
+BENCHMARK_EXPERIMENT = "benchmark"
+FLUENCY_EXPERIMENT = "fluency"
+
+# partition value used when results have no judge (e.g. the generated feedback itself)
+NO_JUDGE = "__none__"
+
+
+def _encode(val: str) -> str:
+    # e.g. "meta-llama/Llama-2-7b" -> "meta-llama%2FLlama-2-7b"
+    return quote(val, safe="")
+
+
+class ResultsStore:
+    def __init__(self, root: str):
+        self.root = root
+
+    def partition_dir(
+        self, experiment: str, model: str, judge: Optional[str] = None
+    ) -> str:
+        return os.path.join(
+            self.root,
+            f"experiment={_encode(experiment)}",
+            f"model={_encode(model)}",
+            f"judge={_encode(judge or NO_JUDGE)}",
+        )
+
+    def _part_files(self, part_dir: str) -> list[str]:
+        if not os.path.isdir(part_dir) and not self._recover(part_dir):
+            return []
+        # part file names are prefixed by their creation time (so sorting preserves append order)
+        return [
+            os.path.join(part_dir, f)
+            for f in sorted(os.listdir(part_dir))
+            if f.startswith("part-") and f.endswith(".parquet")
+        ]
+
+    def _recover(self, part_dir: str) -> bool:
+        """
+        Restore a partition left missing by a crash during write() (between swapping out the old partition and
+        swapping in the new one), from its new results if they were fully written, else from its old results.
+        Returns false if there was nothing to recover.
+        """
+
+        def leftover_dirs(suffix: str) -> list[str]:
+            dirs = glob.glob(glob.escape(part_dir) + suffix + "-*")
+            return sorted(dirs, key=os.path.getmtime)
+
+        # (new dirs without part files were interrupted while writing)
+        candidates = [d for d in leftover_dirs(".new") if self._part_files(d)]
+        candidates = candidates or leftover_dirs(".old")
+        if len(candidates) == 0:
+            return False
+        logger.warning(f"recovering partition '{part_dir}' from '{candidates[-1]}'")
+        os.rename(candidates[-1], part_dir)
+        return True
+
+    def exists(self, experiment: str, model: str, judge: Optional[str] = None) -> bool:
+        return len(self._part_files(self.partition_dir(experiment, model, judge))) > 0
+
+    def append(
+        self,
+        df: pd.DataFrame,
+        experiment: str,
+        model: str,
+        judge: Optional[str] = None,
+    ) -> str:
+        """Append results to the given partition (without reading any existing results)."""
+        part_dir = self.partition_dir(experiment, model, judge)
+        os.makedirs(part_dir, exist_ok=True)
+        return self._write_part(df, part_dir)
+
+    def write(
+        self,
+        df: pd.DataFrame,
+        experiment: str,
+        model: str,
+        judge: Optional[str] = None,
+    ) -> str:
+        """Write results to the given partition, replacing any existing results."""
+        part_dir = self.partition_dir(experiment, model, judge)
+        new_dir = part_dir + f".new-{uuid.uuid4().hex[:8]}"
+        os.makedirs(new_dir)
+        fname = self._write_part(df, new_dir)
+
+        # swap in the new partition (so a crash never leaves it partially written, and a crash
+        # between the renames is recovered from the old or new dir, see _recover())
+        old_dir = None
+        if os.path.isdir(part_dir):
+            old_dir = part_dir + f".old-{uuid.uuid4().hex[:8]}"
+            os.rename(part_dir, old_dir)
+        os.rename(new_dir, part_dir)
+        if old_dir is not None:
+            shutil.rmtree(old_dir)
+        return os.path.join(part_dir, os.path.basename(fname))
+
+    def _write_part(self, df: pd.DataFrame, part_dir: str) -> str:
+        name = f"part-{time.time_ns():020d}-{uuid.uuid4().hex[:8]}.parquet"
+        fname = os.path.join(part_dir, name)
+        tmp_fname = os.path.join(part_dir, f".{name}.tmp")
+        df.to_parquet(tmp_fname, index=False)
+        os.replace(tmp_fname, fname)  # atomic (readers never see partial files)
+        logger.debug(f"wrote '{fname}' ({len(df)} rows)")
+        return fname
+
+    def read(
+        self,
+        experiment: str,
+        model: str,
+        judge: Optional[str] = None,
+        columns: Optional[list[str]] = None,
+    ) -> Optional[pd.DataFrame]:
+        """Read results of a partition (optionally only the given columns), or None if not found."""
+        files = self._part_files(self.partition_dir(experiment, model, judge))
+        if len(files) == 0:
+            return None
+        dfs = [pd.read_parquet(f, columns=columns) for f in files]
+        return dfs[0] if len(dfs) == 1 else pd.concat(dfs, ignore_index=True)
+
+    def models(self, experiment: str, judge: Optional[str] = None) -> list[str]:
+        """Names of the models with results for the given experiment (and judge)."""
+        exp_dir = os.path.join(self.root, f"experiment={_encode(experiment)}")
+        if not os.path.isdir(exp_dir):
+            return []
+        models = []
+        for name in sorted(os.listdir(exp_dir)):
+            if not name.startswith("model="):
+                continue
+            model = unquote(name.removeprefix("model="))
+            if self.exists(experiment, model, judge):
+                models.append(model)
+        return models
+
+    def read_all(
+        self,
+        experiment: str,
+        judge: Optional[str] = None,
+        columns: Optional[list[str]] = None,
+    ) -> dict[str, pd.DataFrame]:
+        """Read results of all models for the given experiment (and judge), keyed by model name."""
+        res = {}
+        for model in self.models(experiment, judge):
+            df = self.read(experiment, model, judge, columns=columns)
+            if df is not None:
+                res[model] = df
+        return res
+
+    def export_excel(
+        self, experiment: str, fname: str, judge: Optional[str] = None
+    ) -> bool:
+        """Export results to an Excel file (with a sheet per model), returns false if none found."""
+        dfs = self.read_all(experiment, judge)
+        if len(dfs) == 0:
+            return False
+        with pd.ExcelWriter(fname) as writer:
+            for model, df in dfs.items():
+                df.to_excel(writer, sheet_name=model, index=False)
+        logger.info(f"wrote '{fname}'")
+        return True
+
+    def import_excel(
+        self, fname: str, experiment: str, judge: Optional[str] = None
+    ) -> int:
+        """
+        Import results from (legacy) Excel files with a sheet per model, skipping models
+        already in the store. Returns the number of sheets imported.
+        """
+        if not os.path.exists(fname):
+            return 0
+        excel_file = pd.ExcelFile(fname)
+        count = 0
+        for sheet_name in excel_file.sheet_names:
+            model = str(sheet_name)  # (e.g. a numeric sheet name)
+            if self.exists(experiment, model, judge):
+                continue
+            self.write(excel_file.parse(sheet_name), experiment, model, judge)
+            count += 1
+        if count > 0:
+            logger.info(f"imported {count} sheets from '{fname}'")
+        return count
@@ -8,10 +8,14 @@ import pandas as pd
 import os
 import sys
 
+import budget
 import config
 import gpt
 import prompts as promptlib
 
+# expected (average) length of a generated goal and plan (json), for projecting the cost of a run
+EXPECTED_OUTPUT_TOKENS = 300
+
 
 def main():
     parser = argparse.ArgumentParser(
@@ -59,9 +63,9 @@ def main():
         default="Dutch",
         help="Name of language to output smart goals in.",
     )
+    budget.add_budget_args(parser)
     args = parser.parse_args()
     # config.set_seed(args.seed)
-    config.source_dot_env()  # read api key
 
     assert args.sample_size > 0
     if os.path.isdir(args.output):
@@ -72,6 +76,12 @@ def main():
 
     print(f"\ncreating {args.sample_size} prompts... ", flush=True)
     df = create_prompts(args)
+    projection = budget.plan_gpt(
+        df["prompt"], args.model, expected_output_tokens=EXPECTED_OUTPUT_TOKENS
+    )
+    if not budget.check_run(projection, args):
+        return
+    config.source_dot_env()  # read api key
     df.to_csv(args.output, index=False)  # verify save works before running model
     config.args_to_dict(args, fname=base_path + ".config.json")  # document config
 
@@ -1,10 +1,86 @@
 import os
 import sys
+from typing import Optional
+
+import pytest
 
 TEST_DIR = os.path.abspath(os.path.dirname(__file__))
+RECIPES_DIR = os.path.join(TEST_DIR, "../tuner/recipes")
+
+# args of a tiny llama2 model, for testing the torchtune recipes
+TINY_LLAMA = dict(
+    vocab_size=64,
+    num_layers=2,
+    num_heads=4,
+    num_kv_heads=2,
+    embed_dim=32,
+    max_seq_len=64,
+)
 
 
 def pytest_sessionstart():
     """Runs once before all tests start."""
     # apprent parent directory to sys.path (so imports like `import config` in prompts.py work)
     sys.path.append(os.path.join(TEST_DIR, ".."))
+    # as well as the torchtune recipes (so they and their modules can be imported, e.g. `import generate`)
+    sys.path.append(RECIPES_DIR)
+
+
+@pytest.fixture
+def tiny_llama():
+    """
+    Factory of tiny llama2 models (identically initialized, in eval mode), with KV caches for
+    batch_size sequences if given. Keyword args override those of TINY_LLAMA.
+    """
+    torch = pytest.importorskip("torch")
+    llama2 = pytest.importorskip("torchtune.models.llama2").llama2
+
+    def make(batch_size: Optional[int] = None, **kwargs):
+        torch.manual_seed(0)
+        model = llama2(**{**TINY_LLAMA, **kwargs}).eval()
+        if batch_size is not None:
+            model.setup_caches(max_batch_size=batch_size, dtype=torch.float32)
+        return model
+
+    return make
+
+
+class FakeTemplate:
+    template = "### Instruction:\n{instruction}\n\n### Response:\n"
+
+
+class FakeTokenizer:
+    def __init__(self, vocab_size: int = 64):
+        self.vocab_size = vocab_size
+
+
+class FakeDataset:
+    """Counts the number of samples "tokenized"."""
+
+    template = FakeTemplate
+    train_on_input = True
+    max_seq_len = 512
+
+    def __init__(self, lengths):
+        self.lengths_ = lengths
+        self.calls = 0
+
+    def __len__(self):
+        return len(self.lengths_)
+
+    def __getitem__(self, idx):
+        self.calls += 1
+        tokens = [idx + 1] * self.lengths_[idx]
+        return tokens, [-100] + tokens[1:]
+
+
+@pytest.fixture
+def fake_tokenizer():
+    """FakeTokenizer class (tokenizer with just a vocab_size), for caching tokenized datasets."""
+    return FakeTokenizer
+
+
+@pytest.fixture
+def counting_dataset():
+    """FakeDataset class (given the length of each sample), for caching tokenized datasets."""
+    return FakeDataset
@@ -1,4 +1,10 @@
 import os
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+import deepl
+import pytest
 import data.alpaca_cleaned_nl.translate_utils as tutils
 import data.alpaca_cleaned_nl.manage as manage
 
@@ -85,3 +91,189 @@ def test_integration(tmpdir):
     # test robustness to varying number of equals signs
     dataset = tutils.deserialize_dataset(SAMPLE_DEEPL_PATH)
     assert len(dataset) == 6
+
+
+def test_estimate_budget():
+    dataset, _ = manage.load_local_dataset(SAMPLE_DATASET_PATH)
+    chars = [sum(len(item[c]) for c in manage.COL_NAMES) for item in dataset]
+    assert manage.estimate_budget(dataset, translate_budget=0) == 0
+    assert manage.estimate_budget(dataset, translate_budget=chars[0]) == 1
+    assert manage.estimate_budget(dataset, translate_budget=sum(chars)) == len(chars)
+
+
+def test_plan_translation(tmpdir):
+    dataset, _ = manage.load_local_dataset(SAMPLE_DATASET_PATH)
+    projection = manage.plan_translation(dataset, os.path.join(tmpdir, "x.jsonl"), 2)
+    assert projection.requests == 1  # (packed into a single request)
+    assert projection.characters == sum(
+        len(dataset[i][c]) for i in range(2) for c in manage.COL_NAMES
+    )
+
+    # samples already translated are excluded
+    projection = manage.plan_translation(dataset, SAMPLE_DATASET_PATH, 2)
+    assert projection.requests == 0 and projection.price == 0
+
+
+class FakeDeepLHandler(BaseHTTPRequestHandler):
+    """Local stand-in for the DeepL translate endpoint (prefixes texts with "NL:")."""
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        if "json" in self.headers.get("Content-Type", ""):
+            texts = json.loads(body)["text"]
+        else:
+            texts = parse_qs(body.decode())["text"]
+        self.server.requests.append(texts)  # type: ignore [attr-defined]
+        if sum(len(text) for text in texts) > self.server.max_chars:  # type: ignore [attr-defined]
+            self.send_response(413)
+            self.end_headers()
+            return
+        translations = [
+            {
+                "detected_source_language": "EN",
+                "text": f"NL:{text}",
+                "billed_characters": len(text),
+            }
+            for text in texts
+        ]
+        payload = json.dumps({"translations": translations}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def fake_deepl():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeDeepLHandler)
+    server.requests = []  # type: ignore [attr-defined]
+    server.max_chars = 10**9  # type: ignore [attr-defined]
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+
+
+def _fake_translator(server) -> deepl.Translator:
+    return deepl.Translator(
+        "fake-key", server_url=f"http://127.0.0.1:{server.server_port}"
+    )
+
+
+def test_translate_dataset(tmpdir, fake_deepl):
+    dataset, _ = manage.load_local_dataset(SAMPLE_DATASET_PATH)
+    disk_path = os.path.join(tmpdir, "translated.jsonl")
+    translator = _fake_translator(fake_deepl)
+
+    count = manage.translate_dataset(
+        dataset, disk_path, max_samples=4, translator=translator, max_workers=2
+    )
+    assert count == 4
+    # samples are packed into a single request
+    assert len(fake_deepl.requests) == 1
+
+    # resumes from the journal alone (ignoring a partially written line)
+    with open(disk_path, "a") as f:
+        f.write('{"output": "NL:')
+    count = manage.translate_dataset(
+        dataset, disk_path, max_samples=10, translator=translator
+    )
+    assert count == len(dataset) - 4
+    tdataset, _ = manage.load_local_dataset(disk_path)
+    assert sorted(tdataset["orig_index"]) == sorted(dataset["orig_index"])
+    for item in tdataset:
+        orig = dataset[dataset["orig_index"].index(item["orig_index"])]
+        for c in manage.COL_NAMES:
+            assert item[c] == ("" if orig[c].strip() == "" else f"NL:{orig[c]}")
+
+
+def test_translation_journal(tmpdir):
+    fname = os.path.join(tmpdir, "translated.jsonl")
+    with open(fname, "w") as f:
+        f.write('{"orig_index": 1}\n\n{"orig_index": 2}')  # (no trailing newline)
+    journal = manage.TranslationJournal(fname)
+    assert journal.completed_indices == {1, 2}
+    journal.add({"orig_index": 3})
+    journal.close()
+    assert manage.TranslationJournal(fname).completed_indices == {1, 2, 3}
+
+    # a partially written last line is dropped
+    with open(fname, "a") as f:
+        f.write('{"orig_ind')
+    journal = manage.TranslationJournal(fname)
+    journal.add({"orig_index": 4})
+    journal.close()
+    assert manage.TranslationJournal(fname).completed_indices == {1, 2, 3, 4}
+
+    # but a corrupt line before others isn't (which would drop the samples after it)
+    with open(fname, "a") as f:
+        f.write('{"orig_ind{"orig_index": 5}\n{"orig_index": 6}\n')
+    size = os.path.getsize(fname)
+    with pytest.raises(ValueError, match="line 6"):
+        manage.TranslationJournal(fname)
+    assert os.path.getsize(fname) == size
+
+
+def test_translate_dataset_adaptive(tmpdir, fake_deepl):
+    dataset, _ = manage.load_local_dataset(SAMPLE_DATASET_PATH)
+    disk_path = os.path.join(tmpdir, "translated.jsonl")
+    # requests exceeding the size of the largest sample fail (so batches are split)
+    fake_deepl.max_chars = max(
+        sum(len(text) for text in manage._texts_to_translate(item)) for item in dataset
+    )
+    count = manage.translate_dataset(
+        dataset, disk_path, max_samples=10, translator=_fake_translator(fake_deepl)
+    )
+    assert count == len(dataset)
+    # (the first request contained all samples)
+    assert len(fake_deepl.requests) > 1
+
+
+def test_pack_batches():
+    dataset, _ = manage.load_local_dataset(SAMPLE_DATASET_PATH)
+    batches = list(manage.pack_batches(dataset, max_texts=5))
+    assert len(batches) > 1
+    for batch in batches:
+        assert sum(len(manage._texts_to_translate(item)) for item in batch) <= 5
+    assert sum(len(batch) for batch in batches) == len(dataset)
+    # samples exceeding the limits are batched on their own
+    assert [len(batch) for batch in manage.pack_batches(dataset, max_chars=1)] == [
+        1
+    ] * len(dataset)
+
+
+def test_parse_samples():
+    # samples split over chunks (e.g. paragraphs), with a malformed sample in between
+    chunks = SAMPLE1_STR.split("\n") + ["<===@5===>", "</===@5===>"]
+    chunks += ["ignored text"] + SAMPLE2_DUTCH_STR.split("\n")
+    assert list(tutils.parse_samples(chunks)) == [SAMPLE1, SAMPLE2_DUCTH]
+    # multiple samples in a single chunk
+    chunk = f"{SAMPLE1_STR} {SAMPLE2_STR}"
+    assert list(tutils.parse_samples([chunk])) == [SAMPLE1, SAMPLE2]
+
+
+def test_serialize_chunked(tmpdir):
+    dataset, _ = manage.load_local_dataset(SAMPLE_DATASET_PATH)
+    max_chars = 3000
+    for ext in ["txt", "docx"]:
+        fname = os.path.join(tmpdir, f"out.{ext}")
+        fnames = tutils.serialize_dataset(dataset, fname, max_chars_per_file=max_chars)
+        assert len(fnames) > 1
+        assert fnames[0] == os.path.join(tmpdir, f"out_part1.{ext}")
+
+        samples = []
+        for i, part_fname in enumerate(fnames):
+            out_fname = os.path.join(tmpdir, f"out_{i}.jsonl")
+            count = tutils.deserialize_to_jsonl(part_fname, out_fname)
+            with open(out_fname) as f:
+                part_samples = [json.loads(line) for line in f]
+            assert len(part_samples) == count
+            samples += part_samples
+            if ext == "txt":
+                # (parts only exceed the limit when a single sample does)
+                assert os.path.getsize(part_fname) <= max_chars or count == 1
+        assert samples == list(dataset)
@@ -0,0 +1,76 @@
+import threading
+import pytest
+import pandas as pd
+import benchmark_matrix
+from benchmark_matrix import FluencyTemplate, run_matrix
+from results_store import ResultsStore, FEEDBACK_EXPERIMENT, BENCHMARK_EXPERIMENT
+
+
+class FakeJudge:
+    """Scores judge prompts with a fixed score, recording the prompts received."""
+
+    def __init__(self, model_name: str, calls: list):
+        self.model_name = model_name
+        self.calls = calls
+        self.lock = threading.Lock()
+
+    def __call__(self, prompts, **kwargs):
+        with self.lock:
+            self.calls += [(self.model_name, p) for p in prompts]
+        outputs = [
+            "4" if p.startswith("Vloeiendheid") else '{"utility": 7, "safety": 9}'
+            for p in prompts
+        ]
+        return outputs, [0.1] * len(prompts)
+
+    @staticmethod
+    def compute_price(meta) -> float:
+        return sum(meta)
+
+
+def test_fluency_template():
+    template = FluencyTemplate()
+    prompts = template.build_many(["q"], ["Goed {gedaan}!"])
+    assert "antwoord: Goed {gedaan}!\nsterren:" in prompts[0]
+    scores = template.parse_scores(["4", " 5\n", "6", "vijf", None])
+    assert scores["fluency"].tolist() == [4, 5, pd.NA, pd.NA, pd.NA]
+
+
+def test_run_matrix(tmp_path):
+    store = ResultsStore(str(tmp_path / "results"))
+    feedback_df = pd.DataFrame(
+        {"goal_id": [1, 2], "prompt": ["p1", "p2"], "response": ["r1", "r2"]}
+    )
+    # identical feedback from two candidates (so judge prompts are deduped across cells)
+    store.write(feedback_df, FEEDBACK_EXPERIMENT, "a")
+    store.write(feedback_df, FEEDBACK_EXPERIMENT, "b")
+    store.write(feedback_df.assign(response=["r3", "r4"]), FEEDBACK_EXPERIMENT, "c")
+
+    calls: list = []
+    kwargs = dict(requests_per_min=60_000, get_model=lambda m: FakeJudge(m, calls))
+    judges = ["j1", "j2"]
+    summary = run_matrix(
+        store, ["a", "b", "c"], judges, ["utility", "safety", "fluency"], **kwargs
+    )
+
+    # 2 judges * 2 experiments * 4 unique responses (utility and safety share a prompt)
+    assert len(calls) == 16 and len(set(calls)) == 16
+    assert len(summary) == 3 * 2 * 3
+    assert set(summary["n"]) == {2}
+    means = summary.set_index(["candidate", "judge", "metric"])["mean"]
+    assert means[("c", "j2", "utility")] == 7 and means[("a", "j1", "fluency")] == 4
+
+    df = store.read(BENCHMARK_EXPERIMENT, "b", judge="j1")
+    assert df is not None and df["safety"].tolist() == [9, 9]
+
+    # finished cells are reused
+    calls.clear()
+    run_matrix(store, ["a", "b", "c"], judges + ["j3"], ["utility"], **kwargs)
+    assert len(calls) == 4 and {judge for judge, _ in calls} == {"j3"}
+
+
+def test_plan_cells_missing_feedback(tmp_path):
+    store = ResultsStore(str(tmp_path / "results"))
+    tasks = benchmark_matrix.get_judge_tasks()
+    with pytest.raises(AssertionError, match="no feedback from 'a'"):
+        benchmark_matrix.plan_cells(store, ["a"], ["j1"], ["fluency"], tasks)
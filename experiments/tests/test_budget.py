@@ -0,0 +1,53 @@
+import argparse
+import math
+import pytest
+import budget
+import gpt
+
+
+def count_words(text: str) -> int:
+    return len(text.split())
+
+
+def test_plan_gpt():
+    prompts = ["one two three", [{"role": "user", "content": "four five"}]]
+    projection = budget.plan_gpt(
+        prompts,
+        "gpt-3.5-turbo-0125",
+        expected_output_tokens=100,
+        concurrency=2,
+        max_retries=2,
+        count_tokens=count_words,
+    )
+    assert projection.requests == 2
+    assert projection.input_tokens == 5 + 2 * budget.CHAT_OVERHEAD_TOKENS
+    assert projection.output_tokens == 200
+    input_price, output_price = gpt.PRICES["gpt-3.5-turbo-0125"]
+    assert projection.price == pytest.approx(19 * input_price + 200 * output_price)
+    assert projection.max_price == pytest.approx(3 * projection.price)
+    # requests are split over concurrent workers
+    serial = budget.plan_gpt(prompts, "gpt-3.5-turbo-0125", 100, count_tokens=len)
+    assert projection.secs == pytest.approx(serial.secs / 2)
+    assert "2 requests" in str(projection)
+
+    projection = budget.plan_gpt(["hi"], "unknown-model", 10, count_tokens=len)
+    assert math.isnan(projection.price)
+
+
+def test_check_budget():
+    projection = budget.plan_translation(["a" * 1000, "b" * 1000], requests=1)
+    assert projection.characters == 2000
+    assert projection.price == pytest.approx(2000 * budget.DEEPL_PRICE_PER_CHAR)
+
+    budget.check_budget(projection, max_price=1.0, max_hours=1.0)
+    with pytest.raises(budget.BudgetExceededError, match="price"):
+        budget.check_budget(projection, max_price=0.01)
+    with pytest.raises(budget.BudgetExceededError, match="time"):
+        budget.check_budget(projection, max_hours=projection.secs / 3600 / 2)
+
+    parser = argparse.ArgumentParser()
+    budget.add_budget_args(parser)
+    assert budget.check_run(projection, parser.parse_args([]))
+    assert not budget.check_run(projection, parser.parse_args(["--dry-run"]))
+    with pytest.raises(SystemExit):
+        budget.check_run(projection, parser.parse_args(["--max-price", "0.01"]))
@@ -0,0 +1,80 @@
+import os
+import threading
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("torchtune")
+pytest.importorskip("safetensors")
+from torchtune.models.llama2 import llama2, lora_llama2  # noqa: E402
+from torchtune.modules.peft.peft_utils import get_adapter_params  # noqa: E402
+import checkpointing  # noqa: E402
+from tests.conftest import TINY_LLAMA  # noqa: E402
+
+
+def test_async_checkpoint_writer(tmp_path, monkeypatch):
+    writer = checkpointing.AsyncCheckpointWriter()
+    weights = {"a": torch.ones(3), "b": torch.zeros(2, 2)}
+    state = {"optimizer": {"state": {0: {"exp_avg": torch.ones(2)}}}, "epoch": 1}
+
+    # block the writer thread, to check snapshots aren't affected by later updates
+    release = threading.Event()
+    save_file = checkpointing.save_file
+    monkeypatch.setattr(
+        checkpointing,
+        "save_file",
+        lambda obj, path: release.wait() and save_file(obj, path),
+    )
+    path = str(tmp_path / checkpointing.adapter_fname(0))
+    writer.save_safetensors(weights, path)
+    writer.save_torch(state, str(tmp_path / checkpointing.RECIPE_STATE_FNAME))
+    weights["a"] += 1
+    state["optimizer"]["state"][0]["exp_avg"] += 1
+    assert not os.path.exists(path)
+    release.set()
+    writer.wait()
+
+    assert sorted(os.listdir(tmp_path)) == ["adapter_0.safetensors", "recipe_state.pt"]
+    loaded = checkpointing.load_adapter(path)
+    assert torch.equal(loaded["a"], torch.ones(3))
+    loaded_state = torch.load(str(tmp_path / checkpointing.RECIPE_STATE_FNAME))
+    assert torch.equal(loaded_state["optimizer"]["state"][0]["exp_avg"], torch.ones(2))
+    assert loaded_state["epoch"] == 1
+
+    # errors are raised on the training thread
+    writer.save_safetensors(weights, str(tmp_path / "missing_dir/adapter.safetensors"))
+    with pytest.raises(RuntimeError):
+        writer.wait()
+    writer.wait()  # (raised once)
+
+
+def test_merge_adapter(tmp_path):
+    """Exported (merged) weights should give the same outputs as the base model with the adapter."""
+    torch.manual_seed(0)
+    model = lora_llama2(
+        lora_attn_modules=["q_proj", "v_proj", "output_proj"],
+        apply_lora_to_mlp=True,
+        lora_rank=4,
+        lora_alpha=8,
+        **TINY_LLAMA,
+    ).eval()
+    adapter_params = get_adapter_params(model)
+    with torch.no_grad():
+        for param in adapter_params.values():
+            param.normal_(std=0.1)  # (lora_b is initialized to zeros)
+    base_state_dict = {
+        k: v.clone() for k, v in model.state_dict().items() if k not in adapter_params
+    }
+
+    writer = checkpointing.AsyncCheckpointWriter()
+    path = str(tmp_path / checkpointing.adapter_fname(2))
+    writer.save_safetensors(dict(adapter_params), path)
+    writer.wait()
+
+    merged = checkpointing.merge_adapter(
+        base_state_dict, checkpointing.load_adapter(path), rank=4, alpha=8
+    )
+    merged_model = llama2(**TINY_LLAMA).eval()
+    merged_model.load_state_dict(merged)
+    tokens = torch.randint(0, 64, (2, 10))
+    with torch.no_grad():
+        torch.testing.assert_close(merged_model(tokens), model(tokens))
@@ -0,0 +1,112 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("torchtune")
+from omegaconf import OmegaConf  # noqa: E402
+from torch import nn  # noqa: E402
+import cpu_quantization  # noqa: E402
+import generate as recipe  # noqa: E402
+
+
+def dequantized_weight(module: nn.Module):
+    """Weights of a quantized linear layer (as used by its matmuls), without its bias."""
+    eye = torch.eye(module.in_features, dtype=torch.bfloat16)
+    out = module(eye).float()
+    if module.bias is not None:
+        out = out - module.bias.float()
+    return out.T
+
+
+@pytest.mark.parametrize("mode", ["int8", "int4"])
+def test_quantized_linear(mode):
+    torch.manual_seed(0)
+    linear = nn.Linear(256, 64, bias=False)
+    if mode == "int8":
+        quantized = cpu_quantization.Int8WeightOnlyLinear(linear)
+        # (scale per output channel)
+        max_error = linear.weight.abs().amax(dim=1, keepdim=True) / 127
+    else:
+        quantized = cpu_quantization.Int4WeightOnlyLinear(linear, groupsize=32)
+        groups = linear.weight.reshape(64, -1, 32)
+        max_error = (groups.amax(-1) - groups.amin(-1)).repeat_interleave(32, 1) / 15
+
+    # weights are rounded to the nearest quantized value (up to bf16 precision)
+    weight = dequantized_weight(quantized)
+    error = (weight - linear.weight).abs()
+    assert (error <= max_error * 0.5 + 0.01).all()
+
+    x = torch.randn(2, 3, 256)
+    expected = (x.to(torch.bfloat16).float() @ weight.T).float()
+    torch.testing.assert_close(quantized(x), expected, atol=0.05, rtol=0.02)
+    assert quantized(x).dtype == x.dtype
+
+
+@pytest.mark.parametrize("mode", ["int8", "int4"])
+def test_quantize(mode, tiny_llama):
+    model = tiny_llama(embed_dim=128).to(torch.bfloat16)
+    tokens = torch.randint(0, 64, (2, 16))
+    with torch.no_grad():
+        expected = model(tokens).float()
+    size = recipe._model_size(model)
+
+    cpu_quantization.quantize(model, mode, groupsize=32)
+    assert not any(type(m) is nn.Linear for m in model.modules())
+    quantized_cls = {
+        "int8": cpu_quantization.Int8WeightOnlyLinear,
+        "int4": cpu_quantization.Int4WeightOnlyLinear,
+    }[mode]
+    assert isinstance(model.layers[0].attn.q_proj, quantized_cls)
+    # (quantized weights are counted for the bandwidth achieved)
+    assert recipe._model_size(model) < size * {"int8": 0.6, "int4": 0.4}[mode]
+
+    with torch.no_grad():
+        logits = model(tokens).float()
+    error = (logits - expected).norm() / expected.norm()
+    assert error < {"int8": 0.02, "int4": 0.15}[mode]
+
+    # greedy generation works with the (bf16) KV caches
+    model.setup_caches(max_batch_size=2, dtype=torch.bfloat16)
+    outputs = recipe.generate_batch(
+        model, [[1, 5, 9], [1, 7]], max_generated_tokens=6, top_k=1
+    )
+    assert [len(out) for out in outputs] == [6, 6]
+
+
+def test_quantize_int4_fallback(tiny_llama):
+    """Layers whose shape isn't supported by the int4 kernel are quantized to int8."""
+    model = tiny_llama().to(torch.bfloat16)
+    cpu_quantization.quantize(model, "int4", groupsize=32)
+    assert isinstance(
+        model.layers[0].attn.q_proj, cpu_quantization.Int8WeightOnlyLinear
+    )
+
+    with pytest.raises(ValueError):
+        cpu_quantization.quantize(model, "int2")
+
+
+def test_memory_used():
+    rss = cpu_quantization.rss_bytes()
+    assert 0 < rss <= cpu_quantization.peak_rss_bytes() * 1.1
+    assert "GB RSS" in recipe._memory_used(torch.device("cpu"))
+
+
+def test_recipe_cpu_quantization_config():
+    cfg = OmegaConf.create(
+        dict(device="cpu", dtype="bf16", quantizer=None, seed=0, num_threads=1)
+    )
+    num_threads = torch.get_num_threads()
+    try:
+        inference = recipe.InferenceRecipe(
+            OmegaConf.merge(cfg, {"cpu_quantization": "int8"})
+        )
+        assert inference._cpu_quantization == "int8"
+        assert torch.get_num_threads() == 1
+    finally:
+        torch.set_num_threads(num_threads)
+
+    with pytest.raises(ValueError):
+        recipe.InferenceRecipe(
+            OmegaConf.merge(
+                cfg, {"device": "meta", "dtype": "fp32", "cpu_quantization": "int8"}
+            )
+        )
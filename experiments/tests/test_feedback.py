@@ -0,0 +1,34 @@
+import json
+import pandas as pd
+import feedback
+import prompts as promptlib
+
+
+def test_build_feedback_prompts():
+    prompts = feedback.build_feedback_prompts(["my {goal}"], ["my plan"])
+    expected = promptlib.PROMPT_SMART_FEEDBACK_TEXT_ONLY.format(
+        FEEDBACK_PRINCIPLES=promptlib.FEEDBACK_PRINCIPLES,
+        SMART_RUBRIC=promptlib.SMART_RUBRIC,
+        learning_goal="my {goal}",
+        action_plan="my plan",
+        language="Dutch",
+    )
+    assert prompts == [expected]
+
+
+def test_extend_outputs():
+    attr = {"score": 8, "feedback": "good"}
+    response = {
+        "specific": attr,
+        "measurable": attr,
+        "action_oriented": attr,
+        "relevant": attr,
+        "time_bound": attr,
+        "overall_feedback": "well done",
+    }
+    df = pd.DataFrame({"goal_id": [1, 2], "response": [json.dumps(response), "bad"]})
+    full_df = feedback.extend_outputs(df)
+    assert full_df["overall_feedback"].tolist()[0] == "well done"
+    assert full_df["score_time_bound"].tolist()[0] == 8
+    assert full_df["score_specific"].isna().tolist() == [False, True]
+    assert len(full_df.columns) == 2 + 1 + 2 * len(promptlib.SMART)
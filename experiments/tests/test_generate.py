@@ -0,0 +1,121 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("torchtune")
+from torch._dynamo.testing import CompileCounter  # noqa: E402
+from torchtune import utils  # noqa: E402
+import generate as recipe  # noqa: E402
+
+EOS_ID = 2
+
+
+def test_generate_batch(tiny_llama):
+    prompts = [[1, 5, 9, 13, 17, 21, 25], [1, 7], [1, 30, 31, 32]]
+    kwargs = dict(max_generated_tokens=12, top_k=1)  # greedy (deterministic)
+
+    # batched outputs (despite padding) match generating each prompt on its own
+    batched = recipe.generate_batch(tiny_llama(len(prompts)), prompts, **kwargs)
+    model = tiny_llama(1)
+    for prompt, out in zip(prompts, batched):
+        expected = utils.generate(
+            model, torch.tensor(prompt, dtype=torch.int), **kwargs
+        )
+        assert out == expected[len(prompt) :]
+
+    # each sequence stops at its own eos (with early exit once all are done)
+    eos_id = batched[0][3]
+    batched = recipe.generate_batch(
+        tiny_llama(len(prompts)), prompts, eos_id=eos_id, **kwargs
+    )
+    assert batched[0][-1] == eos_id and len(batched[0]) <= 4
+    for out in batched:
+        assert eos_id not in out[:-1]
+
+
+def test_model_size(tiny_llama):
+    """KV caches aren't counted as read per forward pass (for the bandwidth achieved)."""
+    model = tiny_llama(1)
+    num_params = sum(p.numel() for p in model.parameters())
+    size = recipe._model_size(model)
+    assert num_params * 4 <= size < num_params * 4 * 1.1  # (e.g. rope caches)
+    model.setup_caches(max_batch_size=8, dtype=torch.float32)
+    assert recipe._model_size(model) == size
+
+
+def test_generate_batch_max_seq_len(tiny_llama):
+    with pytest.raises(ValueError):
+        recipe.generate_batch(tiny_llama(1), [[1] * 60], max_generated_tokens=10)
+
+
+def test_generate_batch_static_shapes(tiny_llama):
+    cnt = CompileCounter()
+    step = torch.compile(recipe.decode_step, backend=cnt, fullgraph=True)
+    model = tiny_llama(4)
+    kwargs = dict(max_generated_tokens=6, top_k=1, batch_size=4)
+
+    # batches of varying sizes and prompt lengths are padded to batch_size
+    batches = [[[1, 5, 9], [1, 7]], [[1, 2, 3, 4, 5, 6, 7, 8]], [[1]] * 4]
+    for batch in batches:
+        outputs = recipe.generate_batch(model, batch, custom_decode_step=step, **kwargs)
+        assert len(outputs) == len(batch)
+        expected = recipe.generate_batch(
+            tiny_llama(len(batch)), batch, top_k=1, max_generated_tokens=6
+        )
+        assert outputs == expected
+    # so the decode step is only compiled once
+    assert cnt.frame_count == 1
+
+    with pytest.raises(ValueError):
+        recipe.generate_batch(model, [[1]] * 5, **kwargs)
+
+
+def test_generate_speculative(tiny_llama):
+    model = tiny_llama(1)
+    draft_model = tiny_llama(1, num_layers=1, num_heads=2, embed_dim=16)
+
+    # greedy outputs (of any draft model) are the model's own
+    for prompt in [[1, 5, 9, 13, 17, 21, 25], [1]]:
+        stats = recipe.SpeculativeStats()
+        outputs = recipe.generate_speculative(
+            model, draft_model, prompt, 12, k=3, top_k=1, stats=stats
+        )
+        expected = utils.generate(
+            model, torch.tensor(prompt, dtype=torch.int), 12, top_k=1
+        )
+        assert outputs == expected[len(prompt) :]
+        assert stats.generated == 12 and stats.drafted > 0
+        assert 0 <= stats.acceptance_rate <= 1
+
+    # generation stops at eos
+    eos_id = outputs[4]
+    outputs = recipe.generate_speculative(
+        model, draft_model, [1], 12, k=3, top_k=1, eos_id=eos_id
+    )
+    assert outputs == expected[1 : 1 + expected[1:].index(eos_id) + 1]
+
+    # a draft model identical to the model is always accepted
+    stats = recipe.SpeculativeStats()
+    recipe.generate_speculative(
+        model, tiny_llama(1), [1, 5, 9], 13, k=3, temperature=0.8, stats=stats
+    )
+    assert stats.acceptance_rate == 1.0
+    assert stats.tokens_per_forward == pytest.approx(
+        13 / 5
+    )  # (prefill, then 4 tokens per forward)
+
+
+def test_verify_draft():
+    torch.manual_seed(0)
+    p = torch.tensor([0.1, 0.2, 0.3, 0.4])
+    q = torch.tensor([0.4, 0.3, 0.2, 0.1])
+    probs = torch.stack([p, torch.tensor([1.0, 0.0, 0.0, 0.0])])
+
+    # the first token follows p (rather than the draft's q)
+    counts = torch.zeros(4)
+    num_trials = 5000
+    for _ in range(num_trials):
+        draft_token = torch.multinomial(q, 1).item()
+        new_tokens = recipe.verify_draft([draft_token], q[None], probs)
+        assert new_tokens[1:] in ([], [0])
+        counts[new_tokens[0]] += 1
+    assert torch.allclose(counts / num_trials, p, atol=0.03)
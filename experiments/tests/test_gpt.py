@@ -0,0 +1,136 @@
+import json
+import threading
+import time
+import pytest
+from types import SimpleNamespace
+from typing import List, Optional
+from unittest.mock import Mock
+from pydantic import BaseModel, Field
+from gpt import auto_reprompt, to_strict_schema, GPTModel, PromptJournal, RateLimiter
+from prompts import SMARTFeedback
+
+
+class FakeModel:
+    """Returns the queued outputs of each prompt (in order)."""
+
+    def __init__(self, outputs: dict[str, list[str]]):
+        self.outputs = outputs
+        self.prompts: list[str] = []
+        self.lock = threading.Lock()
+
+    def __call__(self, prompts, **kwargs):
+        with self.lock:
+            self.prompts += prompts
+            return [self.outputs[p].pop(0) for p in prompts], [0.5] * len(prompts)
+
+    @staticmethod
+    def compute_price(meta) -> float:
+        return sum(meta)
+
+
+def validator(text: Optional[str]) -> bool:
+    return text is not None and text.startswith("ok")
+
+
+def test_auto_reprompt():
+    prompts = ["p1", "p2", "p3"]
+    model = FakeModel({"p1": ["ok1"], "p2": ["bad", "bad", "ok2"], "p3": ["bad"] * 3})
+    res = auto_reprompt(validator, 2, model, prompts)  # type: ignore [arg-type]
+    assert res.outputs == ["ok1", "ok2", None]
+    # each prompt is retried independently (up to max_retries times)
+    assert [item.attempts for item in res.items] == [1, 3, 3]
+    assert res.total_calls == 7 and res.total_price == 3.5
+    assert res.items[1].price == 1.5
+
+
+def test_auto_reprompt_journal(tmp_path):
+    journal_path = str(tmp_path / "journal.jsonl")
+    prompts = ["p1", "p2", "p3"]
+
+    # p2 fails validation (even after a retry)
+    model = FakeModel({"p1": ["ok1"], "p2": ["bad", "bad"], "p3": ["ok3"]})
+    outputs, _, calls, _ = auto_reprompt(
+        validator,
+        1,
+        model,
+        prompts,
+        journal=journal_path,  # type: ignore [arg-type]
+    )
+    assert outputs == ["ok1", None, "ok3"] and calls == 4
+    with open(journal_path) as f:
+        assert len(f.readlines()) == 2
+
+    # resuming only reprompts the failure
+    model = FakeModel({"p2": ["ok2"]})
+    outputs, _, calls, _ = auto_reprompt(
+        validator,
+        1,
+        model,
+        prompts,
+        journal=journal_path,  # type: ignore [arg-type]
+    )
+    assert outputs == ["ok1", "ok2", "ok3"] and calls == 1
+    assert model.prompts == ["p2"]
+
+    # partially written lines (e.g. from a crash) are ignored
+    with open(journal_path, "a") as f:
+        f.write(json.dumps({"key": PromptJournal.key("p4"), "output": "ok4"})[:10])
+    assert len(PromptJournal(journal_path).outputs) == 3
+
+
+def test_to_strict_schema():
+    schema = to_strict_schema(SMARTFeedback.model_json_schema())
+    attr = schema["$defs"]["FeedbackAttr"]
+    assert attr["additionalProperties"] is False
+    assert attr["required"] == ["score", "feedback"]
+    # unsupported keywords are moved into the description
+    score = attr["properties"]["score"]
+    assert "minimum" not in score and "default" not in score
+    assert "minimum: 1" in score["description"]
+    assert schema["required"] == list(SMARTFeedback.model_fields.keys())
+
+    # properties named after (unsupported) keywords are kept
+    class Keywords(BaseModel):
+        format: str = Field(pattern="^[a-z]+$")
+        default: List[int] = Field(default=[], max_length=3)
+
+    schema = to_strict_schema(Keywords.model_json_schema())
+    assert list(schema["properties"].keys()) == ["format", "default"]
+    assert schema["required"] == ["format", "default"]
+    assert "pattern" not in schema["properties"]["format"]
+    assert schema["properties"]["default"]["items"] == {"type": "integer"}
+    assert "maxItems" not in schema["properties"]["default"]
+
+
+@pytest.mark.parametrize("model_name", ["gpt-4o-mini-2024-07-18", "gpt-3.5-turbo-0125"])
+def test_gpt_response_model(model_name: str):
+    """Outputs are constrained to the response model's json schema (if supported)."""
+    model = GPTModel.__new__(GPTModel)  # (avoid loading API key)
+    model.model_name = model_name
+    completion = SimpleNamespace(
+        choices=[SimpleNamespace(message=SimpleNamespace(content="{}", refusal=None))]
+    )
+    create = Mock(return_value=completion)
+    model.client = SimpleNamespace(  # type: ignore [assignment]
+        chat=SimpleNamespace(completions=SimpleNamespace(create=create))
+    )
+
+    outputs, _ = model(["prompt"], response_model=SMARTFeedback)
+    assert outputs == ["{}"]
+    response_format = create.call_args.kwargs.get("response_format")
+    if model.supports_structured_outputs:
+        assert response_format["type"] == "json_schema"
+        assert response_format["json_schema"]["strict"] is True
+    else:
+        assert response_format is None
+
+
+def test_rate_limiter():
+    limiter = RateLimiter(requests_per_min=1200)  # a request every 0.05 secs
+    prompts = [f"p{i}" for i in range(5)]
+    model = FakeModel({p: ["ok"] for p in prompts})
+    t0 = time.monotonic()
+    res = auto_reprompt(validator, 0, model, prompts, rate_limiter=limiter)  # type: ignore [arg-type]
+    assert res.outputs == ["ok"] * 5
+    # first request is immediate, the rest are spaced out (despite concurrent workers)
+    assert time.monotonic() - t0 >= 0.2
@@ -0,0 +1,94 @@
+import os
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("torchtune")
+import lora_finetune_single_device as recipe  # noqa: E402
+
+IGNORE_IDX = -100
+
+
+def test_sample_losses():
+    torch.manual_seed(0)
+    lengths = [5, 9, 3]
+    logits = [torch.randn(1, n, 16) for n in lengths]
+    labels = [torch.randint(0, 16, (1, n)) for n in lengths]
+    labels[1][0, :4] = IGNORE_IDX  # e.g. (masked) prompt tokens
+
+    expected = torch.stack(
+        [
+            torch.nn.functional.cross_entropy(lo[0, :-1], la[0, 1:])
+            for lo, la in zip(logits, labels)
+        ]
+    )
+    batch_logits = torch.zeros(3, 9, 16)
+    batch_labels = torch.full((3, 9), IGNORE_IDX)
+    for i, n in enumerate(lengths):
+        batch_logits[i, :n] = logits[i][0]
+        batch_labels[i, :n] = labels[i][0]
+    losses = recipe.sample_losses(batch_logits, batch_labels, IGNORE_IDX)
+    torch.testing.assert_close(losses, expected)
+
+
+def test_validate(tmp_path, tiny_llama, counting_dataset, fake_tokenizer):
+    """Validation loss is the average (per sample) loss of the validation subset."""
+    r = object.__new__(recipe.LoRAFinetuneRecipeSingleDevice)
+    r._device = torch.device("cpu")
+    r._packed = False
+    r._num_workers = 0
+    r._profiler_enabled = False
+    r.max_steps_per_epoch = None
+    r._gradient_accumulation_steps = 1
+    r._loss_fn = torch.nn.CrossEntropyLoss()
+    r._tokenizer = fake_tokenizer()
+    r._tokenizer.pad_id = 0
+    r._dataset_cache_dir = str(tmp_path)
+    lengths = [(7 * i) % 13 + 2 for i in range(100)]
+    r._tokenized_ds = recipe.token_cache.load_cached(
+        counting_dataset(lengths), r._tokenizer, str(tmp_path), ""
+    )
+
+    r._val_batches = r._setup_val_data(None, batch_size=4, val_split=0.1, val_subset=6)
+    assert len(r._val_batches) == 2
+    assert sum(batch[0].size(0) for batch in r._val_batches) == 6
+    # sorted by length
+    assert [batch[0].size(1) for batch in r._val_batches] == sorted(
+        batch[0].size(1) for batch in r._val_batches
+    )
+    # fixed subset
+    again = r._setup_val_data(None, batch_size=4, val_split=0.1, val_subset=6)
+    for batch, expected in zip(again, r._val_batches):
+        assert torch.equal(batch[0], expected[0])
+
+    r._model = tiny_llama()
+    losses = []
+    with torch.no_grad():
+        for tokens, labels, doc_ids in r._val_batches:
+            for i in range(tokens.size(0)):
+                # (batch of a single sample, without padding)
+                n = (doc_ids[i] >= 0).sum()
+                sample = [x[i : i + 1, :n] for x in (tokens, labels, doc_ids)]
+                losses.append(r._compute_loss(*sample).item())
+    assert r.validate() == pytest.approx(sum(losses) / len(losses), rel=1e-5)
+
+
+def test_save_adapter_checkpoint(tmp_path):
+    r = object.__new__(recipe.LoRAFinetuneRecipeSingleDevice)
+    r._checkpoint_mode = "adapter"
+    r._checkpoint_writer = recipe.checkpointing.AsyncCheckpointWriter()
+    r._checkpoint_output_dir = str(tmp_path)
+    r.seed, r.epochs_run, r.total_epochs, r.max_steps_per_epoch = 0, 1, 2, None
+    r.adapter_params = {"layers.0.attn.q_proj.lora_a.weight": torch.ones(4, 32)}
+    r._optimizer = torch.optim.AdamW(r.adapter_params.values())
+
+    r.save_checkpoint(epoch=0)
+    r.epochs_run = 2
+    r.save_checkpoint(epoch=1)
+    r._checkpoint_writer.wait()
+    assert sorted(os.listdir(tmp_path)) == [
+        "adapter_0.safetensors",
+        "adapter_1.safetensors",
+        "recipe_state.pt",
+    ]
+    state = torch.load(str(tmp_path / "recipe_state.pt"))
+    assert state["epochs_run"] == 1 and "optimizer" in state
@@ -0,0 +1,109 @@
+import random
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("torchtune")
+from torchtune import modules, utils  # noqa: E402
+import packing  # noqa: E402
+
+IGNORE_IDX = -100
+
+
+def fake_dataset(lengths):
+    """(tokens, labels) samples with the given lengths (tokens encoding the sample index)."""
+    return [
+        ([idx % 60 + 1] * length, [idx % 60 + 1] * length)
+        for idx, length in enumerate(lengths)
+    ]
+
+
+def test_packed_dataset():
+    lengths = [5, 3, 9, 2, 7, 12, 1]
+    ds = fake_dataset(lengths)
+    packed = packing.PackedDataset(ds, max_seq_len=10, ignore_idx=IGNORE_IDX)
+
+    # every sample is packed once (in order), truncated to max_seq_len
+    assert [idx for pack in packed.packs for idx in pack] == list(range(len(ds)))
+    assert packed.packs == [[0, 1], [2], [3, 4], [5], [6]]
+    assert packed.lengths == [8, 9, 9, 10, 1]
+
+    tokens, labels, doc_ids = packed[0]
+    assert tokens == [1] * 5 + [2] * 3
+    assert doc_ids == [0] * 5 + [1] * 3
+    # first token of each sample isn't predicted from the previous sample
+    assert labels == [IGNORE_IDX] + [1] * 4 + [IGNORE_IDX] + [2] * 2
+    assert len(packed[3][0]) == 10
+
+
+def test_padded_collate():
+    batch = [([1, 2, 3], [1, 2, 3]), ([4], [IGNORE_IDX])]
+    tokens, labels, doc_ids = packing.padded_collate(
+        batch, padding_idx=0, ignore_idx=IGNORE_IDX
+    )
+    assert tokens.tolist() == [[1, 2, 3], [4, 0, 0]]
+    assert labels.tolist() == [[1, 2, 3], [IGNORE_IDX] * 3]
+    assert doc_ids.tolist() == [[0, 0, 0], [0, -1, -1]]
+
+    packed = [([1, 2, 3], [IGNORE_IDX, 2, IGNORE_IDX], [0, 0, 1])]
+    _, _, doc_ids = packing.padded_collate(packed)
+    assert doc_ids.tolist() == [[0, 0, 1]]
+
+
+def test_length_bucket_sampler():
+    rng = random.Random(0)
+    lengths = [rng.randint(10, 500) for _ in range(1000)]
+    sampler = packing.LengthBucketSampler(lengths, batch_size=8, bucket_batches=10)
+
+    def batch_padding(batches):
+        padding = sum(
+            max(lengths[i] for i in b) * len(b) - sum(lengths[i] for i in b)
+            for b in batches
+        )
+        return padding / sum(lengths)
+
+    batches = list(sampler)
+    assert len(batches) == len(sampler) == 125
+    assert sorted(i for b in batches for i in b) == list(range(len(lengths)))
+    random_batches = [list(range(i, i + 8)) for i in range(0, len(lengths), 8)]
+    assert batch_padding(batches) < 0.1 < batch_padding(random_batches)
+
+    # deterministic per epoch
+    assert list(sampler) == batches
+    sampler.set_epoch(1)
+    assert list(sampler) != batches
+
+
+def test_forward_packed(tiny_llama):
+    """Logits of packed samples should match those of each sample on its own."""
+    model = tiny_llama()
+    lengths = [7, 4, 11]
+    torch.manual_seed(1)
+    samples = [torch.randint(1, 64, (length,)).tolist() for length in lengths]
+    with torch.no_grad():
+        expected = [model(torch.tensor([s]))[0] for s in samples]
+
+    ds = [(s, s) for s in samples]
+    packed = packing.PackedDataset(ds, max_seq_len=32)
+    assert len(packed) == 1
+    # second row is padded (to check padding doesn't affect the real tokens)
+    tokens, labels, doc_ids = packing.padded_collate(
+        [packed[0], (samples[0], samples[0])]
+    )
+
+    packing.enable_attention_masks(model)
+    utils.set_activation_checkpointing(
+        model, auto_wrap_policy={modules.TransformerDecoderLayer}
+    )
+    with torch.no_grad():
+        logits = packing.forward_packed(model, tokens, doc_ids)
+    torch.testing.assert_close(logits[0], torch.cat(expected), atol=1e-5, rtol=1e-4)
+    torch.testing.assert_close(logits[1, : lengths[0]], expected[0])
+
+    # gradients flow through recomputed (checkpointed) layers
+    model.train()
+    logits = packing.forward_packed(model, tokens, doc_ids)
+    loss = torch.nn.functional.cross_entropy(
+        logits[:, :-1].transpose(1, 2), labels[:, 1:], ignore_index=IGNORE_IDX
+    )
+    loss.backward()
+    assert model.tok_embeddings.weight.grad is not None
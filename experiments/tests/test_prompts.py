@@ -1,5 +1,6 @@
 import pytest
 import json
+import time
 import prompts as promptlib
 from prompts import SMARTFeedback
 import benchmark as benchmark
@@ -127,3 +128,98 @@ def test_build_judgement_prompt():
     }
 
     prompt, AttrModel = benchmark.build_judge_prompt(question, answer, other_attributes)
+
+
+def test_iter_json_objects():
+    text = """Here's my answer {with braces} in prose:
+```json
+{"a": "text with } and { and \\" chars", "b": {"c": [1, 2]}}
+```
+and {"d": 1}"""
+    objs = list(promptlib.iter_json_objects(text))
+    assert objs[1:] == [
+        '{"a": "text with } and { and \\" chars", "b": {"c": [1, 2]}}',
+        '{"d": 1}',
+    ]
+    assert list(promptlib.iter_json_objects('incomplete {"a": {"b": 1}')) == []
+
+
+def test_parse_pydantic_quirks():
+    class ScoreModel(BaseModel):
+        utility: int
+        comment: str
+
+    # the first object matching the model is used
+    res = promptlib.parse_pydantic(
+        'I\'d say {"utility"} {"utility": 5, "comment": "it\'s ok"}', ScoreModel
+    )
+    assert isinstance(res, ScoreModel) and res.utility == 5
+
+    quirky = [
+        '```json\n{"utility": 5, "comment": "fine"}\n```',
+        "{'utility': 5, 'comment': 'a \"quoted\" word'}",
+        '{"utility": 5, "comment": "trailing, }",}',
+        "{'utility': 5, 'comment': 'it\\'s fine',\n}",
+    ]
+    for i, text in enumerate(quirky):
+        res = promptlib.parse_pydantic(text, ScoreModel)
+        assert isinstance(res, ScoreModel), f"failed to parse {text}: {res}"
+        # (code fences don't require any repairs)
+        res = promptlib.parse_pydantic(text, ScoreModel, retry=False)
+        assert isinstance(res, ScoreModel) if i == 0 else isinstance(res, str)
+
+    assert promptlib.parse_pydantic("no json", ScoreModel) == (
+        "no json object found in text"
+    )
+    res = promptlib.parse_pydantic('{"utility": "x", "comment": ""}', ScoreModel)
+    assert isinstance(res, str) and res.startswith("validation error")
+
+
+def test_parse_pydantic_benchmark():
+    """Parsing (typical) LLM responses should be fast."""
+    _, ScoreModel = benchmark.build_judge_prompt("question", "answer")
+    responses = []
+    for i in range(10_000):
+        explanation = "The answer is helpful, but {vague} in places. " * 20
+        if i % 3 == 0:
+            responses.append(
+                f'{explanation}\n```json\n{{"utility": {i % 10 + 1}}}\n```'
+            )
+        elif i % 3 == 1:
+            responses.append(f"{explanation}\n{{'utility': {i % 10 + 1},}}")
+        else:
+            responses.append(f'{explanation} {{"utility": "bad"}}')
+
+    start_time = time.perf_counter()
+    results = [promptlib.parse_pydantic(text, ScoreModel) for text in responses]
+    duration = time.perf_counter() - start_time
+    print(f"parsed {len(responses)} responses in {duration:.3f} secs")
+
+    valid = [res for res in results if isinstance(res, ScoreModel)]
+    assert len(valid) == 6667
+    assert duration < 10
+
+
+def test_judge_template():
+    other_attributes = {"safety": promptlib.FEEDBACK_PRINCIPLES}
+    template = benchmark.JudgeTemplate(other_attributes)
+    ScoreModel = template.ScoreModel
+
+    # matches formatting the full template per prompt (including braces in answers)
+    question, answer = "what time is {it}", "don't ask me {that}"
+    expected = benchmark.judgement_template.format(
+        question=question,
+        answer=answer,
+        additional_attributes=f'\nAdditionally a "safety" score shall follow from the criteria:\n{promptlib.FEEDBACK_PRINCIPLES}\n',
+        format_schema=ScoreModel.model_json_schema(),
+        format_example=json.dumps({"utility": 5, "safety": 5}),
+    )
+    assert template.build_many([question], [answer]) == [expected]
+
+    scores = template.parse_scores(
+        ['{"utility": 7, "safety": 3}', "invalid", '{"utility": 11, "safety": 3}']
+    )
+    assert list(scores.columns) == ["utility", "safety"]
+    assert str(scores["utility"].dtype) == "Int64"
+    assert scores["utility"].tolist()[0] == 7
+    assert scores["utility"].isna().tolist() == [False, True, True]
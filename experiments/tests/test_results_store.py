@@ -0,0 +1,79 @@
+import os
+
+import pandas as pd
+from results_store import ResultsStore
+
+
+def test_results_store(tmp_path):
+    store = ResultsStore(str(tmp_path / "results"))
+    assert store.read("feedback", "gpt-4") is None
+    assert store.models("feedback") == []
+
+    df1 = pd.DataFrame({"goal_id": [1, 2], "response": ["a", "b"]})
+    df2 = pd.DataFrame({"goal_id": [3], "response": ["c"]})
+    store.append(df1, "feedback", "meta-llama/Llama-2-7b")
+    store.append(df2, "feedback", "meta-llama/Llama-2-7b")
+    assert store.exists("feedback", "meta-llama/Llama-2-7b")
+    assert not store.exists("feedback", "meta-llama/Llama-2-7b", judge="gpt-4")
+    assert store.models("feedback") == ["meta-llama/Llama-2-7b"]
+
+    # appended parts are read back in order (optionally only some columns)
+    df = store.read("feedback", "meta-llama/Llama-2-7b")
+    assert df is not None and df["goal_id"].tolist() == [1, 2, 3]
+    df = store.read("feedback", "meta-llama/Llama-2-7b", columns=["response"])
+    assert df is not None and list(df.columns) == ["response"]
+
+    # results are keyed by judge, and write() replaces existing results
+    store.write(df1, "benchmark", "gpt-3.5", judge="gpt-4")
+    store.write(df2, "benchmark", "gpt-3.5", judge="gpt-4")
+    assert store.read_all("benchmark") == {}
+    dfs = store.read_all("benchmark", judge="gpt-4")
+    assert list(dfs.keys()) == ["gpt-3.5"] and dfs["gpt-3.5"].equals(df2)
+
+
+def test_results_store_excel(tmp_path):
+    store = ResultsStore(str(tmp_path / "results"))
+    fname = str(tmp_path / "feedback.xlsx")
+    assert not store.export_excel("feedback", fname)
+
+    df = pd.DataFrame({"goal_id": [1, 2], "response": ["a", "b"]})
+    store.write(df, "feedback", "gpt-4")
+    assert store.export_excel("feedback", fname)
+
+    # importing (legacy) Excel files skips models already stored
+    other = ResultsStore(str(tmp_path / "other"))
+    assert other.import_excel(fname, "feedback") == 1
+    assert other.import_excel(fname, "feedback") == 0
+    res = other.read("feedback", "gpt-4")
+    assert res is not None and res.equals(df)
+
+    # (numeric sheet names are stored as strings)
+    fname = str(tmp_path / "numeric.xlsx")
+    with pd.ExcelWriter(fname) as writer:
+        df.to_excel(writer, sheet_name="2024", index=False)
+    assert other.import_excel(fname, "numeric") == 1
+    assert other.models("numeric") == ["2024"]
+
+
+def test_results_store_recover(tmp_path):
+    """A partition missing after a crash between write()'s renames is recovered."""
+    store = ResultsStore(str(tmp_path))
+    old_df = pd.DataFrame({"score": [1, 2]})
+    new_df = pd.DataFrame({"score": [3]})
+    part_dir = store.partition_dir("benchmark", "m", judge="j")
+
+    # crashed after swapping out the old partition (with the new one fully written)
+    store.write(old_df, "benchmark", "m", judge="j")
+    os.rename(part_dir, part_dir + ".old-1")
+    os.makedirs(part_dir + ".new-1")
+    store._write_part(new_df, part_dir + ".new-1")
+    assert store.exists("benchmark", "m", judge="j")
+    pd.testing.assert_frame_equal(store.read("benchmark", "m", judge="j"), new_df)
+
+    # crashed while writing the new partition (so the old one is recovered)
+    os.rename(part_dir, part_dir + ".old-2")
+    os.makedirs(part_dir + ".new-2")
+    assert store.models("benchmark", judge="j") == ["m"]
+    pd.testing.assert_frame_equal(store.read("benchmark", "m", judge="j"), new_df)
+
+    assert not store.exists("benchmark", "other", judge="j")
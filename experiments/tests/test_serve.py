@@ -0,0 +1,175 @@
+import json
+import threading
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("torchtune")
+from torchtune import utils  # noqa: E402
+import serve  # noqa: E402
+
+
+def expected_outputs(model, prompts, max_tokens):
+    """Greedy outputs of torchtune's (single sequence) generation."""
+    model.setup_caches(max_batch_size=1, dtype=torch.float32)
+    outputs = []
+    for prompt in prompts:
+        tokens = utils.generate(
+            model,
+            torch.tensor(prompt, dtype=torch.int),
+            max_generated_tokens=max_tokens,
+            top_k=1,
+        )
+        outputs.append(tokens[len(prompt) :])
+    return outputs
+
+
+PROMPTS = [[1, 5, 9, 13, 17, 21, 25], [1, 7], [1, 30, 31, 32], [1] + list(range(3, 20))]
+
+
+def test_engine(tiny_llama):
+    model = tiny_llama()
+    engine = serve.Engine(model, num_blocks=32, block_size=4, max_batch_size=2, top_k=1)
+    completions = engine.generate(PROMPTS, max_tokens=10)
+    assert [c.tokens for c in completions] == expected_outputs(model, PROMPTS, 10)
+    assert all(c.finish_reason == "length" for c in completions)
+    assert [c.prompt_tokens for c in completions] == [len(p) for p in PROMPTS]
+    # all blocks are returned once done
+    assert len(engine.cache.free_blocks) == 32 and engine.num_preempted == 0
+
+    # requests join the running batch as others finish (or stop at eos)
+    eos_id = completions[1].tokens[2]
+    engine.eos_id = eos_id
+    first = engine.submit(PROMPTS[0], max_tokens=10)
+    engine.step()
+    engine.step()
+    second = engine.submit(PROMPTS[1], max_tokens=10)
+    engine.step()
+    assert len(engine.running) == 2
+    while engine.step():
+        pass
+    assert second.result().finish_reason == "stop"
+    assert second.result().tokens == completions[1].tokens[:2]
+    assert first.result().tokens[:2] == completions[0].tokens[:2]
+
+
+def test_engine_preemption(tiny_llama):
+    model = tiny_llama()
+    # too few blocks for all sequences at once
+    engine = serve.Engine(model, num_blocks=10, block_size=4, max_batch_size=4, top_k=1)
+    completions = engine.generate(PROMPTS, max_tokens=12)
+    assert engine.num_preempted > 0
+    assert [c.tokens for c in completions] == expected_outputs(model, PROMPTS, 12)
+    assert len(engine.cache.free_blocks) == 10
+
+    with pytest.raises(ValueError):
+        engine.submit([1] * 40, max_tokens=10)  # more blocks than the cache has
+    with pytest.raises(ValueError):
+        engine.submit([1] * 64, max_tokens=10)  # exceeds max_seq_len
+
+
+class CharTokenizer:
+    eos_id = 2
+
+    def encode(self, text: str, add_bos: bool, add_eos: bool) -> list[int]:
+        return [1] + [3 + ord(c) % 61 for c in text[-20:]]
+
+    def decode(self, tokens: list[int]) -> str:
+        return "".join(chr(ord("a") + t % 26) for t in tokens)
+
+
+def test_chat_server(tiny_llama, monkeypatch):
+    import openai
+    from openai import OpenAI
+
+    model = tiny_llama()
+    engine = serve.Engine(model, num_blocks=32, block_size=4, top_k=1)
+    engine.start()
+    server = serve.ChatServer(
+        ("127.0.0.1", 0), engine, CharTokenizer(), "tiny", max_tokens=5
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        client = OpenAI(
+            api_key="unused", base_url=f"http://127.0.0.1:{server.server_port}/v1"
+        )
+        assert [m.id for m in client.models.list()] == ["tiny"]
+
+        messages = [{"role": "user", "content": "Hallo!"}]
+        completion = client.chat.completions.create(model="tiny", messages=messages)
+        prompt_tokens = CharTokenizer().encode(serve.format_chat(messages), True, False)
+        expected = expected_outputs(model, [prompt_tokens], 5)[0]
+        assert completion.choices[0].message.content == CharTokenizer().decode(expected)
+        assert completion.choices[0].finish_reason == "length"
+        assert completion.usage.prompt_tokens == len(prompt_tokens)
+        assert completion.usage.completion_tokens == 5
+
+        completion = client.chat.completions.create(
+            model="tiny", messages=messages, max_tokens=2
+        )
+        assert completion.usage.completion_tokens == 2
+
+        # requests aborted by a failed engine step get an (OpenAI style) server error
+        def fail():
+            raise RuntimeError("out of memory")
+
+        monkeypatch.setattr(engine, "step", fail)
+        with pytest.raises(openai.InternalServerError, match="out of memory"):
+            client.with_options(max_retries=0).chat.completions.create(
+                model="tiny", messages=messages
+            )
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def post(url: str, body: dict) -> int:
+    """Status code of a POST request with a JSON body."""
+    request = urllib.request.Request(
+        url,
+        data=json.dumps(body).encode(),
+        headers={"Content-Type": "application/json"},
+    )
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def test_chat_server_invalid_requests(tiny_llama):
+    """Invalid requests are rejected (400) without aborting the other requests in the batch."""
+    engine = serve.Engine(tiny_llama(), num_blocks=32, block_size=4, top_k=1)
+    engine.start()
+    server = serve.ChatServer(
+        ("127.0.0.1", 0), engine, CharTokenizer(), "tiny", max_tokens=20
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/v1/chat/completions"
+    messages = [{"role": "user", "content": "Hallo!"}]
+    try:
+        good = {"messages": messages}
+        bad = [
+            {"messages": messages, "temperature": -1},
+            {"messages": messages, "temperature": "hot"},
+            {"messages": messages, "max_tokens": "5"},
+            {"messages": messages, "max_tokens": 0},
+            {"messages": [{"role": "user", "content": ["Hallo!"]}]},
+            {"messages": "Hallo!"},
+            [messages],
+        ]
+        with ThreadPoolExecutor(len(bad) + 2) as pool:
+            good_statuses = [
+                pool.submit(post, url, good),
+                # (null is the default temperature)
+                pool.submit(post, url, {**good, "temperature": None}),
+            ]
+            bad_statuses = [pool.submit(post, url, body) for body in bad]
+            assert [f.result() for f in bad_statuses] == [400] * len(bad)
+            assert [f.result() for f in good_statuses] == [200, 200]
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,67 @@
+import os
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("torchtune")
+from torch.utils.data import DataLoader  # noqa: E402
+import token_cache  # noqa: E402
+import packing  # noqa: E402
+
+
+def test_load_cached(tmp_path, counting_dataset, fake_tokenizer):
+    lengths = [3, 1, 4, 1, 5, 9, 2, 6]
+    ds = counting_dataset(lengths)
+    cache_dir = str(tmp_path)
+
+    cached = token_cache.load_cached(ds, fake_tokenizer(), cache_dir, "source: a")
+    assert ds.calls == len(lengths)
+    assert len(cached) == len(lengths)
+    assert cached.lengths.tolist() == lengths
+    for idx in range(len(ds)):
+        tokens, labels = cached[idx]
+        assert tokens.tolist() == ds[idx][0]
+        assert labels.tolist() == ds[idx][1]
+    with pytest.raises(IndexError):
+        cached[len(lengths)]
+
+    # cache hit (nothing is tokenized)
+    ds2 = counting_dataset(lengths)
+    cached = token_cache.load_cached(ds2, fake_tokenizer(), cache_dir, "source: a")
+    assert ds2.calls == 0
+    assert len(os.listdir(cache_dir)) == 1
+
+    # different tokenizer, template or dataset config
+    token_cache.load_cached(ds2, fake_tokenizer(32), cache_dir, "source: a")
+    token_cache.load_cached(ds2, fake_tokenizer(), cache_dir, "source: b")
+    ds2.train_on_input = False
+    token_cache.load_cached(ds2, fake_tokenizer(), cache_dir, "source: a")
+    assert len(os.listdir(cache_dir)) == 4
+
+    # train/val split views
+    val = cached.select(range(2))
+    train = cached.select(range(2, len(cached)))
+    assert val.lengths.tolist() == lengths[:2]
+    assert train.lengths.tolist() == lengths[2:]
+    assert train[0][0].tolist() == [3] * 4
+    assert train.select(range(1, 3)).lengths.tolist() == lengths[3:5]
+    assert len(cached.select(range(5, 2))) == 0
+
+
+def test_dataloader_workers(tmp_path, counting_dataset, fake_tokenizer):
+    lengths = [3, 1, 4, 1, 5, 9, 2, 6]
+    ds = counting_dataset(lengths)
+    cached = token_cache.load_cached(ds, fake_tokenizer(), str(tmp_path), "")
+
+    assert packing.get_lengths(cached) == lengths
+    loader = DataLoader(
+        cached, batch_size=4, collate_fn=packing.padded_collate, num_workers=2
+    )
+    batches = list(loader)
+    tokens, labels, doc_ids = batches[1]
+    assert tokens[0].tolist() == [5] * 5 + [0] * 4
+    assert (doc_ids >= 0).sum(dim=1).tolist() == lengths[4:]
+
+    packed = packing.PackedDataset(cached, max_seq_len=10)
+    tokens, labels, doc_ids = packed[0]
+    assert tokens == [1] * 3 + [2] + [3] * 4 + [4]
+    assert labels[:4] == [-100, 1, 1, -100]
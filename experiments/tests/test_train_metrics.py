@@ -0,0 +1,94 @@
+import threading
+
+import pytest
+
+torch = pytest.importorskip("torch")
+import train_metrics  # noqa: E402
+
+
+class ListLogger:
+    def __init__(self, fail_step=None):
+        self.logged = []
+        self.closed = False
+        self.fail_step = fail_step
+
+    def log_dict(self, payload, step):
+        if step == self.fail_step:
+            raise ValueError("logger unavailable")
+        self.logged.append((step, payload))
+
+    def close(self):
+        self.closed = True
+
+
+def test_metrics_accumulator():
+    metrics = train_metrics.MetricsAccumulator()
+    loss = torch.tensor(1.0, requires_grad=True)
+    metrics.add("loss", loss)
+    metrics.add("loss", torch.tensor(2.0))
+    metrics.add("loss", 4.0, count=2)  # (average of 2 items)
+    metrics.add("acc", torch.tensor(0.5))
+    assert len(metrics) == 2
+
+    pending = metrics.flush()
+    assert not pending.sums.requires_grad
+    assert pending.to_dict() == {"loss": pytest.approx(11 / 4), "acc": 0.5}
+    assert len(metrics) == 0
+    assert metrics.flush().to_dict() == {}
+
+    metrics.add("loss", torch.tensor(3.0))
+    assert metrics.flush().to_dict() == {"loss": 3.0}
+
+
+def test_async_metric_logger():
+    logger = ListLogger(fail_step=2)
+    seen = []
+    async_logger = train_metrics.AsyncMetricLogger(
+        logger, callback=lambda payload, step: seen.append(step), max_pending=1
+    )
+    metrics = train_metrics.MetricsAccumulator()
+    for step in range(5):
+        metrics.add("loss", torch.tensor(float(step)))
+        async_logger.log_dict({"metrics": metrics.flush(), "lr": 0.1}, step=step)
+    async_logger.wait()
+    assert seen == [0, 1, 3, 4]  # (failing to log doesn't stop the logging thread)
+
+    async_logger.log_dict({"val_loss": 1.5}, step=5)
+    async_logger.close()
+    assert logger.closed
+    assert [step for step, _ in logger.logged] == [0, 1, 3, 4, 5]
+    assert logger.logged[1] == (1, {"lr": 0.1, "loss": 1.0})
+    assert logger.logged[-1] == (5, {"val_loss": 1.5})
+
+
+def test_async_metric_logger_doesnt_block():
+    """log_dict() returns while the logger is busy (up to max_pending payloads), keeping it off the training step."""
+    busy, release = threading.Event(), threading.Event()
+    logger = ListLogger()
+    log_dict = logger.log_dict
+
+    def slow_log_dict(payload, step):
+        busy.set()
+        release.wait()
+        log_dict(payload, step)
+
+    logger.log_dict = slow_log_dict
+    async_logger = train_metrics.AsyncMetricLogger(logger, max_pending=2)
+    async_logger.log_dict({"loss": 0.0}, step=0)
+    busy.wait()
+    for step in (1, 2):  # (pending while step 0 is being logged)
+        async_logger.log_dict({"loss": float(step)}, step=step)
+    assert logger.logged == []
+
+    # once max_pending payloads are queued, log_dict() waits for the logger
+    blocked = threading.Thread(
+        target=async_logger.log_dict, args=({"loss": 3.0}, 3), daemon=True
+    )
+    blocked.start()
+    blocked.join(timeout=0.1)
+    assert blocked.is_alive()
+
+    release.set()
+    blocked.join()
+    async_logger.close()
+    assert [step for step, _ in logger.logged] == [0, 1, 2, 3]
@@ -0,0 +1,130 @@
+"""
+Adapter-only checkpointing for lora_finetune_single_device.py (checkpoint_mode: adapter).
+Checkpoints are written by a background thread, with the adapter weights as safetensors.
+Merging an adapter into the base model's weights is deferred to the export command below, e.g.:
+    EXP_NAME=changeme tune run recipes/checkpointing.py --config ./llama2_7B_qlora_single_device.yaml epoch=3
+writing the merged weights (e.g. hf_model_0001_3.pt) for generate.py to the experiment's dir.
+"""
+
+import os
+import queue
+import sys
+import threading
+from typing import Any, Callable, Dict, Optional
+
+import torch
+from omegaconf import DictConfig
+from safetensors.torch import load_file, save_file
+from torchtune import config, utils
+from torchtune.modules.peft.peft_utils import get_merged_lora_ckpt
+
+log = utils.get_logger("DEBUG")
+
+
+RECIPE_STATE_FNAME = "recipe_state.pt"  # (same as torchtune's checkpointers)
+
+
+def adapter_fname(epoch: int) -> str:
+    return f"adapter_{epoch}.safetensors"
+
+
+def snapshot(obj: Any) -> Any:
+    """Copy of (the tensors in) a (nested) state dict on CPU, unaffected by later (in place) updates."""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {k: snapshot(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v) for v in obj)
+    return obj
+
+
+class AsyncCheckpointWriter:
+    """
+    Writes checkpoints in a background thread (in order), so training only waits for tensors to be copied.
+    Files are written atomically (to a temporary file first). An exception in the writer thread is raised by
+    the next call to save_*() or wait().
+    """
+
+    def __init__(self):
+        self._queue: queue.Queue = queue.Queue()
+        self._error: Optional[BaseException] = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def save_safetensors(self, state_dict: Dict[str, torch.Tensor], path: str):
+        self._submit(save_file, state_dict, path)
+
+    def save_torch(self, obj: Any, path: str):
+        self._submit(torch.save, obj, path)
+
+    def wait(self):
+        """Blocks until all checkpoints are written."""
+        self._queue.join()
+        self._raise_error()
+
+    def _submit(self, write: Callable[[Any, str], None], obj: Any, path: str):
+        self._raise_error()
+        self._queue.put((write, snapshot(obj), path))
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError("failed to write checkpoint") from error
+
+    def _run(self):
+        while True:
+            write, obj, path = self._queue.get()
+            try:
+                tmp_path = f"{path}.tmp"
+                write(obj, tmp_path)
+                os.replace(tmp_path, path)
+                log.info(
+                    f"checkpoint of size {os.path.getsize(path) / 1000**2:.1f} MB saved to {path}"
+                )
+            except BaseException as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+
+def load_adapter(path: str) -> Dict[str, torch.Tensor]:
+    return load_file(path)
+
+
+def merge_adapter(
+    base_state_dict: Dict[str, torch.Tensor],
+    adapter_state_dict: Dict[str, torch.Tensor],
+    rank: int,
+    alpha: float,
+) -> Dict[str, torch.Tensor]:
+    """Base model weights with the LoRA adapter merged into them (see get_merged_lora_ckpt())."""
+    return get_merged_lora_ckpt(
+        {**base_state_dict, **adapter_state_dict}, rank=rank, alpha=alpha
+    )
+
+
+@config.parse
+def main(cfg: DictConfig) -> None:
+    """
+    Export command merging the adapter of a given epoch (saved with checkpoint_mode: adapter) into the base model,
+    with the finetuning config (for the base model checkpoint and the LoRA rank/alpha).
+    """
+    epoch = cfg.epoch
+    adapter_path = os.path.join(cfg.checkpointer.output_dir, adapter_fname(epoch))
+    checkpointer = config.instantiate(
+        cfg.checkpointer, resume_from_checkpoint=False, adapter_checkpoint=None
+    )
+    base_state_dict = checkpointer.load_checkpoint()[utils.MODEL_KEY]
+    log.info(f"merging adapter '{adapter_path}' into base model")
+    merged_state_dict = merge_adapter(
+        base_state_dict,
+        load_adapter(adapter_path),
+        rank=cfg.model.lora_rank,
+        alpha=cfg.model.lora_alpha,
+    )
+    checkpointer.save_checkpoint({utils.MODEL_KEY: merged_state_dict}, epoch=epoch)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
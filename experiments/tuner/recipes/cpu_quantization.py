@@ -0,0 +1,147 @@
+"""
+Weight-only int8/int4 quantization of a model's linear layers for CPU inference with generate.py (cpu_quantization).
+Unlike torchtune's quantizers (targeting CUDA, and loading checkpoints quantized beforehand), full precision
+checkpoints are quantized when loaded, with matmuls using PyTorch's (multi-threaded) CPU kernels for int8/int4 weights.
+"""
+
+import os
+import resource
+import sys
+from typing import Optional
+
+import torch
+from torch import nn
+
+MODES = ("int8", "int4")
+# inner k tiles of the packed int4 weights (see torch.ops.aten._convert_weight_to_int4pack)
+INT4_INNER_K_TILES = 8
+
+
+class Int8WeightOnlyLinear(nn.Module):
+    """nn.Linear with int8 weights (symmetric, with a scale per output channel)."""
+
+    def __init__(self, linear: nn.Linear):
+        super().__init__()
+        weight = linear.weight.detach().float()
+        scales = weight.abs().amax(dim=1).clamp(min=1e-8) / 127
+        self.out_features, self.in_features = weight.shape
+        self.register_buffer(
+            "weight",
+            torch.round(weight / scales[:, None]).clamp(-128, 127).to(torch.int8),
+        )
+        self.register_buffer("scales", scales.to(torch.bfloat16))
+        self.bias = linear.bias
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        # (the CPU kernel requires bf16 activations)
+        out = torch.ops.aten._weight_int8pack_mm(
+            x.reshape(-1, self.in_features).to(torch.bfloat16), self.weight, self.scales
+        )
+        out = out.reshape(*x.shape[:-1], self.out_features).to(x.dtype)
+        return out if self.bias is None else out + self.bias
+
+
+class Int4WeightOnlyLinear(nn.Module):
+    """
+    nn.Linear with int4 weights (asymmetric, with a scale and zero point per group of groupsize input channels),
+    packed two per byte.
+    """
+
+    def __init__(self, linear: nn.Linear, groupsize: int = 128):
+        super().__init__()
+        assert int4_supported(linear, groupsize)
+        weight = linear.weight.detach().float()
+        self.out_features, self.in_features = weight.shape
+        self.groupsize = groupsize
+
+        groups = weight.reshape(self.out_features, -1, groupsize)
+        min_val = groups.amin(dim=-1, keepdim=True)
+        scales = (groups.amax(dim=-1, keepdim=True) - min_val).clamp(min=1e-6) / 15
+        # (the kernel dequantizes as (q - 8) * scale + zero)
+        zeros = min_val + scales * 8
+        quantized = ((groups - min_val) / scales).round().clamp(0, 15)
+        self.register_buffer(
+            "weight",
+            torch.ops.aten._convert_weight_to_int4pack(
+                quantized.reshape(self.out_features, -1).to(torch.int32),
+                INT4_INNER_K_TILES,
+            ),
+        )
+        # shape: [in_features / groupsize, out_features, 2]
+        self.register_buffer(
+            "scales_and_zeros",
+            torch.stack([scales.squeeze(-1), zeros.squeeze(-1)], dim=-1)
+            .transpose(0, 1)
+            .contiguous()
+            .to(torch.bfloat16),
+        )
+        self.bias = linear.bias
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        out = torch.ops.aten._weight_int4pack_mm(
+            x.reshape(-1, self.in_features).to(torch.bfloat16),
+            self.weight,
+            self.groupsize,
+            self.scales_and_zeros,
+        )
+        out = out.reshape(*x.shape[:-1], self.out_features).to(x.dtype)
+        return out if self.bias is None else out + self.bias
+
+
+def int4_supported(linear: nn.Linear, groupsize: int) -> bool:
+    """Whether the shape of a linear layer's weights can be packed for the int4 kernel."""
+    out_features, in_features = linear.weight.shape
+    return (
+        groupsize in (32, 64, 128, 256)
+        and in_features % groupsize == 0
+        and in_features % (INT4_INNER_K_TILES * 16) == 0
+        and out_features % 8 == 0
+    )
+
+
+def quantize(model: nn.Module, mode: str, groupsize: int = 128) -> nn.Module:
+    """
+    Replace (in place) the model's linear layers with weight-only quantized ones.
+    With mode int4, layers whose shape isn't supported by the int4 kernel are quantized to int8 instead.
+    """
+    if mode not in MODES:
+        raise ValueError(f"unknown cpu_quantization '{mode}', expected one of {MODES}")
+    for module in list(model.modules()):
+        for child_name, child in list(module.named_children()):
+            if type(child) is not nn.Linear:
+                continue
+            if mode == "int4" and int4_supported(child, groupsize):
+                quantized: nn.Module = Int4WeightOnlyLinear(child, groupsize)
+            else:
+                quantized = Int8WeightOnlyLinear(child)
+            setattr(module, child_name, quantized)
+    return model
+
+
+def set_num_threads(num_threads: Optional[int] = None) -> int:
+    """Threads used by CPU matmuls (defaults to all the CPUs available to this process)."""
+    if num_threads is None:
+        num_threads = (
+            len(os.sched_getaffinity(0))
+            if hasattr(os, "sched_getaffinity")
+            else os.cpu_count() or 1
+        )
+    torch.set_num_threads(num_threads)
+    return num_threads
+
+
+def rss_bytes() -> int:
+    """Current resident set size of this process (the peak where /proc isn't available, e.g. on macOS)."""
+    try:
+        with open("/proc/self/statm") as f:
+            resident_pages = int(f.read().split()[1])
+    except OSError:
+        return peak_rss_bytes()
+    return resident_pages * os.sysconf("SC_PAGE_SIZE")
+
+
+def peak_rss_bytes() -> int:
+    """Peak resident set size of this process."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # (reported in bytes on macOS, kilobytes on Linux)
+    return peak if sys.platform == "darwin" else peak * 1024
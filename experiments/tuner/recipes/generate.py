@@ -9,7 +9,8 @@ import itertools
 import os
 import sys
 import time
-from typing import Any, Dict, List, Optional, Tuple
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 import torch
 from omegaconf import DictConfig
@@ -18,6 +19,8 @@ from torch import nn
 
 from torchtune import config, utils
 from torchtune.data import AlpacaInstructTemplate
+from torchtune.modules import KVCache
+from torchtune.utils._generation import multinomial_sample_one, sample
 
 import pandas as pd
 
@@ -27,11 +30,13 @@ from openai.types.chat.chat_completion import ChatCompletion
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 EXPERIMENTS_DIR = os.path.realpath(os.path.join(SCRIPT_DIR, "../.."))
 sys.path.append(EXPERIMENTS_DIR)
+sys.path.append(SCRIPT_DIR)
+import cpu_quantization  # noqa: E402
 from AbstractModel import AbstractModel, IPrompt  # noqa: E402
 from gpt import GPTModel  # noqa: E402
 import config as projconfig  # noqa: E402
+from prompts import FLUENCY_QUESTION  # noqa: E402
 
-FLUENCY_QUESTION = "provide a paragraph of feedback in Dutch on a student's assignment."
 FNAME_GOALS = os.path.join(
     projconfig.DATASETS_DIR, "synthetic_smart/v4/smart_goals.csv"
 )
@@ -43,8 +48,12 @@ class InferenceRecipe(AbstractModel):
     """
     Recipe for generating tokens from a dense Transformer-based LLM.
 
-    Currently this recipe supports single-GPU generation only. Speculative
-    decoding is not supported.
+    Currently this recipe supports single-GPU generation only.
+    On CPU (device: cpu), the checkpoint's linear layers can be quantized to int8/int4 weights when loaded
+    (cfg.cpu_quantization), see cpu_quantization.py.
+    Multiple prompts are generated in (left-padded) batches of cfg.batch_size, see generate_batch().
+    When a cfg.draft_model is given, prompts are instead generated one at a time with speculative decoding
+    (see generate_speculative()).
 
     For more details on how to use this recipe for generation, please see our
     tutorial: https://pytorch.org/torchtune/main/tutorials/e2e_flow.html#generation
@@ -56,11 +65,26 @@ class InferenceRecipe(AbstractModel):
 
     def __init__(self, cfg: DictConfig) -> None:
         self._device = utils.get_device(device=cfg.device)
-        self._dtype = utils.get_dtype(dtype=cfg.dtype)
+        self._dtype = utils.get_dtype(dtype=cfg.dtype, device=self._device)
         self._quantizer = config.instantiate(cfg.quantizer)
         self._quantization_mode = utils.get_quantizer_mode(self._quantizer)
+        self._cpu_quantization = cfg.get("cpu_quantization")
+        self._cpu_quantization_groupsize = cfg.get("cpu_quantization_groupsize", 128)
+        if self._cpu_quantization is not None:
+            if self._device.type != "cpu":
+                raise ValueError("cpu_quantization requires device: cpu")
+            if self._quantization_mode is not None:
+                raise ValueError("cpu_quantization can't be combined with a quantizer")
+        if self._device.type == "cpu":
+            num_threads = cpu_quantization.set_num_threads(cfg.get("num_threads"))
+            logger.info(f"Using {num_threads} threads for CPU inference")
 
         self.alpaca_template = AlpacaInstructTemplate()
+        self._batch_size = cfg.get("batch_size", 1)
+        self._speculate_k = cfg.get("speculate_k", 4)
+        if cfg.get("draft_model") is not None:
+            # speculative decoding generates a single sequence at a time
+            self._batch_size = 1
 
         utils.set_seed(seed=cfg.seed)
 
@@ -80,6 +104,38 @@ class InferenceRecipe(AbstractModel):
         )
         self._tokenizer = config.instantiate(cfg.tokenizer)
 
+        self._draft_model = None
+        if cfg.get("draft_model") is not None:
+            # (the draft model must share the model's tokenizer)
+            draft_ckpt_dict = config.instantiate(
+                cfg.draft_checkpointer
+            ).load_checkpoint()
+            self._draft_model = self._setup_model(
+                model_cfg=cfg.draft_model,
+                model_state_dict=draft_ckpt_dict[utils.MODEL_KEY],
+            )
+
+        # computed once (rather than per prompt), for reporting the bandwidth achieved
+        self._model_size = _model_size(self._model)
+        self._draft_size = _model_size(self._draft_model) if self._draft_model else 0
+        self._decode_step: Optional[Callable] = None
+        if self._quantization_mode is not None and self._draft_model is None:
+            self._compile(cfg)
+
+    def _compile(self, cfg: DictConfig) -> None:
+        """
+        Compile the decode step once, warming it up (since quantized model uses torch.compile to get speedup).
+        Batches are always padded to batch_size, so its input shapes are static (and it's never recompiled).
+        """
+        logger.info("Starting compilation to improve generation performance ...")
+        self._decode_step = torch.compile(
+            decode_step, mode="max-autotune", fullgraph=True
+        )
+        t0 = time.perf_counter()
+        self._generate_batch(cfg, [[self._tokenizer.bos_id]], max_generated_tokens=2)
+        t = time.perf_counter() - t0
+        logger.info(f"Warmup run for quantized model takes: {t:.02f} sec")
+
     def _setup_model(
         self,
         model_cfg: DictConfig,
@@ -97,83 +153,391 @@ class InferenceRecipe(AbstractModel):
         # Validate model was loaded in with the expected dtype.
         utils.validate_expected_param_dtype(model.named_parameters(), dtype=self._dtype)
         logger.info(f"Model is initialized with precision {self._dtype}.")
+        if self._cpu_quantization is not None:
+            model = cpu_quantization.quantize(
+                model, self._cpu_quantization, self._cpu_quantization_groupsize
+            )
+            logger.info(f"Model is quantized to {self._cpu_quantization} weights.")
 
         # Ensure the cache is setup on the right device
         with self._device:
-            model.setup_caches(max_batch_size=1, dtype=self._dtype)
+            model.setup_caches(max_batch_size=self._batch_size, dtype=self._dtype)
 
         return model
 
+    def _generate_batch(
+        self,
+        cfg: DictConfig,
+        batch: List[List[int]],
+        max_generated_tokens: Optional[int] = None,
+    ) -> List[List[int]]:
+        return generate_batch(
+            model=self._model,
+            prompts=batch,
+            max_generated_tokens=max_generated_tokens or cfg.max_new_tokens,
+            # (llama2's tokenizer has no pad token, i.e. pad_id=-1, its value is irrelevant as it's masked)
+            pad_id=max(self._tokenizer.pad_id, 0),
+            temperature=cfg.temperature,
+            top_k=cfg.top_k,
+            eos_id=self._tokenizer.eos_id,
+            batch_size=self._batch_size,
+            custom_decode_step=self._decode_step,
+        )
+
     def __call__(
         self,
         prompts: List[IPrompt],
         cfg: DictConfig,
         verbose: bool = True,
     ) -> Tuple[List[str], List[ChatCompletion]]:
-        raw_outputs = [
-            self.generate(cfg, prompt, verbose=verbose) for prompt in prompts
+        encoded = [
+            self._tokenizer.encode(prompt, add_bos=True, add_eos=False)
+            for prompt in prompts
         ]
-        return raw_outputs, None
-
-    @torch.no_grad()
-    def generate(self, cfg: DictConfig, prompt: str, verbose: bool = True):
-        tokens = self._tokenizer.encode(prompt, add_bos=True, add_eos=False)
-        prompt = torch.tensor(tokens, dtype=torch.int, device=self._device)
+        logf = logger.info if verbose else logger.debug
+        if self._draft_model is not None:
+            return self._call_speculative(cfg, encoded, logf)
+
+        # batch prompts of similar length together (minimizing padding)
+        order = sorted(range(len(encoded)), key=lambda i: len(encoded[i]))
+        raw_outputs: List[str] = [""] * len(encoded)
+        total_tokens, total_steps, t0 = 0, 0, time.perf_counter()
+        for start in range(0, len(order), self._batch_size):
+            idxs = order[start : start + self._batch_size]
+            batch = [encoded[i] for i in idxs]
+            generated = self._generate_batch(cfg, batch)
+            for i, tokens, new_tokens in zip(idxs, batch, generated):
+                raw_outputs[i] = self._tokenizer.decode(tokens + new_tokens)
+                total_tokens += len(new_tokens)
+            # (the model is read once per step for the whole batch)
+            total_steps += max(len(new_tokens) for new_tokens in generated)
+            logf(f"generated {start + len(batch)}/{len(encoded)} prompts")
 
-        custom_generate_next_token = None
-
-        logf = logger.info if verbose else logger.debug  # logger function
+        t = time.perf_counter() - t0
+        logf(
+            f"Time for inference: {t:.02f} sec total, {total_tokens / t:.02f} tokens/sec "
+            f"({len(encoded)} prompts, batch_size={self._batch_size})"
+        )
+        logf(
+            f"Bandwidth achieved: {self._model_size * total_steps / t / 1e9:.02f} GB/s"
+        )
+        logf(_memory_used(self._device))
+        return raw_outputs, None
 
-        # since quantized model uses torch.compile to get speedup, it needs a warm up / prefill run
-        # to get the accurate performance measurement
-        if self._quantization_mode is not None:
-            logf("Starting compilation to improve generation performance ...")
-            custom_generate_next_token = torch.compile(
-                utils.generate_next_token, mode="max-autotune", fullgraph=True
-            )
-            t0 = time.perf_counter()
-            _ = utils.generate(
+    def _call_speculative(
+        self, cfg: DictConfig, encoded: List[List[int]], logf: Callable
+    ) -> Tuple[List[str], None]:
+        assert self._draft_model is not None
+        raw_outputs = []
+        stats = SpeculativeStats()
+        total_tokens, t0 = 0, time.perf_counter()
+        for i, tokens in enumerate(encoded):
+            new_tokens = generate_speculative(
                 model=self._model,
-                prompt=prompt,
-                max_generated_tokens=2,
+                draft_model=self._draft_model,
+                prompt=tokens,
+                max_generated_tokens=cfg.max_new_tokens,
+                k=self._speculate_k,
                 temperature=cfg.temperature,
                 top_k=cfg.top_k,
                 eos_id=self._tokenizer.eos_id,
-                custom_generate_next_token=custom_generate_next_token,
+                stats=stats,
             )
-            t = time.perf_counter() - t0
-            logf(f"Warmup run for quantized model takes: {t:.02f} sec")
+            raw_outputs.append(self._tokenizer.decode(tokens + new_tokens))
+            total_tokens += len(new_tokens)
+            logf(f"generated {i + 1}/{len(encoded)} prompts")
 
-        t0 = time.perf_counter()
-        generated_tokens = utils.generate(
-            model=self._model,
-            prompt=prompt,
-            max_generated_tokens=cfg.max_new_tokens,
-            temperature=cfg.temperature,
-            top_k=cfg.top_k,
-            eos_id=self._tokenizer.eos_id,
-            custom_generate_next_token=custom_generate_next_token,
-        )
         t = time.perf_counter() - t0
+        bytes_read = (
+            self._model_size * stats.forwards + self._draft_size * stats.draft_forwards
+        )
+        logf(
+            f"Time for inference: {t:.02f} sec total, {total_tokens / t:.02f} tokens/sec "
+            f"({len(encoded)} prompts, speculate_k={self._speculate_k})"
+        )
+        logf(f"Bandwidth achieved: {bytes_read / t / 1e9:.02f} GB/s")
+        logf(
+            f"Draft acceptance rate: {stats.acceptance_rate:.1%}, "
+            f"{stats.tokens_per_forward:.02f} tokens per forward pass of the model"
+        )
+        logf(_memory_used(self._device))
+        return raw_outputs, None
 
-        raw_output = self._tokenizer.decode(generated_tokens)
-        logf(raw_output)
+    def generate(self, cfg: DictConfig, prompt: str, verbose: bool = True) -> str:
+        raw_output = self([prompt], cfg, verbose=verbose)[0][0]
+        logger.info(raw_output)
+        return raw_output
+
+
+def _model_size(model: nn.Module) -> int:
+    """
+    Size of a model's weights in bytes (including buffers such as quantized weights, but not its KV caches,
+    of which only the part up to the current position is read by a forward pass).
+    """
+    kv_caches = {
+        id(b) for m in model.modules() if isinstance(m, KVCache) for b in m.buffers()
+    }
+    return sum(
+        p.numel() * p.dtype.itemsize
+        for p in itertools.chain(model.parameters(), model.buffers())
+        if id(p) not in kv_caches
+    )
+
+
+def _memory_used(device: torch.device) -> str:
+    if device.type == "cuda":
+        return f"Memory used: {torch.cuda.max_memory_allocated() / 1e9:.02f} GB"
+    # (including the memory used by the process for anything besides the model)
+    return (
+        f"Memory used: {cpu_quantization.rss_bytes() / 1e9:.02f} GB RSS "
+        f"(peak {cpu_quantization.peak_rss_bytes() / 1e9:.02f} GB)"
+    )
 
-        model_size = sum(
-            [
-                p.numel() * p.dtype.itemsize
-                for p in itertools.chain(
-                    self._model.parameters(), self._model.buffers()
-                )
-            ]
+
+def _forward(
+    model: nn.Module, tokens: torch.Tensor, input_pos: torch.Tensor, mask: torch.Tensor
+) -> torch.Tensor:
+    """TransformerDecoder.forward() with a given attention mask (per sequence) rather than its causal mask."""
+    h = model.tok_embeddings(tokens)
+    for layer in model.layers:
+        h = layer(h, mask, input_pos)
+    return model.output(model.norm(h)).float()
+
+
+def decode_step(
+    model: nn.Module,
+    x: torch.Tensor,
+    input_pos: torch.Tensor,
+    mask: torch.Tensor,
+    temperature: float = 1.0,
+    top_k: Optional[int] = None,
+) -> torch.Tensor:
+    """Sample the next token of each sequence, shape [b, 1] (see generate_batch())."""
+    logits = _forward(model, x, input_pos, mask)
+    return sample(logits[:, -1], temperature=temperature, top_k=top_k)
+
+
+@torch.inference_mode()
+def generate_batch(
+    model: nn.Module,
+    prompts: List[List[int]],
+    max_generated_tokens: int,
+    pad_id: int = 0,
+    temperature: float = 1.0,
+    top_k: Optional[int] = None,
+    eos_id: Optional[int] = None,
+    batch_size: Optional[int] = None,
+    custom_decode_step: Optional[Callable] = None,
+) -> List[List[int]]:
+    """
+    Batched version of torchtune's utils.generate(), for a model with caches setup for batch_size sequences.
+    Prompts are left-padded (so all sequences decode at the same position), with padding masked out of attention.
+    Decoding stops early once every sequence has generated eos_id.
+    batch_size: pad the batch to this many sequences (default len(prompts)), keeping shapes static
+        (e.g. for a compiled custom_decode_step, see decode_step()).
+    Returns the generated tokens of each prompt (up to and including eos_id).
+    """
+    num_prompts = len(prompts)
+    bsz = batch_size or num_prompts
+    if num_prompts > bsz:
+        raise ValueError(f"{num_prompts} prompts don't fit in batch_size={bsz}")
+    prompts = prompts + [[pad_id]] * (bsz - num_prompts)
+    custom_decode_step = custom_decode_step or decode_step
+    prompt_len = max(len(p) for p in prompts)
+    if model.max_seq_len < (prompt_len + max_generated_tokens) - 1:
+        raise ValueError(
+            f"Models maximum seq length {model.max_seq_len} should be >= "
+            f"{(prompt_len + max_generated_tokens)} - 1"
         )
 
-        tokens_generated = len(generated_tokens) - prompt.size(0)
-        tokens_sec = tokens_generated / t
-        logf(f"Time for inference: {t:.02f} sec total, {tokens_sec:.02f} tokens/sec")
-        logf(f"Bandwidth achieved: {model_size * tokens_sec / 1e9:.02f} GB/s")
-        logf(f"Memory used: {torch.cuda.max_memory_allocated() / 1e9:.02f} GB")
-        return raw_output
+    device = model.tok_embeddings.weight.device
+    tokens = torch.full((bsz, prompt_len), pad_id, dtype=torch.int, device=device)
+    for i, p in enumerate(prompts):
+        tokens[i, prompt_len - len(p) :] = torch.tensor(p, dtype=torch.int)
+
+    # (RoPE only depends on relative positions, so shared positions are fine despite the padding offsets)
+    positions = torch.arange(model.max_seq_len, device=device)
+    pad_lens = torch.tensor([prompt_len - len(p) for p in prompts], device=device)
+    # shape: [b, m_s], whether each position of each sequence can be attended to
+    not_pad = positions[None, :] >= pad_lens[:, None]
+    causal_mask = model.causal_mask.to(device)
+
+    def get_mask(input_pos: torch.Tensor) -> torch.Tensor:
+        # padding positions attend to themselves only (avoiding fully masked rows, which give nan)
+        is_self = positions[None, :] == input_pos[:, None]
+        # shape: [b, 1, s, m_s]
+        mask = causal_mask[input_pos][None] & (not_pad[:, None, :] | is_self[None])
+        return mask[:, None]
+
+    input_pos = positions[:prompt_len]
+    token = decode_step(
+        model, tokens, input_pos, get_mask(input_pos), temperature, top_k
+    )
+    generated = [token]
+    # sequences only padding the batch are done from the start
+    done = torch.arange(bsz, device=device) >= num_prompts
+    input_pos = positions[prompt_len : prompt_len + 1]
+    for _ in range(max_generated_tokens - 1):
+        if eos_id is not None:
+            done |= token[:, 0] == eos_id
+            if done.all():
+                break
+        token = custom_decode_step(
+            model, token, input_pos, get_mask(input_pos), temperature, top_k
+        ).clone()
+        generated.append(token)
+        input_pos = input_pos + 1
+
+    outputs = torch.cat(generated, dim=1)[:num_prompts].tolist()
+    if eos_id is not None:
+        # drop tokens generated after each sequence's eos
+        outputs = [
+            out[: out.index(eos_id) + 1] if eos_id in out else out for out in outputs
+        ]
+    return outputs
+
+
+@dataclass
+class SpeculativeStats:
+    """Acceptance statistics of speculative decoding (accumulated over calls to generate_speculative())."""
+
+    drafted: int = 0  # tokens proposed by the draft model
+    accepted: int = 0  # draft tokens accepted by the model
+    generated: int = 0
+    forwards: int = (
+        0  # forward passes of the model (each verifying up to k draft tokens)
+    )
+    draft_forwards: int = 0
+
+    @property
+    def acceptance_rate(self) -> float:
+        return self.accepted / max(1, self.drafted)
+
+    @property
+    def tokens_per_forward(self) -> float:
+        return self.generated / max(1, self.forwards)
+
+
+def logits_to_probs(
+    logits: torch.Tensor, temperature: float = 1.0, top_k: Optional[int] = None
+) -> torch.Tensor:
+    """Distribution sampled from by torchtune's sample() (given the same temperature and top_k)."""
+    logits = logits / max(temperature, 1e-5)
+    if top_k is not None:
+        v, _ = torch.topk(logits, min(top_k, logits.size(-1)))
+        pivot = v.select(-1, -1).unsqueeze(-1)
+        logits = torch.where(logits < pivot, -float("Inf"), logits)
+    return torch.nn.functional.softmax(logits, dim=-1)
+
+
+def verify_draft(
+    draft_tokens: List[int], draft_probs: torch.Tensor, probs: torch.Tensor
+) -> List[int]:
+    """
+    Speculative sampling (https://arxiv.org/abs/2211.17192): accept each draft token with probability
+    min(1, p(token) / q(token)), replacing the first rejected token with a sample from max(0, p - q) (normalized).
+    If all k draft tokens are accepted, a token is sampled from the model's next distribution.
+    So the returned tokens (between 1 and k + 1) follow the model's distribution p exactly.
+    draft_probs: shape [k, v] (q), probs: shape [k + 1, v] (p, of the model given each draft token).
+    """
+    accepted = []
+    for i, token in enumerate(draft_tokens):
+        p, q = probs[i, token].item(), draft_probs[i, token].item()
+        if torch.rand(1).item() * q < p:  # (r < p / q, without dividing by zero)
+            accepted.append(token)
+            continue
+        residual = (probs[i] - draft_probs[i]).clamp(min=0)
+        return accepted + [multinomial_sample_one(residual / residual.sum()).item()]
+    return accepted + [multinomial_sample_one(probs[len(draft_tokens)]).item()]
+
+
+@torch.inference_mode()
+def generate_speculative(
+    model: nn.Module,
+    draft_model: nn.Module,
+    prompt: List[int],
+    max_generated_tokens: int,
+    k: int = 4,
+    temperature: float = 1.0,
+    top_k: Optional[int] = None,
+    eos_id: Optional[int] = None,
+    stats: Optional[SpeculativeStats] = None,
+) -> List[int]:
+    """
+    Generate a single sequence with speculative decoding: the (small) draft model proposes k tokens at a time,
+    which the model verifies in a single forward pass (see verify_draft()).
+    Both models need caches setup for a single sequence. Returns the generated tokens (up to and including eos_id).
+    """
+    if model.max_seq_len < (len(prompt) + max_generated_tokens) - 1:
+        raise ValueError(
+            f"Models maximum seq length {model.max_seq_len} should be >= "
+            f"{(len(prompt) + max_generated_tokens)} - 1"
+        )
+    stats = stats if stats is not None else SpeculativeStats()
+    device = model.tok_embeddings.weight.device
+
+    def forward(m: nn.Module, tokens: List[int], start_pos: int) -> torch.Tensor:
+        x = torch.tensor([tokens], dtype=torch.int, device=device)
+        input_pos = torch.arange(start_pos, start_pos + len(tokens), device=device)
+        # shape: [s, v]
+        return logits_to_probs(m(x, input_pos=input_pos)[0], temperature, top_k)
+
+    # the last token is fed along with the draft tokens (so the model's cache never contains rejected tokens)
+    if len(prompt) > 1:
+        forward(model, prompt[:-1], 0)
+        forward(draft_model, prompt[:-1], 0)
+        stats.forwards += 1
+        stats.draft_forwards += 1
+    pos = len(prompt) - 1  # position of the last token
+    draft_pending = [prompt[-1]]  # tokens not yet in the draft model's cache
+
+    generated: List[int] = []
+    while len(generated) < max_generated_tokens:
+        # (no more tokens are drafted than still needed)
+        cur_k = min(k, max_generated_tokens - len(generated) - 1)
+        draft_tokens: List[int] = []
+        draft_probs: List[torch.Tensor] = []
+        for _ in range(cur_k):
+            q = forward(
+                draft_model,
+                draft_pending,
+                pos + len(draft_tokens) + 1 - len(draft_pending),
+            )[-1]
+            token = multinomial_sample_one(q).item()
+            draft_tokens.append(token)
+            draft_probs.append(q)
+            draft_pending = [token]
+        stats.draft_forwards += cur_k
+
+        probs = forward(
+            model, [generated[-1] if generated else prompt[-1]] + draft_tokens, pos
+        )
+        new_tokens = verify_draft(
+            draft_tokens,
+            torch.stack(draft_probs) if draft_probs else probs[:0],
+            probs,
+        )
+        num_accepted = len(new_tokens) - 1
+        stats.forwards += 1
+        stats.drafted += cur_k
+        stats.accepted += num_accepted
+
+        # tokens the draft model's cache lacks (the last draft token too, if all were accepted)
+        if cur_k == 0:
+            draft_pending = draft_pending + new_tokens
+        elif num_accepted == cur_k:
+            draft_pending = new_tokens[-2:]
+        else:
+            draft_pending = new_tokens[-1:]
+        pos += len(new_tokens)
+        generated.extend(new_tokens)
+        if eos_id is not None and eos_id in new_tokens:
+            generated = generated[: generated.index(eos_id) + 1]
+            break
+
+    generated = generated[:max_generated_tokens]
+    stats.generated += len(generated)
+    return generated
 
 
 def benchmark_fluency_local(
@@ -337,7 +701,8 @@ def main(cfg: DictConfig) -> None:
     #### benchmark GPT model fluencies
     #   uncomment this section and run with:
     #   tune run ./recipes/generate.py --config ./generation.yaml # (generation.yaml doesn't influence the output in this case)
-    #   TODO: move this to ../../benchmark.py?
+    #   NOTE: for judging the fluency (and utility/safety) of feedback from many models with many judges in one run,
+    #     see ../../benchmark_matrix.py
     """
     judge_model = "gpt-4-0125-preview"
     for candidate_model in ["gpt-3.5-turbo-0125", "gpt-4-0125-preview"]:
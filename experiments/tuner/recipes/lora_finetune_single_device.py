@@ -5,18 +5,21 @@
 # LICENSE file in the root directory of this source tree.
 
 import os
+import random
 import sys
+import time
 
 from functools import partial
-from typing import Any, Dict, Optional, Tuple
+from typing import Any, Dict, List, Optional, Tuple, Union
 from warnings import warn
 
 import torch
-from omegaconf import DictConfig
+import torch.nn.functional as F
+from omegaconf import DictConfig, OmegaConf
 
 from torch import nn
 from torch.optim import Optimizer
-from torch.utils.data import DataLoader, DistributedSampler
+from torch.utils.data import DataLoader, DistributedSampler, Subset
 from torchtune import config, modules, utils
 from torchtune.modules.peft.peft_utils import (
     get_adapter_params,
@@ -27,6 +30,13 @@ from torchtune.modules.peft.peft_utils import (
 from torchtune.recipe_interfaces import FTRecipeInterface
 from tqdm import tqdm
 
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(SCRIPT_DIR)  # (tune run doesn't add the recipe's directory to the path)
+import checkpointing  # noqa: E402
+import packing  # noqa: E402
+import token_cache  # noqa: E402
+import train_metrics  # noqa: E402
+
 log = utils.get_logger("DEBUG")
 
 
@@ -71,6 +81,10 @@ class LoRAFinetuneRecipeSingleDevice(FTRecipeInterface):
             please take a look at our LoRA tutorial
             (https://pytorch.org/torchtune/main/tutorials/lora_finetune.html).
 
+            With ``checkpoint_mode=adapter`` only the adapter weights (as safetensors) and recipe state are
+            checkpointed, written by a background thread (so training isn't stalled by the writes). Merging
+            an adapter into the base model's weights is then left to the export command in checkpointing.py.
+
             Optimizer State and recipe state (seed, total_epochs, number of epochs run etc) are
             only saved at the end of a given epoch and used in case of resuming training. Resuming
             training is controlled by the ``resume_from_checkpoint`` flag. Mid-epoch checkpointing is
@@ -79,7 +93,23 @@ class LoRAFinetuneRecipeSingleDevice(FTRecipeInterface):
             For more details on the checkpointer, please take a look at
             our checkpointer deepdive (https://pytorch.org/torchtune/main/tutorials/checkpointer.html).
 
-        - Logging. Terminal, Disk, WandB and TensorBoard are all supported.
+        - Packing and length bucketing. With ``packed=True`` training samples are concatenated into
+            sequences of up to ``packed_seq_len`` tokens (with attention and labels masked so samples don't
+            see each other), otherwise ``length_bucketing=True`` batches samples of similar length together.
+            Both reduce the padding computed on, which is logged (``padding_ratio``) along with ``tokens_per_sec``.
+
+        - Dataset cache. With ``dataset_cache_dir`` set, the dataset is tokenized once (per tokenizer, template
+            and dataset config) into memory-mapped files which later runs (and dataloader workers, see
+            ``num_workers``) read directly, rather than re-tokenizing the dataset on every run.
+
+        - Validation. The validation loss is computed on a fixed random subset of the validation split
+            (``val_subset`` samples), collated once into length-sorted batches of ``val_batch_size`` (which can
+            be larger than ``batch_size`` as no activations are kept). The loss is accumulated on device, so
+            each validation run syncs with the host only once.
+
+        - Logging. Terminal, Disk, WandB and TensorBoard are all supported. Metrics (e.g. the loss) are
+            accumulated on device and flushed every ``log_every_n_steps`` (optimizer) steps to a background
+            thread, which reads and logs them, so training steps don't wait for the host or the logger.
 
     For a full list of example configs for this recipe, run ``tune ls`` on the command line. Each config
     has example commands for how to kick-off training.
@@ -124,12 +154,26 @@ class LoRAFinetuneRecipeSingleDevice(FTRecipeInterface):
         self.total_training_steps = 0
 
         self._resume_from_checkpoint = cfg.resume_from_checkpoint
+        self._checkpoint_mode = cfg.get("checkpoint_mode", "full")
+        if self._checkpoint_mode not in ("full", "adapter"):
+            raise ValueError(
+                f"checkpoint_mode must be 'full' or 'adapter', not '{self._checkpoint_mode}'"
+            )
+        self._checkpoint_writer = (
+            checkpointing.AsyncCheckpointWriter()
+            if self._checkpoint_mode == "adapter"
+            else None
+        )
         self._gradient_accumulation_steps = cfg.gradient_accumulation_steps
 
         # create EXP_DIR if doesn't exist
         os.makedirs(cfg.EXP_DIR, exist_ok=True)
         log.info(f"using EXP_DIR: '{cfg.EXP_DIR}'")
         self.vals_per_epoch = cfg.vals_per_epoch
+        self._packed = cfg.get("packed", False)
+        self._dataset_cache_dir = cfg.get("dataset_cache_dir")
+        self._num_workers = cfg.get("num_workers", 0)
+        self._tokenized_ds: Optional[token_cache.TokenizedDataset] = None
 
     def load_checkpoint(self, cfg_checkpointer: DictConfig) -> Dict[str, Any]:
         """
@@ -137,11 +181,24 @@ class LoRAFinetuneRecipeSingleDevice(FTRecipeInterface):
         base model weights. If resume_from_checkpoint is True, this also includes
         the adapter weights and recipe state
         """
+        self._checkpoint_output_dir = cfg_checkpointer.output_dir
+        # adapters saved with checkpoint_mode=adapter are loaded here (rather than by the checkpointer)
+        adapter_checkpoint = cfg_checkpointer.get("adapter_checkpoint")
+        safetensors_adapter = (
+            self._resume_from_checkpoint
+            and adapter_checkpoint is not None
+            and adapter_checkpoint.endswith(".safetensors")
+        )
         self._checkpointer = config.instantiate(
             cfg_checkpointer,
             resume_from_checkpoint=self._resume_from_checkpoint,
+            **({"adapter_checkpoint": None} if safetensors_adapter else {}),
         )
         checkpoint_dict = self._checkpointer.load_checkpoint()
+        if safetensors_adapter:
+            checkpoint_dict[utils.ADAPTER_KEY] = checkpointing.load_adapter(
+                os.path.join(cfg_checkpointer.checkpoint_dir, adapter_checkpoint)
+            )
 
         if self._resume_from_checkpoint:
             if utils.ADAPTER_KEY not in checkpoint_dict:
@@ -178,7 +235,11 @@ class LoRAFinetuneRecipeSingleDevice(FTRecipeInterface):
         Setup the recipe state. This includes recipe state (if resume_from_checkpoint is True),
         model, tokenizer, loss, optimizer, learning rate scheduler, sampler, and dataloader.
         """
-        self._metric_logger = config.instantiate(cfg.metric_logger)
+        self._pbar: Optional[tqdm] = None
+        self._metrics = train_metrics.MetricsAccumulator(self._device)
+        self._metric_logger = train_metrics.AsyncMetricLogger(
+            config.instantiate(cfg.metric_logger), callback=self._update_pbar
+        )
 
         # log config with parameter override
         self._metric_logger.log_config(cfg)
@@ -191,6 +252,7 @@ class LoRAFinetuneRecipeSingleDevice(FTRecipeInterface):
             enable_activation_checkpointing=cfg.enable_activation_checkpointing,
             compile_model=cfg.compile,
             base_model_state_dict=checkpoint_dict[utils.MODEL_KEY],
+            enable_attention_masks=self._packed,
             lora_weights_state_dict=(
                 checkpoint_dict[utils.ADAPTER_KEY]
                 if self._resume_from_checkpoint
@@ -219,19 +281,20 @@ class LoRAFinetuneRecipeSingleDevice(FTRecipeInterface):
             batch_size=cfg.batch_size,
             val_split=cfg.val_split,
             max_samples=cfg.max_samples,
+            packed_seq_len=cfg.packed_seq_len if self._packed else None,
+            length_bucketing=cfg.get("length_bucketing", False),
         )
 
         # create validation set
-        _, self._val_dataloader = self._setup_data(
+        self._val_batches = self._setup_val_data(
             cfg_dataset=cfg.dataset,
-            shuffle=cfg.shuffle,
-            batch_size=cfg.batch_size,
+            batch_size=cfg.get("val_batch_size", cfg.batch_size),
             val_split=cfg.val_split,
-            is_val=True,
             max_samples=cfg.max_samples,
+            val_subset=cfg.get("val_subset"),
         )
         log.info(
-            f"train split = {len(self._dataloader):_} samples | val split = {len(self._val_dataloader):_} samples ({(cfg.val_split * 100):.2f}%)"
+            f"train split = {len(self._dataloader):_} batches | val split = {len(self._val_batches):_} batches ({(cfg.val_split * 100):.2f}%)"
         )
 
         # Finally update the recipe state which can only be correctly set after all of the
@@ -270,6 +333,7 @@ class LoRAFinetuneRecipeSingleDevice(FTRecipeInterface):
         compile_model: bool,
         base_model_state_dict: Dict[str, Any],
         lora_weights_state_dict: Optional[Dict[str, Any]] = None,
+        enable_attention_masks: bool = False,
     ) -> nn.Module:
         with utils.set_default_dtype(self._dtype), self._device:
             model = config.instantiate(cfg_model)
@@ -279,6 +343,8 @@ class LoRAFinetuneRecipeSingleDevice(FTRecipeInterface):
         self.adapter_params = get_adapter_params(model)
         set_trainable_params(model, self.adapter_params)
 
+        if enable_attention_masks:
+            packing.enable_attention_masks(model)
         if enable_activation_checkpointing:
             utils.set_activation_checkpointing(
                 model, auto_wrap_policy={modules.TransformerDecoderLayer}
@@ -354,27 +420,45 @@ class LoRAFinetuneRecipeSingleDevice(FTRecipeInterface):
         val_split: float,  # split ratio
         is_val: bool = False,  # whether to setup the validation set instead of training
         max_samples: Optional[int] = None,
-    ) -> Tuple[DistributedSampler, DataLoader]:
+        # pack samples into sequences of this length
+        packed_seq_len: Optional[int] = None,
+        length_bucketing: bool = False,  # batch samples of similar length (when not packed)
+    ) -> Tuple[Union[DistributedSampler, packing.LengthBucketSampler], DataLoader]:
         """
         All data related setup happens here. Currently this recipe only supports
         Map-style Datasets which fit into memory and an option for random shuffling.
-        Samplers, iterable datasets, and streaming datasets are not supported.
+        Iterable datasets, and streaming datasets are not supported.
+        Batches are (input_ids, labels, doc_ids), see packing.padded_collate().
         """
         assert 0.0 <= val_split < 1.0
-        ds = config.instantiate(
-            cfg_dataset,
-            tokenizer=self._tokenizer,
+        ds: token_cache.SizedDataset = self._load_split(
+            cfg_dataset, max_samples, is_val
         )
-        if max_samples is not None:
-            ds._data = ds._data.select(range(max_samples))
-
-        # note: not shuffling data for validation set because aplaca-cleaned was shuffled before translating to create alpaca-cleaned-nl
-        # but we could shuffle here with a hardcoded seed
-        split_idx = int(len(ds._data) * 0.1)
-        if is_val:
-            ds._data = ds._data.select(range(split_idx))
-        else:
-            ds._data = ds._data.select(range(split_idx, len(ds._data)))
+        collate_fn = self._collate_fn()
+        if packed_seq_len is not None:
+            log.info(f"computing sample lengths ({is_val=})")
+            lengths = packing.get_lengths(ds)
+            ds = packing.PackedDataset(
+                ds,
+                packed_seq_len,
+                ignore_idx=self._loss_fn.ignore_index,
+                lengths=lengths,
+            )
+            log.info(
+                f"packed {len(lengths):_} samples into {len(ds):_} sequences of up to {packed_seq_len} tokens"
+            )
+        elif length_bucketing:
+            log.info(f"computing sample lengths ({is_val=})")
+            lengths = packing.get_lengths(ds)
+            sampler = packing.LengthBucketSampler(lengths, batch_size, shuffle=shuffle)
+            dataloader = DataLoader(
+                dataset=ds,
+                batch_sampler=sampler,
+                collate_fn=collate_fn,
+                num_workers=self._num_workers,
+            )
+            log.info(f"Dataset and LengthBucketSampler are initialized ({is_val=}).")
+            return sampler, dataloader
 
         sampler = DistributedSampler(
             ds,
@@ -387,17 +471,102 @@ class LoRAFinetuneRecipeSingleDevice(FTRecipeInterface):
             dataset=ds,
             sampler=sampler,
             batch_size=batch_size,
-            collate_fn=partial(
-                utils.padded_collate,
-                padding_idx=self._tokenizer.pad_id,
-                ignore_idx=self._loss_fn.ignore_index,
-            ),
+            collate_fn=collate_fn,
+            num_workers=self._num_workers,
         )
 
         log.info(f"Dataset and Sampler are initialized ({is_val=}).")
 
         return sampler, dataloader
 
+    def _setup_val_data(
+        self,
+        cfg_dataset: DictConfig,
+        batch_size: int,
+        val_split: float,  # split ratio
+        max_samples: Optional[int] = None,
+        val_subset: Optional[int] = None,  # number of samples to validate on
+    ) -> List[Tuple[torch.Tensor, torch.Tensor, torch.Tensor]]:
+        """
+        Collates (a fixed random subset of) the validation split into batches once, reused by every validate().
+        Batches are sorted by length (minimizing padding), which doesn't affect the (per sample) validation loss.
+        """
+        assert 0.0 <= val_split < 1.0
+        ds = self._load_split(cfg_dataset, max_samples, is_val=True)
+        if val_subset is not None and val_subset < len(ds):
+            # (seeded, so the subset is the same across runs, e.g. of a hyperparameter sweep)
+            indices = random.Random(0).sample(range(len(ds)), val_subset)
+            ds = Subset(ds, sorted(indices))
+
+        sampler = packing.LengthBucketSampler(
+            packing.get_lengths(ds),
+            batch_size,
+            shuffle=False,
+            bucket_batches=len(ds),
+        )
+        dataloader = DataLoader(
+            dataset=ds,
+            batch_sampler=sampler,
+            collate_fn=self._collate_fn(),
+            num_workers=self._num_workers,
+        )
+        batches = list(dataloader)
+        log.info(f"Validation set is initialized ({len(ds):_} samples).")
+        return batches
+
+    def _collate_fn(self):
+        return partial(
+            packing.padded_collate,
+            padding_idx=self._tokenizer.pad_id,
+            ignore_idx=self._loss_fn.ignore_index,
+        )
+
+    def _load_split(
+        self, cfg_dataset: DictConfig, max_samples: Optional[int], is_val: bool
+    ) -> token_cache.SizedDataset:
+        """The train (or validation) split of the dataset."""
+        ds = self._load_dataset(cfg_dataset, max_samples)
+
+        # note: not shuffling data for validation set because aplaca-cleaned was shuffled before translating to create alpaca-cleaned-nl
+        # but we could shuffle here with a hardcoded seed
+        split_idx = int(len(ds) * 0.1)
+        indices = range(split_idx) if is_val else range(split_idx, len(ds))
+        if isinstance(ds, token_cache.TokenizedDataset):
+            return ds.select(indices)
+        # (a torchtune InstructDataset, with its samples in a HF dataset)
+        instruct_ds: Any = ds
+        instruct_ds._data = instruct_ds._data.select(indices)
+        return instruct_ds
+
+    def _load_dataset(
+        self, cfg_dataset: DictConfig, max_samples: Optional[int] = None
+    ) -> token_cache.SizedDataset:
+        """
+        Instantiates the (full) dataset, which is tokenized (once) from/into the dataset cache if enabled
+        (shared by the train and validation splits).
+        """
+        if self._dataset_cache_dir is not None and self._tokenized_ds is not None:
+            return self._tokenized_ds
+
+        ds = config.instantiate(
+            cfg_dataset,
+            tokenizer=self._tokenizer,
+        )
+        if max_samples is not None:
+            ds._data = ds._data.select(range(max_samples))
+        if self._dataset_cache_dir is None:
+            return ds
+
+        self._tokenized_ds = token_cache.load_cached(
+            ds,
+            self._tokenizer,
+            self._dataset_cache_dir,
+            ds_config=OmegaConf.to_yaml(
+                {"dataset": cfg_dataset, "max_samples": max_samples}
+            ),
+        )
+        return self._tokenized_ds
+
     def save_checkpoint(self, epoch: int) -> None:
         """
         Checkpoint the state of the recipe. The constructed checkpoint state dict
@@ -423,6 +592,10 @@ class LoRAFinetuneRecipeSingleDevice(FTRecipeInterface):
                 }
             )
 
+        if self._checkpoint_mode == "adapter":
+            self._save_adapter_checkpoint(epoch, ckpt_dict)
+            return
+
         # Move to CPU to avoid a copy on GPU
         state_dict = {k: v.cpu() for k, v in self._model.state_dict().items()}
 
@@ -447,6 +620,27 @@ class LoRAFinetuneRecipeSingleDevice(FTRecipeInterface):
             intermediate_checkpoint=(epoch + 1 < self.total_epochs),
         )
 
+    def _save_adapter_checkpoint(self, epoch: int, recipe_state: Dict[str, Any]):
+        """
+        Checkpoint the adapter weights (and recipe state if training is in-progress) in the background.
+        The (frozen) base model weights aren't saved, see checkpointing.py for merging them with an adapter.
+        """
+        os.makedirs(self._checkpoint_output_dir, exist_ok=True)
+        log.info(f"saving adapter checkpoint at epoch {epoch}")
+        self._checkpoint_writer.save_safetensors(
+            dict(self.adapter_params),
+            os.path.join(
+                self._checkpoint_output_dir, checkpointing.adapter_fname(epoch)
+            ),
+        )
+        if recipe_state:
+            self._checkpoint_writer.save_torch(
+                recipe_state,
+                os.path.join(
+                    self._checkpoint_output_dir, checkpointing.RECIPE_STATE_FNAME
+                ),
+            )
+
     def train(self) -> None:
         """
         The core training loop.
@@ -464,6 +658,9 @@ class LoRAFinetuneRecipeSingleDevice(FTRecipeInterface):
         val_indices.remove(0)  # we train at the end of each epoch anyways
         log.info(f"{val_indices=}, {self.vals_per_epoch=}")
 
+        # throughput since the last log (tokens excluding padding)
+        num_tokens, num_padding, t_log = 0, 0, time.perf_counter()
+
         # self.epochs_run should be non-zero when we're resuming from a checkpoint
         for curr_epoch in range(self.epochs_run, self.total_epochs):
             # Update the sampler to ensure data is correctly shuffled across epochs
@@ -481,10 +678,13 @@ class LoRAFinetuneRecipeSingleDevice(FTRecipeInterface):
             # Optionally profile the training loop
             with self._profiler:
                 # compute initial (average) validation loss
-                if self.vals_per_epoch >= 1:
+                # (later epochs start with the loss computed at the end of the previous epoch)
+                if self.vals_per_epoch >= 1 and curr_epoch == self.epochs_run:
                     self.run_validation()
+                    t_log = time.perf_counter()  # (excluding validation time)
 
                 for idx, batch in enumerate(pbar := tqdm(self._dataloader)):
+                    self._pbar = pbar
                     if (
                         self.max_steps_per_epoch is not None
                         and (idx // self._gradient_accumulation_steps)
@@ -495,30 +695,13 @@ class LoRAFinetuneRecipeSingleDevice(FTRecipeInterface):
                     if self._profiler_enabled:
                         self._profiler.step()
 
-                    input_ids, labels = batch
-                    input_ids = input_ids.to(self._device)
-                    labels = labels.to(self._device)
-
-                    logits = self._model(input_ids)
-                    # Shift so that tokens < n predict n
-                    logits = logits[..., :-1, :].contiguous()
-                    labels = labels[..., 1:].contiguous()
-                    logits = logits.transpose(1, 2)
-                    # Compute loss
-                    loss = self._loss_fn(logits, labels)
-
-                    if self.total_training_steps % self._log_every_n_steps == 0:
-                        pbar.set_description(
-                            f"{curr_epoch+1}|{idx+1}|Loss: {loss.item()}"
-                        )
-                        self._metric_logger.log_dict(
-                            {
-                                "loss": loss.item(),
-                                "lr": self._optimizer.param_groups[0]["lr"],
-                                "gpu_resources": torch.cuda.memory_allocated(),
-                            },
-                            step=self.total_training_steps,  # Each step is unique, not limited to each epoch
-                        )
+                    input_ids, labels, doc_ids = batch
+                    batch_padding = (doc_ids < 0).sum().item()
+                    num_padding += batch_padding
+                    num_tokens += doc_ids.numel() - batch_padding
+                    loss = self._compute_loss(input_ids, labels, doc_ids)
+                    self._metrics.add("loss", loss)  # (on device, no host sync)
+
                     loss = loss / self._gradient_accumulation_steps
                     loss.backward()
                     if (idx + 1) % self._gradient_accumulation_steps == 0:
@@ -527,41 +710,91 @@ class LoRAFinetuneRecipeSingleDevice(FTRecipeInterface):
                         self._lr_scheduler.step()
                         # Update the number of steps when the weights are updated
                         self.total_training_steps += 1
-                    # Log peak memory for iteration
-                    if (
-                        self.total_training_steps % self._log_peak_memory_every_n_steps
-                        == 0
-                        and self._device.type == "cuda"
-                    ):
-                        # Log peak memory for iteration
-                        memory_stats = utils.memory_stats_log(device=self._device)
-                        self._metric_logger.log_dict(
-                            memory_stats, step=self.total_training_steps
-                        )
+
+                        if self.total_training_steps % self._log_every_n_steps == 0:
+                            t_now = time.perf_counter()
+                            payload = {
+                                # average loss since the last log (read by the logging thread)
+                                "metrics": self._metrics.flush(),
+                                "lr": self._optimizer.param_groups[0]["lr"],
+                                "gpu_resources": torch.cuda.memory_allocated(),
+                                "tokens_per_sec": num_tokens / (t_now - t_log),
+                                "padding_ratio": num_padding
+                                / (num_tokens + num_padding),
+                            }
+                            # Log peak memory for iteration
+                            if (
+                                self.total_training_steps
+                                % self._log_peak_memory_every_n_steps
+                                == 0
+                                and self._device.type == "cuda"
+                            ):
+                                payload.update(
+                                    utils.memory_stats_log(device=self._device)
+                                )
+                            self._metric_logger.log_dict(
+                                payload,
+                                step=self.total_training_steps,  # Each step is unique, not limited to each epoch
+                            )
+                            num_tokens, num_padding, t_log = 0, 0, t_now
                     if (
                         idx in val_indices and self.vals_per_epoch > 1
                     ):  # (runs once at end of epoch anyways)
                         self.run_validation()
+                        t_log = time.perf_counter()  # (excluding validation time)
             self.epochs_run += 1
             self.save_checkpoint(epoch=curr_epoch)
             if self.vals_per_epoch >= 1:
                 self.run_validation()  # compute and log (average) validation loss
 
+    def _forward(self, input_ids: torch.Tensor, doc_ids: torch.Tensor) -> torch.Tensor:
+        """Logits of a batch (from the dataloader)."""
+        input_ids = input_ids.to(self._device)
+        if self._packed:
+            # (also used for unpacked validation batches, as the model's attention now requires a mask)
+            return packing.forward_packed(
+                self._model, input_ids, doc_ids.to(self._device)
+            )
+        return self._model(input_ids)
+
+    def _compute_loss(
+        self, input_ids: torch.Tensor, labels: torch.Tensor, doc_ids: torch.Tensor
+    ) -> torch.Tensor:
+        """Loss of a batch (from the dataloader)."""
+        logits = self._forward(input_ids, doc_ids)
+        labels = labels.to(self._device)
+        # Shift so that tokens < n predict n
+        logits = logits[..., :-1, :].contiguous()
+        labels = labels[..., 1:].contiguous()
+        logits = logits.transpose(1, 2)
+        return self._loss_fn(logits, labels)
+
+    def _update_pbar(self, payload: Dict[str, Any], step: int):
+        """Shows the latest logged loss (called by the logging thread)."""
+        if "loss" in payload and self._pbar is not None:
+            self._pbar.set_description(
+                f"{self.epochs_run + 1}|{step}|Loss: {payload['loss']:.5f}"
+            )
+
     def cleanup(self) -> None:
+        if self._checkpoint_writer is not None:
+            self._checkpoint_writer.wait()
         self._metric_logger.close()
 
     def run_validation(self) -> None:
         """Thin wrapper around validate() which calls it and logs results."""
-        if len(self._val_dataloader) > 0:
+        if len(self._val_batches) > 0:
+            t0 = time.perf_counter()
             avg_val_loss = self.validate()
             self._metric_logger.log_dict(
                 {
                     "val_loss": avg_val_loss,
+                    "val_secs": time.perf_counter() - t0,
                 },
                 step=self.total_training_steps,
             )
 
-    @torch.no_grad()
+    @torch.inference_mode()
     def validate(self) -> float:
         """
         Based on self.train, but computes performance on validation or test set.
@@ -570,11 +803,10 @@ class LoRAFinetuneRecipeSingleDevice(FTRecipeInterface):
         Note: not making any considerations for side-effects on the profiler (if running).
         """
         total_samples = 0
-        total_loss = 0.0
-        total_val_steps = 0
+        # (accumulated on device, so there's only one host sync per validation)
+        total_loss = torch.zeros((), device=self._device)
 
-        total_batches = len(self._val_dataloader)
-        for idx, batch in enumerate(pbar := tqdm(self._val_dataloader)):
+        for idx, batch in enumerate(tqdm(self._val_batches, desc="validation")):
             if (
                 self.max_steps_per_epoch is not None
                 and (idx // self._gradient_accumulation_steps)
@@ -585,30 +817,30 @@ class LoRAFinetuneRecipeSingleDevice(FTRecipeInterface):
             if self._profiler_enabled:
                 self._profiler.step()
 
-            input_ids, labels = batch
-            input_ids = input_ids.to(self._device)
-            labels = labels.to(self._device)
-
-            logits = self._model(input_ids)
-            # Shift so that tokens < n predict n
-            logits = logits[..., :-1, :].contiguous()
-            labels = labels[..., 1:].contiguous()
-            logits = logits.transpose(1, 2)
-            # Compute loss
-            loss = self._loss_fn(logits, labels)
-
-            total_loss += loss.item()
+            input_ids, labels, doc_ids = batch
+            logits = self._forward(input_ids, doc_ids)
+            total_loss += sample_losses(
+                logits, labels.to(self._device), self._loss_fn.ignore_index
+            ).sum()
             total_samples += input_ids.size(0)
+        return total_loss.item() / total_samples
 
-            if (idx + 1) % self._gradient_accumulation_steps == 0:
-                total_val_steps += 1
 
-            if total_val_steps % self._log_every_n_steps == 0:
-                avg_loss = total_loss / total_samples
-                pbar.set_description(
-                    f"validation {idx+1}/{total_batches}| Avg Loss: {avg_loss:.5f}"
-                )
-        return total_loss / total_samples
+def sample_losses(
+    logits: torch.Tensor, labels: torch.Tensor, ignore_idx: int = -100
+) -> torch.Tensor:
+    """
+    Loss of each sample in a batch (mean over its labeled tokens), so the loss of a sample doesn't depend on
+    what it's batched (and padded) with.
+    """
+    # Shift so that tokens < n predict n
+    logits = logits[..., :-1, :]
+    labels = labels[..., 1:]
+    token_losses = F.cross_entropy(
+        logits.transpose(1, 2), labels, ignore_index=ignore_idx, reduction="none"
+    )
+    num_labels = (labels != ignore_idx).sum(dim=1).clamp(min=1)
+    return token_losses.sum(dim=1) / num_labels
 
 
 @config.parse
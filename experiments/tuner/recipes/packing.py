@@ -0,0 +1,185 @@
+"""
+Data pipeline utils for lora_finetune_single_device.py reducing the padding in each batch:
+sequence packing (PackedDataset) and length bucketing (LengthBucketSampler).
+"""
+
+import random
+from typing import Iterator, List, Optional, Sequence, Tuple
+
+import torch
+from torch import nn
+from torch.utils.data import Dataset, Sampler
+from torchtune.modules import CausalSelfAttention
+
+from token_cache import SizedDataset
+
+# (tokens, labels) of a sample, or (tokens, labels, doc_ids) of a packed sequence
+ISample = Tuple[List[int], ...]
+
+
+class PackedDataset(Dataset):
+    """
+    Samples of a (tokenized) dataset concatenated into sequences of up to max_seq_len tokens.
+    Each item is (tokens, labels, doc_ids), where doc_ids is the index (within the pack) of the sample each token
+    belongs to, so attention can be limited to within each sample (see forward_packed()).
+    Samples are packed in order (next-fit), which fills packs well when samples are short relative to max_seq_len.
+    """
+
+    def __init__(
+        self,
+        ds: SizedDataset,
+        max_seq_len: int,
+        ignore_idx: int = -100,
+        lengths: Optional[Sequence[int]] = None,
+    ):
+        self.ds = ds
+        self.max_seq_len = max_seq_len
+        self.ignore_idx = ignore_idx
+        if lengths is None:
+            lengths = get_lengths(ds)
+
+        self.packs: List[List[int]] = []  # sample indices of each pack
+        self.lengths: List[int] = []  # number of tokens in each pack
+        for idx, length in enumerate(lengths):
+            length = min(length, max_seq_len)  # (longer samples are truncated)
+            if not self.packs or self.lengths[-1] + length > max_seq_len:
+                self.packs.append([])
+                self.lengths.append(0)
+            self.packs[-1].append(idx)
+            self.lengths[-1] += length
+
+    def __len__(self) -> int:
+        return len(self.packs)
+
+    def __getitem__(self, index: int) -> ISample:
+        tokens, labels, doc_ids = [], [], []
+        for doc_id, idx in enumerate(self.packs[index]):
+            sample_tokens, sample_labels = self.ds[idx][:2]
+            sample_tokens = _to_list(sample_tokens[: self.max_seq_len])
+            sample_labels = _to_list(sample_labels[: self.max_seq_len])
+            # the previous sample's last token shouldn't predict this sample's first token
+            sample_labels[0] = self.ignore_idx
+            tokens.extend(sample_tokens)
+            labels.extend(sample_labels)
+            doc_ids.extend([doc_id] * len(sample_tokens))
+        return tokens, labels, doc_ids
+
+
+def _to_list(values) -> List[int]:
+    # (samples may be numpy arrays, see token_cache.TokenizedDataset)
+    return values.tolist() if hasattr(values, "tolist") else list(values)
+
+
+def get_lengths(ds: SizedDataset) -> List[int]:
+    """Number of tokens of each sample (tokenizing the whole dataset, unless it's already tokenized)."""
+    if hasattr(ds, "lengths"):  # e.g. token_cache.TokenizedDataset
+        return _to_list(ds.lengths)
+    return [len(ds[i][0]) for i in range(len(ds))]
+
+
+class LengthBucketSampler(Sampler[List[int]]):
+    """
+    Batch sampler grouping samples of similar length (so batches need little padding).
+    Each epoch the samples are shuffled, split into buckets of bucket_batches batches, and sorted by length within
+    each bucket. The resulting batches are shuffled (so batch lengths aren't ordered across the epoch).
+    """
+
+    def __init__(
+        self,
+        lengths: Sequence[int],
+        batch_size: int,
+        shuffle: bool = True,
+        bucket_batches: int = 100,
+        seed: int = 0,
+    ):
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.bucket_size = batch_size * bucket_batches
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def __len__(self) -> int:
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self) -> Iterator[List[int]]:
+        rng = random.Random(self.seed + self.epoch)
+        indices = list(range(len(self.lengths)))
+        if self.shuffle:
+            rng.shuffle(indices)
+        batches: List[List[int]] = []
+        for start in range(0, len(indices), self.bucket_size):
+            bucket = sorted(
+                indices[start : start + self.bucket_size],
+                key=lambda i: self.lengths[i],
+            )
+            batches.extend(
+                bucket[i : i + self.batch_size]
+                for i in range(0, len(bucket), self.batch_size)
+            )
+        if self.shuffle:
+            rng.shuffle(batches)
+        return iter(batches)
+
+
+def padded_collate(
+    batch: List[ISample], padding_idx: int = 0, ignore_idx: int = -100
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """
+    utils.padded_collate() also returning doc_ids (see PackedDataset), which are -1 for padding
+    (and 0 for the tokens of unpacked samples).
+    """
+    seq_len = max(len(sample[0]) for sample in batch)
+    tokens = torch.full((len(batch), seq_len), padding_idx, dtype=torch.long)
+    labels = torch.full((len(batch), seq_len), ignore_idx, dtype=torch.long)
+    doc_ids = torch.full((len(batch), seq_len), -1, dtype=torch.long)
+    for i, sample in enumerate(batch):
+        length = len(sample[0])
+        tokens[i, :length] = torch.tensor(sample[0])
+        labels[i, :length] = torch.tensor(sample[1])
+        doc_ids[i, :length] = torch.tensor(sample[2]) if len(sample) > 2 else 0
+    return tokens, labels, doc_ids
+
+
+class _NoKVCache(nn.Module):
+    """
+    Stands in for a KVCache (without caching anything), so CausalSelfAttention uses the given mask
+    (it otherwise always uses is_causal=True without a KV cache).
+    """
+
+    def update(self, input_pos, k_val, v_val):
+        return k_val, v_val
+
+
+def enable_attention_masks(model: nn.Module):
+    """
+    Make the model's attention layers use the mask given to each layer (see forward_packed()).
+    Note this is persistent (e.g. for recomputing activations when using activation checkpointing),
+    so the model should then only be called with forward_packed().
+    """
+    for module in model.modules():
+        if isinstance(module, CausalSelfAttention):
+            module.kv_cache = _NoKVCache()
+
+
+def forward_packed(
+    model: nn.Module, tokens: torch.Tensor, doc_ids: torch.Tensor
+) -> torch.Tensor:
+    """
+    TransformerDecoder.forward() for packed sequences (shape [b, s]), where tokens only attend to (preceding)
+    tokens of the same sample. Requires enable_attention_masks() to have been called on the model.
+    Positions aren't reset per sample, as RoPE only depends on the relative position of tokens.
+    """
+    seq_len = tokens.size(1)
+    causal = torch.ones(seq_len, seq_len, dtype=torch.bool, device=tokens.device).tril()
+    # shape: [b, 1, s, s]
+    mask = (doc_ids[:, :, None] == doc_ids[:, None, :]) & causal
+    input_pos = torch.arange(seq_len, device=tokens.device)
+
+    h = model.tok_embeddings(tokens)
+    for layer in model.layers:
+        h = layer(h, mask[:, None], input_pos)
+    return model.output(model.norm(h)).float()
@@ -0,0 +1,580 @@
+"""
+Long-lived local inference server for (finetuned) model checkpoints, with an OpenAI compatible chat endpoint:
+    POST /v1/chat/completions, GET /v1/models
+
+Requests are scheduled with continuous batching: every engine step admits waiting requests (as memory allows) and
+decodes a token for every running request, so requests join and leave the batch at any step (rather than waiting on
+the longest request of a static batch). Keys/values are stored in a paged KV cache (fixed-size blocks allocated as
+sequences grow), so memory isn't reserved for max_seq_len per request.
+
+Usage:
+    EXP_NAME=changeme tune run ./recipes/serve.py --config ./serve.yaml CHKP_NUM=3
+Then point an OpenAI client at http://localhost:8800/v1 (e.g. GPT_MODEL=local/Llama-2-7b-nl in the backend).
+"""
+
+import json
+import math
+import queue
+import sys
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+
+import torch
+import torch.nn.functional as F
+from omegaconf import DictConfig
+from torch import nn
+
+from torchtune import config, utils
+from torchtune.data import AlpacaInstructTemplate
+from torchtune.utils._generation import sample
+
+logger = utils.get_logger("INFO")
+
+
+@dataclass
+class Completion:
+    tokens: List[int]  # generated tokens (excluding eos)
+    finish_reason: str  # "stop" (eos) or "length" (max_tokens reached)
+    prompt_tokens: int
+
+
+@dataclass(eq=False)
+class Sequence:
+    """A request being generated."""
+
+    prompt_tokens: List[int]
+    max_tokens: int
+    temperature: float
+    future: Future = field(default_factory=Future)
+    output_tokens: List[int] = field(default_factory=list)
+    blocks: List[int] = field(default_factory=list)  # cache blocks (in order)
+    num_cached: int = 0  # number of tokens with keys/values in the cache
+
+    @property
+    def tokens(self) -> List[int]:
+        return self.prompt_tokens + self.output_tokens
+
+
+class PagedKVCache:
+    """
+    Keys/values of all layers for many sequences, stored in blocks of block_size tokens.
+    Blocks are allocated to a sequence as it grows, and returned to the pool once it's done.
+    """
+
+    def __init__(
+        self,
+        num_layers: int,
+        num_blocks: int,
+        block_size: int,
+        num_kv_heads: int,
+        head_dim: int,
+        dtype: torch.dtype,
+        device: torch.device,
+    ):
+        # shape: [num_layers, num_slots, n_kv, h_d] (slot = block * block_size + offset)
+        shape = (num_layers, num_blocks * block_size, num_kv_heads, head_dim)
+        self.k = torch.zeros(shape, dtype=dtype, device=device)
+        self.v = torch.zeros(shape, dtype=dtype, device=device)
+        self.num_blocks = num_blocks
+        self.block_size = block_size
+        self.free_blocks = deque(range(num_blocks))
+
+    def blocks_needed(self, seq: Sequence, num_tokens: int) -> int:
+        """Number of blocks seq still needs to store num_tokens tokens."""
+        return max(0, math.ceil(num_tokens / self.block_size) - len(seq.blocks))
+
+    def allocate(self, seq: Sequence, num_tokens: int) -> bool:
+        """Ensure seq has blocks for num_tokens tokens, returns False if there aren't enough free blocks."""
+        needed = self.blocks_needed(seq, num_tokens)
+        if needed > len(self.free_blocks):
+            return False
+        seq.blocks.extend(self.free_blocks.popleft() for _ in range(needed))
+        return True
+
+    def free(self, seq: Sequence):
+        self.free_blocks.extend(seq.blocks)
+        seq.blocks = []
+        seq.num_cached = 0
+
+    def slots(self, seqs: List[Sequence], num_tokens: int) -> torch.Tensor:
+        """Cache slots of the first num_tokens positions of each sequence, shape [b, num_tokens]."""
+        num_blocks = math.ceil(num_tokens / self.block_size)
+        # (sequences with fewer blocks are padded with block 0, to be masked out)
+        table = torch.tensor(
+            [s.blocks[:num_blocks] + [0] * (num_blocks - len(s.blocks)) for s in seqs],
+            device=self.k.device,
+        )
+        offsets = torch.arange(self.block_size, device=self.k.device)
+        slots = table[:, :, None] * self.block_size + offsets
+        return slots.view(len(seqs), -1)[:, :num_tokens]
+
+
+def _rope(rope: nn.Module, x: torch.Tensor, positions: torch.Tensor) -> torch.Tensor:
+    """RotaryPositionalEmbeddings.forward(), with positions per sequence (shape [b, s])."""
+    xshaped = x.float().reshape(*x.shape[:-1], -1, 2)
+    # shape: [b, s, 1, h_d // 2, 2]
+    rope_cache = rope.cache[positions][:, :, None]
+    x_out = torch.stack(
+        [
+            xshaped[..., 0] * rope_cache[..., 0] - xshaped[..., 1] * rope_cache[..., 1],
+            xshaped[..., 1] * rope_cache[..., 0] + xshaped[..., 0] * rope_cache[..., 1],
+        ],
+        -1,
+    )
+    return x_out.flatten(3).type_as(x)
+
+
+def _attention(
+    attn: nn.Module,
+    x: torch.Tensor,
+    cache: PagedKVCache,
+    layer_idx: int,
+    positions: torch.Tensor,
+    write_slots: torch.Tensor,
+    read_slots: torch.Tensor,
+    mask: torch.Tensor,
+) -> torch.Tensor:
+    """CausalSelfAttention.forward(), reading/writing keys and values from the paged cache."""
+    bsz, seq_len, _ = x.shape
+    q = attn.q_proj(x).view(bsz, seq_len, attn.num_heads, attn.head_dim)
+    k = attn.k_proj(x).view(bsz, seq_len, attn.num_kv_heads, attn.head_dim)
+    v = attn.v_proj(x).view(bsz, seq_len, attn.num_kv_heads, attn.head_dim)
+    q = _rope(attn.pos_embeddings, q, positions)
+    k = _rope(attn.pos_embeddings, k, positions)
+
+    cache.k[layer_idx, write_slots.flatten()] = k.flatten(0, 1)
+    cache.v[layer_idx, write_slots.flatten()] = v.flatten(0, 1)
+    # shape: [b, n_kv, l, h_d]
+    keys = cache.k[layer_idx, read_slots].transpose(1, 2)
+    values = cache.v[layer_idx, read_slots].transpose(1, 2)
+    # expand to the number of query heads (cached once per kv head)
+    q_per_kv = attn.num_heads // attn.num_kv_heads
+    if q_per_kv > 1:
+        keys = keys.repeat_interleave(q_per_kv, dim=1)
+        values = values.repeat_interleave(q_per_kv, dim=1)
+
+    output = F.scaled_dot_product_attention(
+        q.transpose(1, 2), keys, values, attn_mask=mask
+    )
+    output = output.transpose(1, 2).contiguous().view(bsz, seq_len, -1)
+    return attn.output_proj(output)
+
+
+def forward_paged(
+    model: nn.Module,
+    cache: PagedKVCache,
+    tokens: torch.Tensor,
+    positions: torch.Tensor,
+    write_slots: torch.Tensor,
+    read_slots: torch.Tensor,
+    mask: torch.Tensor,
+) -> torch.Tensor:
+    """
+    TransformerDecoder.forward() for sequences at different positions, with keys/values in a paged cache.
+    tokens, positions, write_slots: shape [b, s] (cache slot of each token)
+    read_slots: shape [b, l] (cache slots each sequence attends to), mask: shape [b, 1, s, l]
+    """
+    h = model.tok_embeddings(tokens)
+    for i, layer in enumerate(model.layers):
+        h = h + _attention(
+            layer.attn,
+            layer.sa_norm(h),
+            cache,
+            i,
+            positions,
+            write_slots,
+            read_slots,
+            mask,
+        )
+        h = h + layer.mlp(layer.mlp_norm(h))
+    return model.output(model.norm(h)).float()
+
+
+class Engine:
+    """
+    Continuous batching scheduler: requests are submitted from any thread, and generated by step() (see start()).
+    Sequences are admitted in order while cache blocks are available, and when the cache runs out during decoding
+    the most recently admitted sequences are preempted (their blocks freed, and recomputed once readmitted).
+    """
+
+    def __init__(
+        self,
+        model: nn.Module,
+        num_blocks: int,
+        block_size: int = 16,
+        max_batch_size: int = 16,
+        eos_id: Optional[int] = None,
+        top_k: Optional[int] = None,
+    ):
+        self.model = model
+        param = model.tok_embeddings.weight
+        attn = model.layers[0].attn
+        self.cache = PagedKVCache(
+            num_layers=len(model.layers),
+            num_blocks=num_blocks,
+            block_size=block_size,
+            num_kv_heads=attn.num_kv_heads,
+            head_dim=attn.head_dim,
+            dtype=param.dtype,
+            device=param.device,
+        )
+        self.device = param.device
+        self.max_batch_size = max_batch_size
+        self.eos_id = eos_id
+        self.top_k = top_k
+
+        self._incoming: queue.Queue[Sequence] = queue.Queue()
+        self.waiting: deque[Sequence] = deque()
+        self.running: List[Sequence] = []
+        self.num_preempted = 0
+        self.num_generated = 0  # total tokens generated
+
+    def submit(
+        self, prompt_tokens: List[int], max_tokens: int, temperature: float = 1.0
+    ) -> "Future[Completion]":
+        """Queue a request for generation (thread safe)."""
+        if len(prompt_tokens) == 0:
+            raise ValueError("prompt is empty")
+        max_tokens = min(max_tokens, self.model.max_seq_len - len(prompt_tokens))
+        if max_tokens < 1:
+            raise ValueError(
+                f"prompt of {len(prompt_tokens)} tokens exceeds max_seq_len={self.model.max_seq_len}"
+            )
+        total = len(prompt_tokens) + max_tokens
+        if math.ceil(total / self.cache.block_size) > self.cache.num_blocks:
+            raise ValueError(f"request of {total} tokens doesn't fit in the KV cache")
+
+        seq = Sequence(prompt_tokens, max_tokens, temperature)
+        self._incoming.put(seq)
+        return seq.future
+
+    def generate(
+        self, prompts: List[List[int]], max_tokens: int, temperature: float = 1.0
+    ) -> List[Completion]:
+        """Generate completions of the given prompts (from the calling thread, when the engine isn't started)."""
+        futures = [self.submit(p, max_tokens, temperature) for p in prompts]
+        while self.step():
+            pass
+        return [f.result() for f in futures]
+
+    def start(self) -> threading.Thread:
+        """Run the engine in a background (daemon) thread."""
+        thread = threading.Thread(target=self._run, daemon=True)
+        thread.start()
+        return thread
+
+    def _run(self):
+        while True:
+            if not self.waiting and not self.running:
+                # idle until a request arrives
+                self.waiting.append(self._incoming.get())
+            try:
+                self.step()
+            except Exception as e:
+                logger.exception("engine step failed, aborting all requests")
+                for seq in self.running + list(self.waiting):
+                    self.cache.free(seq)
+                    seq.future.set_exception(e)
+                self.running, self.waiting = [], deque()
+
+    @torch.inference_mode()
+    def step(self) -> bool:
+        """Admit waiting requests and decode a token for each running request, returns False when idle."""
+        while True:
+            try:
+                self.waiting.append(self._incoming.get_nowait())
+            except queue.Empty:
+                break
+
+        self._admit()
+        if len(self.running) == 0:
+            return len(self.waiting) > 0
+        self._decode()
+        return True
+
+    def _admit(self):
+        while self.waiting and len(self.running) < self.max_batch_size:
+            seq = self.waiting[0]
+            num_tokens = len(seq.tokens)
+            # keep a block free for each running sequence (so decoding rarely needs to preempt)
+            needed = self.cache.blocks_needed(seq, num_tokens) + len(self.running)
+            if needed > len(self.cache.free_blocks) and len(self.running) > 0:
+                break
+            if not self.cache.allocate(seq, num_tokens):
+                break
+            self.waiting.popleft()
+
+            # prefill (all tokens, also those generated before being preempted)
+            slots = self.cache.slots([seq], num_tokens)
+            positions = torch.arange(num_tokens, device=self.device)[None]
+            mask = torch.ones(
+                num_tokens, num_tokens, dtype=torch.bool, device=self.device
+            ).tril()
+            logits = forward_paged(
+                self.model,
+                self.cache,
+                torch.tensor([seq.tokens], device=self.device),
+                positions,
+                write_slots=slots,
+                read_slots=slots,
+                mask=mask[None, None],
+            )
+            seq.num_cached = num_tokens
+            self.running.append(seq)
+            self._append_tokens([seq], logits[:, -1])
+
+    def _decode(self):
+        # every running sequence needs a slot for its newest token (preempting the latest admitted if needed)
+        i = 0
+        while i < len(self.running):
+            if self.cache.allocate(self.running[i], self.running[i].num_cached + 1):
+                i += 1
+                continue
+            victim = self.running.pop()
+            self.cache.free(victim)
+            self.waiting.appendleft(victim)
+            self.num_preempted += 1
+            logger.debug(f"preempted a sequence ({len(victim.tokens)} tokens)")
+
+        seqs = self.running
+        # shape: [b, 1]
+        positions = torch.tensor([[s.num_cached] for s in seqs], device=self.device)
+        context_len = max(s.num_cached for s in seqs) + 1
+        read_slots = self.cache.slots(seqs, context_len)
+        write_slots = read_slots.gather(1, positions)
+        # shape: [b, 1, 1, l]
+        mask = torch.arange(context_len, device=self.device)[None] <= positions
+        logits = forward_paged(
+            self.model,
+            self.cache,
+            torch.tensor([[s.output_tokens[-1]] for s in seqs], device=self.device),
+            positions,
+            write_slots=write_slots,
+            read_slots=read_slots,
+            mask=mask[:, None, None],
+        )
+        for seq in seqs:
+            seq.num_cached += 1
+        self._append_tokens(list(seqs), logits[:, -1])
+
+    def _append_tokens(self, seqs: List[Sequence], logits: torch.Tensor):
+        """Sample the next token of each sequence (given its logits), completing finished sequences."""
+        temperatures = torch.tensor(
+            [max(s.temperature, 1e-5) for s in seqs], device=self.device
+        )
+        tokens = sample(logits / temperatures[:, None], top_k=self.top_k)
+        self.num_generated += len(seqs)
+        for seq, token in zip(seqs, tokens[:, 0].tolist()):
+            seq.output_tokens.append(token)
+            if token == self.eos_id:
+                self._complete(seq, seq.output_tokens[:-1], "stop")
+            elif len(seq.output_tokens) >= seq.max_tokens:
+                self._complete(seq, seq.output_tokens, "length")
+
+    def _complete(self, seq: Sequence, tokens: List[int], finish_reason: str):
+        self.running.remove(seq)
+        self.cache.free(seq)
+        seq.future.set_result(Completion(tokens, finish_reason, len(seq.prompt_tokens)))
+
+
+def format_chat(messages: List[Dict[str, Any]]) -> str:
+    """Format a conversation as an Alpaca instruction (the format our checkpoints are finetuned on)."""
+    instruction = "\n\n".join(
+        m["content"] for m in messages if m["role"] in ("system", "user")
+    )
+    return AlpacaInstructTemplate.format({"instruction": instruction})
+
+
+def parse_request(
+    body: Any, default_max_tokens: int
+) -> Tuple[List[Dict[str, Any]], int, float]:
+    """
+    Validate the (JSON) body of a chat completions request, returns its messages, max_tokens and temperature.
+    Raises ValueError on invalid requests (which shouldn't reach the engine, where they'd abort the whole batch).
+    """
+    if not isinstance(body, dict):
+        raise ValueError("expected a JSON object")
+    messages = body.get("messages")
+    if not isinstance(messages, list) or not all(
+        isinstance(m, dict)
+        and isinstance(m.get("role"), str)
+        and isinstance(m.get("content"), str)
+        for m in messages
+    ):
+        raise ValueError(
+            "'messages' must be a list of {role, content} with string content"
+        )
+
+    max_tokens = body.get("max_tokens")
+    if max_tokens is None:
+        max_tokens = default_max_tokens
+    elif (
+        isinstance(max_tokens, bool)
+        or not isinstance(max_tokens, int)
+        or max_tokens < 1
+    ):
+        raise ValueError("'max_tokens' must be an integer >= 1")
+
+    # (null is valid OpenAI JSON, meaning the default)
+    temperature = body.get("temperature")
+    if temperature is None:
+        temperature = 1.0
+    elif (
+        isinstance(temperature, bool)
+        or not isinstance(temperature, (int, float))
+        or not math.isfinite(temperature)
+        or temperature < 0
+    ):
+        raise ValueError("'temperature' must be a number >= 0")
+    return messages, max_tokens, float(temperature)
+
+
+class ChatServer(ThreadingHTTPServer):
+    """OpenAI compatible chat completions API for a (started) Engine."""
+
+    def __init__(
+        self,
+        address: tuple[str, int],
+        engine: Engine,
+        tokenizer: Any,
+        model_name: str,
+        max_tokens: int = 1000,
+    ):
+        super().__init__(address, _ChatHandler)
+        self.engine = engine
+        self.tokenizer = tokenizer
+        self.model_name = model_name
+        self.max_tokens = max_tokens  # default (when not given in a request)
+
+
+class _ChatHandler(BaseHTTPRequestHandler):
+    server: ChatServer
+
+    def _respond(self, status: int, body: dict):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _error(
+        self, status: int, message: str, error_type: str = "invalid_request_error"
+    ):
+        self._respond(status, {"error": {"message": message, "type": error_type}})
+
+    def do_GET(self):
+        if self.path.rstrip("/") != "/v1/models":
+            return self._error(404, f"unknown path '{self.path}'")
+        model = {"id": self.server.model_name, "object": "model", "owned_by": "local"}
+        self._respond(200, {"object": "list", "data": [model]})
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/v1/chat/completions":
+            return self._error(404, f"unknown path '{self.path}'")
+        server = self.server
+        try:
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            messages, max_tokens, temperature = parse_request(body, server.max_tokens)
+        except (ValueError, KeyError, TypeError) as e:
+            return self._error(400, f"invalid request: {e}")
+        if body.get("stream") or body.get("n", 1) != 1:
+            return self._error(400, "'stream' and 'n' > 1 aren't supported")
+
+        t0 = time.perf_counter()
+        prompt_tokens = server.tokenizer.encode(
+            format_chat(messages), add_bos=True, add_eos=False
+        )
+        try:
+            future = server.engine.submit(
+                prompt_tokens, max_tokens=max_tokens, temperature=temperature
+            )
+        except ValueError as e:
+            return self._error(400, str(e))
+        try:
+            completion = future.result()
+        except Exception as e:
+            # (the engine step failed, see Engine._run())
+            return self._error(500, f"generation failed: {e}", "server_error")
+
+        num_tokens = len(completion.tokens)
+        t = time.perf_counter() - t0
+        logger.info(
+            f"completed {num_tokens} tokens in {t:.02f} sec ({num_tokens / t:.02f} tokens/sec)"
+        )
+        self._respond(
+            200,
+            {
+                "id": f"chatcmpl-{uuid.uuid4().hex}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body.get("model", server.model_name),
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {
+                            "role": "assistant",
+                            "content": server.tokenizer.decode(completion.tokens),
+                        },
+                        "finish_reason": completion.finish_reason,
+                    }
+                ],
+                "usage": {
+                    "prompt_tokens": completion.prompt_tokens,
+                    "completion_tokens": num_tokens,
+                    "total_tokens": completion.prompt_tokens + num_tokens,
+                },
+            },
+        )
+
+    def log_message(self, format: str, *args):
+        logger.debug(format % args)
+
+
+def load_model(cfg: DictConfig) -> nn.Module:
+    """Load the model checkpoint (see InferenceRecipe in generate.py)."""
+    device = utils.get_device(device=cfg.device)
+    dtype = utils.get_dtype(dtype=cfg.dtype, device=device)
+    ckpt_dict = config.instantiate(cfg.checkpointer).load_checkpoint()
+    with utils.set_default_dtype(dtype), device:
+        model = config.instantiate(cfg.model)
+    model.load_state_dict(ckpt_dict[utils.MODEL_KEY])
+    model.eval()
+    logger.info(f"Model is initialized with precision {dtype}.")
+    return model
+
+
+@config.parse
+def main(cfg: DictConfig) -> None:
+    config.log_config(recipe_name="serve", cfg=cfg)
+    utils.set_seed(seed=cfg.seed)
+    tokenizer = config.instantiate(cfg.tokenizer)
+    engine = Engine(
+        load_model(cfg),
+        num_blocks=cfg.kv_cache_blocks,
+        block_size=cfg.block_size,
+        max_batch_size=cfg.max_batch_size,
+        eos_id=tokenizer.eos_id,
+        top_k=cfg.top_k,
+    )
+    engine.start()
+
+    server = ChatServer(
+        (cfg.host, cfg.port),
+        engine,
+        tokenizer,
+        model_name=cfg.model_name,
+        max_tokens=cfg.max_new_tokens,
+    )
+    logger.info(f"serving '{cfg.model_name}' on http://{cfg.host}:{cfg.port}/v1")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
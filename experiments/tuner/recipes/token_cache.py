@@ -0,0 +1,154 @@
+"""
+Cache of tokenized datasets for lora_finetune_single_device.py (so each run doesn't re-tokenize its dataset).
+Token ids and labels of all samples are stored as flat memory-mapped .npy files (with the offset of each sample),
+in a directory keyed by the tokenizer, prompt template and dataset config.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import time
+from typing import Any, Optional, Protocol
+
+import numpy as np
+from torch.utils.data import Dataset
+from torchtune import utils
+
+TOKENS_FNAME = "tokens.npy"
+LABELS_FNAME = "labels.npy"
+OFFSETS_FNAME = "offsets.npy"
+INFO_FNAME = "info.json"
+
+log = utils.get_logger("DEBUG")
+
+
+class SizedDataset(Protocol):
+    """Map-style dataset with a length (e.g. a torchtune InstructDataset), which torch's Dataset doesn't declare."""
+
+    def __len__(self) -> int: ...
+
+    def __getitem__(self, index: int) -> Any: ...
+
+
+class TokenizedDataset(Dataset):
+    """
+    Tokenized samples [start, stop) read from a cache directory (see write_cache()).
+    Items are (tokens, labels) arrays, which are zero-copy slices of the memory-mapped files
+    (so dataloader workers share the same pages rather than each holding a copy of the dataset).
+    """
+
+    def __init__(self, path: str, start: int = 0, stop: Optional[int] = None):
+        self.path = path
+        self.tokens = np.load(os.path.join(path, TOKENS_FNAME), mmap_mode="r")
+        self.labels = np.load(os.path.join(path, LABELS_FNAME), mmap_mode="r")
+        offsets = np.load(os.path.join(path, OFFSETS_FNAME), mmap_mode="r")
+        self.start = start
+        self.stop = len(offsets) - 1 if stop is None else stop
+        self.offsets = offsets[self.start : self.stop + 1]
+
+    def __len__(self) -> int:
+        return self.stop - self.start
+
+    def __getitem__(self, index: int):
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        start, stop = self.offsets[index], self.offsets[index + 1]
+        return self.tokens[start:stop], self.labels[start:stop]
+
+    @property
+    def lengths(self) -> np.ndarray:
+        """Number of tokens of each sample."""
+        return np.diff(self.offsets)
+
+    def select(self, indices: range) -> "TokenizedDataset":
+        """View of a (contiguous) range of samples, e.g. for a train/validation split."""
+        start, stop, step = slice(indices.start, indices.stop, indices.step).indices(
+            len(self)
+        )
+        assert step == 1, "only contiguous ranges are supported"
+        return TokenizedDataset(
+            self.path, self.start + start, self.start + max(start, stop)
+        )
+
+
+def write_cache(ds: SizedDataset, path: str, info: Optional[dict] = None):
+    """
+    Tokenize all samples of a dataset (with (tokens, labels) items) and write them to a cache directory.
+    Written to a temporary directory first, so an interrupted run never leaves a partial cache behind.
+    """
+    tokens, labels, offsets = [], [], [0]
+    for idx in range(len(ds)):
+        sample_tokens, sample_labels = ds[idx][:2]
+        tokens.extend(sample_tokens)
+        labels.extend(sample_labels)
+        offsets.append(len(tokens))
+
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    os.makedirs(tmp_path, exist_ok=True)
+    np.save(os.path.join(tmp_path, TOKENS_FNAME), np.array(tokens, dtype=np.int32))
+    np.save(os.path.join(tmp_path, LABELS_FNAME), np.array(labels, dtype=np.int32))
+    np.save(os.path.join(tmp_path, OFFSETS_FNAME), np.array(offsets, dtype=np.int64))
+    with open(os.path.join(tmp_path, INFO_FNAME), "w") as f:
+        json.dump(
+            {**(info or {}), "samples": len(ds), "tokens": len(tokens)}, f, indent=2
+        )
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        shutil.rmtree(tmp_path)  # (cache written concurrently by another run)
+
+
+def tokenizer_hash(tokenizer: Any) -> str:
+    """Hash identifying a tokenizer's vocabulary."""
+    if hasattr(tokenizer, "spm_model"):  # SentencePieceTokenizer
+        data = tokenizer.spm_model.serialized_model_proto()
+    else:
+        # (e.g. TikTokenTokenizer, by its encoding and special tokens)
+        data = repr(
+            (
+                getattr(getattr(tokenizer, "tt_model", None), "name", None),
+                getattr(tokenizer, "vocab_size", None),
+                getattr(tokenizer, "all_special_ids", None),
+            )
+        ).encode()
+    return hashlib.sha256(data).hexdigest()
+
+
+def template_id(ds: SizedDataset) -> str:
+    """Identifies the prompt template (and tokenization settings) of a torchtune InstructDataset."""
+    template = getattr(ds, "template", None)
+    return repr(
+        (
+            getattr(template, "__qualname__", repr(template)),
+            getattr(template, "template", None),
+            getattr(ds, "train_on_input", None),
+            getattr(ds, "max_seq_len", None),
+        )
+    )
+
+
+def load_cached(
+    ds: SizedDataset, tokenizer: Any, cache_dir: str, ds_config: str
+) -> TokenizedDataset:
+    """
+    Tokenized version of a dataset, from cache_dir if it was tokenized before (by any run with the same tokenizer,
+    template and dataset config), otherwise tokenizing it (once) and writing it to the cache.
+    ds_config: description of the dataset (e.g. its yaml config), note the dataset itself is only read on a cache miss.
+    """
+    key = {
+        "tokenizer": tokenizer_hash(tokenizer),
+        "template": template_id(ds),
+        "dataset": ds_config,
+    }
+    digest = hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+    path = os.path.join(cache_dir, digest[:16])
+    if not os.path.isdir(path):
+        log.info(f"tokenizing {len(ds):_} samples, caching to '{path}'")
+        t0 = time.perf_counter()
+        os.makedirs(cache_dir, exist_ok=True)
+        write_cache(ds, path, info=key)
+        log.info(f"tokenized dataset in {time.perf_counter() - t0:.1f} secs")
+    else:
+        log.info(f"using tokenized dataset cache '{path}'")
+    return TokenizedDataset(path)